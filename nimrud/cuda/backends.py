@@ -0,0 +1,471 @@
+# pylint: disable=E0401, E1101
+
+"""
+compute backends for the neighborhood pipeline of the multiscale operators.
+
+the prototype operators (G_MSO, OG_MSO and C_MSO in nimrud.prototypes.mso) run one processing
+chain whose every step goes through a Backend: voxelizing the search space, grabbing the
+neighbors of each query point, dropping them to each scale, and reducing them to centroids,
+covariances and eigenvalues. the numpy backend, which is the default, runs those steps on the
+host, so the chain runs and can be benchmarked on CPU-only nodes; the cuda backend runs them with
+the pycuda kernels in nimrud.prototypes.ch on GPU nodes.
+
+the backend is picked at runtime by name: get_backend("cuda"), or the NIMRUD_BACKEND environment
+variable when no name is given. pycuda is only imported when the cuda backend is created.
+
+neighborhoods travel between the steps ragged, on the host: the coordinates of every neighbor
+relative to its query point, flat and one query point after another, with the row offsets of
+each query point's neighbors (as in nimrud.features.neighborhoods). only real neighbors are
+stored, so their size doesn't follow the largest neighborhood. load puts a chunk of them in the
+backend's working layout: RaggedNeighborhoods for numpy, and the prototypes' padded
+(num query points, num rows, 3) tensor with its irows on the GPU.
+
+arrays are stored in single precision, but centroids and covariances are accumulated in double
+precision about each neighborhood's own centroid, and cast back when they're stored. points
+should be moved near the origin (nimrud.utils.geometry.local_frame) before they go to a backend,
+so that their single precision offsets are worth accumulating.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+from nimrud.features.eigen import normalized_eigenvalues
+from nimrud.utils.geometry import VoxelFilter
+from nimrud.utils.lazy import lazy_from, lazy_import
+
+# scipy is only loaded once the numpy backend searches
+cKDTree = lazy_from("scipy.spatial", "cKDTree")
+Neighborhoods = lazy_from("nimrud.features.neighborhoods", "Neighborhoods")
+RaggedNeighborhoods = lazy_from("nimrud.features.neighborhoods", "RaggedNeighborhoods")
+
+# the prototype chain imports this module, so it's only loaded once an operator is run
+prototype_mso = lazy_import("nimrud.prototypes.mso")
+
+
+# environment variable naming the backend get_backend uses by default
+BACKEND_VARIABLE = "NIMRUD_BACKEND"
+DEFAULT_BACKEND = "numpy"
+
+# the prototypes import each other by bare name (import ch), so the cuda backend puts their
+# directory on the path
+PROTOTYPES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          "prototypes")
+
+#---------------------------------------------------------------------------------------------------
+
+class Backend(object):
+    """
+    interface for the neighborhood pipeline. arrays passed between the methods live wherever the
+    backend keeps them (on the host for numpy, on the GPU for cuda); use to_device and to_host to
+    move data in and out. ragged neighborhoods (coordinates, row offsets) are always on the host.
+    """
+
+    name = None
+
+    #==================================
+
+    def geometric_mso(self, query_set, search_space, voxel_edge, scales, **options):
+        """
+        run the prototype first order multiscale operator (nimrud.prototypes.mso.G_MSO) on this
+        backend. returns G_MSO's output: [index, (density, centroid, eigval x2) x num scales]
+        for every query set point it processed, with scales in descending order.
+        """
+
+        return prototype_mso.G_MSO(query_set, search_space, voxel_edge, scales, backend=self,
+                                   **options)
+
+    #==================================
+
+    def to_device(self, array):
+        """
+        move a host array to the backend as float32 (or uint32 for integer arrays)
+        """
+        raise NotImplementedError
+
+    #==================================
+
+    def to_host(self, array):
+        """
+        return a backend array as a numpy array on the host
+        """
+        raise NotImplementedError
+
+    #==================================
+
+    def release(self, *arrays):
+        """
+        free backend arrays (or loaded neighborhoods) that are no longer needed
+        """
+        pass
+
+    #==================================
+
+    def search_index(self, search_space):
+        """
+        prepare a host search space for repeated grabs
+        """
+        raise NotImplementedError
+
+    #==================================
+
+    def grab(self, index, query_set, radius):
+        """
+        find the neighbors strictly within radius of each point of a host query set, in a
+        search space prepared by search_index. returns the ragged neighborhoods on the host:
+        (float32 coordinates relative to the query points, row offsets).
+        """
+        raise NotImplementedError
+
+    #==================================
+
+    def load(self, coordinates, row_offsets):
+        """
+        put ragged neighborhoods in the backend's working layout, for shrink, centroids and
+        covariances
+        """
+        raise NotImplementedError
+
+    #==================================
+
+    def shrink(self, neighborhoods, radius):
+        """
+        drop the neighbors at radius or farther from loaded neighborhoods, in place, and return
+        the number of neighbors left for each query point on the host, as NBtensor.drop does
+        """
+        raise NotImplementedError
+
+    #==================================
+
+    def centroids(self, neighborhoods):
+        """
+        centroid of each neighborhood and its distance from the query point, as returned by
+        NBtensor.MP_displacement, summed in double precision. returns (distances, centroids).
+        """
+        raise NotImplementedError
+
+    #==================================
+
+    def covariances(self, neighborhoods, centroids):
+        """
+        (num query points, 3, 3) unnormalized covariance of each neighborhood about its
+        centroid, as returned by NBtensor.MSPCA_cov, accumulated in double precision
+        """
+        raise NotImplementedError
+
+    #==================================
+
+    def eigenvalues(self, covariances):
+        """
+        eigenvalues of each covariance matrix, normalized to sum to 1 and sorted in descending
+        order, as computed inside NBtensor.MSPCA_eigs
+        """
+        raise NotImplementedError
+
+    #==================================
+
+    def voxelize(self, points, edge):
+        """
+        one point per occupied voxel of the given edge length
+        """
+        raise NotImplementedError
+
+    #==================================
+
+    def ball_query(self, points, center, radius):
+        """
+        sorted indices of the points strictly within radius of center
+        """
+        raise NotImplementedError
+
+    #==================================
+
+    def box_query(self, points, center, radius):
+        """
+        sorted indices of the points strictly within radius of center along every axis (the
+        chebyshev ball)
+        """
+        raise NotImplementedError
+
+#---------------------------------------------------------------------------------------------------
+
+class NumpyBackend(Backend):
+    """
+    the pipeline on the host with numpy and scipy: KD tree searches, and RaggedNeighborhoods as
+    the working layout
+    """
+
+    name = "numpy"
+
+    #==================================
+
+    def to_device(self, array):
+
+        array = np.asarray(array)
+        if np.issubdtype(array.dtype, np.integer):
+            return array.astype(np.uint32)
+        return array.astype(np.float32)
+
+    #==================================
+
+    def to_host(self, array):
+        return np.asarray(array)
+
+    #==================================
+
+    def search_index(self, search_space):
+
+        search_space = np.asarray(search_space, dtype=np.float32)
+        return search_space, cKDTree(search_space)
+
+    #==================================
+
+    def grab(self, index, query_set, radius):
+
+        search_space, tree = index
+        query_set = np.asarray(query_set, dtype=np.float32)
+        neighborhoods = RaggedNeighborhoods.from_neighborhoods(
+            Neighborhoods.radius_search(search_space, query_set, radius, tree),
+            search_space,
+            query_set)
+        return neighborhoods.coordinates, neighborhoods.row_offsets
+
+    #==================================
+
+    def load(self, coordinates, row_offsets):
+
+        # the float32 coordinates decide the distances, and each row is sorted by them so that
+        # shrinking only moves the row's end
+        row_offsets = np.asarray(row_offsets, dtype=np.int64)
+        coordinates = np.asarray(coordinates, dtype=np.float32).reshape(-1, 3)
+        wide = coordinates.astype(np.float64)
+        distances = np.sqrt(np.einsum("ij,ij->i", wide, wide))
+        row_ids = np.repeat(np.arange(row_offsets.size - 1), np.diff(row_offsets))
+        order = np.lexsort((distances, row_ids))
+        return RaggedNeighborhoods(row_offsets, order, distances.take(order),
+                                   coordinates.take(order, axis=0))
+
+    #==================================
+
+    def shrink(self, neighborhoods, radius):
+        return neighborhoods.drop(radius)
+
+    #==================================
+
+    def centroids(self, neighborhoods):
+
+        centroids = neighborhoods.centroids()
+        distances = np.sqrt(np.einsum("ij,ij->i", centroids, centroids))
+        return distances.astype(np.float32), centroids.astype(np.float32)
+
+    #==================================
+
+    def covariances(self, neighborhoods, centroids):
+        return neighborhoods.scatter_matrices().astype(np.float32)
+
+    #==================================
+
+    def eigenvalues(self, covariances):
+        return normalized_eigenvalues(covariances).astype(np.float32)
+
+    #==================================
+
+    def voxelize(self, points, edge):
+        return VoxelFilter(points, edge).unique_voxels(points)
+
+    #==================================
+
+    def ball_query(self, points, center, radius):
+
+        offsets = points - np.asarray(center).reshape(1, 3)
+        return np.flatnonzero(np.einsum("ij,ij->i", offsets, offsets) < radius * radius)
+
+    #==================================
+
+    def box_query(self, points, center, radius):
+
+        offsets = np.abs(points - np.asarray(center).reshape(1, 3))
+        return np.flatnonzero(offsets.max(1) < radius)
+
+#---------------------------------------------------------------------------------------------------
+
+class PaddedNeighborhoods(object):
+    """
+    the cuda backend's working layout: a padded neighborhood tensor on the GPU and irows, the
+    number of neighbors at the head of each page
+    """
+
+    def __init__(self, tensor, irows):
+
+        self.tensor = tensor
+        self.irows = irows
+
+#---------------------------------------------------------------------------------------------------
+
+class CudaBackend(Backend):
+    """
+    the pipeline on the GPU, through the pycuda kernels in nimrud.prototypes.ch. creating one
+    initializes a CUDA context, and raises ImportError if pycuda isn't installed.
+    """
+
+    name = "cuda"
+
+    def __init__(self):
+
+        # importing ch runs pycuda.autoinit, so only do it once the cuda backend is asked for
+        import pycuda.gpuarray as gpuarray
+        if PROTOTYPES not in sys.path:
+            sys.path.append(PROTOTYPES)
+        import ch
+        self.gpuarray = gpuarray
+        self.ch = ch
+        # max rows of a neighborhood tensor straight out of ngrab, as set in NBtensor
+        self.i2 = 5000
+
+    #==================================
+
+    def to_device(self, array):
+
+        array = np.asarray(array)
+        if np.issubdtype(array.dtype, np.integer):
+            return self.gpuarray.to_gpu(array.astype(np.uint32))
+        return self.gpuarray.to_gpu(array.astype(np.float32))
+
+    #==================================
+
+    def to_host(self, array):
+
+        if isinstance(array, self.gpuarray.GPUArray):
+            return array.get()
+        return np.asarray(array)
+
+    #==================================
+
+    def release(self, *arrays):
+
+        for array in arrays:
+            if isinstance(array, PaddedNeighborhoods):
+                self.release(array.tensor, array.irows)
+            elif isinstance(array, self.gpuarray.GPUArray):
+                array.gpudata.free()
+
+    #==================================
+
+    def search_index(self, search_space):
+        return self.to_device(search_space)
+
+    #==================================
+
+    def grab(self, index, query_set, radius):
+
+        # as in NBtensor.fill: grab and compact, with the query point at the head of each page
+        query_set = self.to_device(query_set)
+        irows = self.gpuarray.zeros(query_set.shape[0], dtype=np.uint32)
+        irows.fill(index.shape[0] + 1)
+        headed = self.ch.ngrab(index, query_set, radius)
+        self.release(query_set)
+        headed, irows = self.ch.PTshrink(headed, irows, self.i2, radius)
+
+        # strip the query points off, as NB_process did, and keep the neighbors of each page
+        tensor = headed.get()[:, 1:, :]
+        self.release(headed, irows)
+        irows = np.full(tensor.shape[0], tensor.shape[1], dtype=np.uint32)
+        neighborhoods = PaddedNeighborhoods(self.to_device(tensor), self.to_device(irows))
+        lengths = self.shrink(neighborhoods, radius).astype(np.int64)
+        tensor = self.to_host(neighborhoods.tensor)
+        self.release(neighborhoods)
+
+        live = np.arange(tensor.shape[1]) < lengths.reshape(-1, 1)
+        row_offsets = np.zeros(lengths.size + 1, dtype=np.int64)
+        np.cumsum(lengths, out=row_offsets[1:])
+        return tensor[live], row_offsets
+
+    #==================================
+
+    def load(self, coordinates, row_offsets):
+
+        lengths = np.diff(row_offsets)
+        width = max(int(lengths.max()), 1) if lengths.size else 1
+        tensor = np.zeros((lengths.size, width, 3), dtype=np.float32)
+        tensor[np.arange(width) < lengths.reshape(-1, 1)] = coordinates
+        return PaddedNeighborhoods(self.to_device(tensor), self.to_device(lengths))
+
+    #==================================
+
+    def shrink(self, neighborhoods, radius):
+
+        neighborhoods.tensor, neighborhoods.irows = self.ch.PTshrink(
+            neighborhoods.tensor, neighborhoods.irows, 0, radius)
+        return neighborhoods.irows.get()
+
+    #==================================
+
+    def centroids(self, neighborhoods):
+        return self.ch.PTcentroid(neighborhoods.tensor, neighborhoods.irows)
+
+    #==================================
+
+    def covariances(self, neighborhoods, centroids):
+        return self.ch.PT_cov(neighborhoods.tensor, centroids, neighborhoods.irows)
+
+    #==================================
+
+    def eigenvalues(self, covariances):
+        return self.ch.row_norm_sort(self.ch.block_eigvals(covariances))
+
+    #==================================
+
+    def voxelize(self, points, edge):
+        # double_vox tiles the space so that cuvox never sees more than its grid can address
+        return self.to_device(prototype_mso.double_vox(self.to_host(points), edge))
+
+    #==================================
+
+    def ball_query(self, points, center, radius):
+        return self.ch.cu_query_neighborhood(points, center, radius, "euclid")
+
+    #==================================
+
+    def box_query(self, points, center, radius):
+        return self.ch.cu_query_neighborhood(points, center, radius, "cheby")
+
+#---------------------------------------------------------------------------------------------------
+
+# every backend get_backend knows, by name
+BACKENDS = {
+    NumpyBackend.name: NumpyBackend,
+    CudaBackend.name: CudaBackend}
+
+#---------------------------------------------------------------------------------------------------
+
+def get_backend(name=None):
+    """
+    create the named backend. without a name, use the NIMRUD_BACKEND environment variable, or
+    numpy if that isn't set. a Backend instance is passed straight through.
+    """
+
+    if isinstance(name, Backend):
+        return name
+    if name is None:
+        name = os.environ.get(BACKEND_VARIABLE, DEFAULT_BACKEND)
+    if name not in BACKENDS:
+        raise ValueError("backend must be one of {}".format(sorted(BACKENDS)))
+    return BACKENDS[name]()
+
+#---------------------------------------------------------------------------------------------------
+
+def available_backends():
+    """
+    names of the backends that can be created here, i.e. numpy, and cuda if pycuda imports and
+    finds a GPU
+    """
+
+    available = []
+    for name in sorted(BACKENDS):
+        try:
+            BACKENDS[name]()
+        except Exception:                   # pylint: disable=broad-except
+            continue
+        available.append(name)
+    return available
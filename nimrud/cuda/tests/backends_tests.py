@@ -0,0 +1,162 @@
+# pylint: disable=E0401, E1101
+
+"""
+tests for the compute backends
+"""
+
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from nimrud.cuda import backends
+from nimrud.features import mso
+from nimrud.utils.geometry import local_frame
+
+SEED = 10
+np.random.seed(SEED)
+
+#---------------------------------------------------------------------------------------------------
+
+def test_get_backend():
+    """
+    backends should be picked by name or from the environment, with numpy as the default
+    """
+
+    saved = os.environ.pop(backends.BACKEND_VARIABLE, None)
+    try:
+        assert isinstance(backends.get_backend(), backends.NumpyBackend), "wrong default"
+        os.environ[backends.BACKEND_VARIABLE] = "numpy"
+        assert backends.get_backend().name == "numpy", "didn't read the environment"
+        numpy_backend = backends.NumpyBackend()
+        assert backends.get_backend(numpy_backend) is numpy_backend, "didn't pass a backend on"
+        assert "numpy" in backends.available_backends(), "numpy backend isn't available"
+        try:
+            backends.get_backend("abacus")
+            assert False, "accepted an unknown backend"
+        except ValueError:
+            pass
+    finally:
+        os.environ.pop(backends.BACKEND_VARIABLE, None)
+        if saved is not None:
+            os.environ[backends.BACKEND_VARIABLE] = saved
+
+#---------------------------------------------------------------------------------------------------
+
+def test_backend_steps():
+    """
+    each backend's steps should grab, shrink and reduce neighborhoods like a brute force search
+    """
+
+    search_space = np.random.rand(500, 3).astype(np.float32)
+    query_set = np.random.rand(40, 3).astype(np.float32)
+    tree = cKDTree(search_space)
+
+    for name in backends.available_backends():
+        backend = backends.get_backend(name)
+        index = backend.search_index(search_space)
+        coordinates, row_offsets = backend.grab(index, query_set, 0.3)
+        backend.release(index)
+        neighborhoods = backend.load(coordinates, row_offsets)
+        for radius in [0.3, 0.15]:
+            irows = backend.shrink(neighborhoods, radius)
+            distances, centroids = backend.centroids(neighborhoods)
+            covariances = backend.covariances(neighborhoods, centroids)
+            eigenvalues = backend.to_host(backend.eigenvalues(covariances))
+            distances, centroids = backend.to_host(distances), backend.to_host(centroids)
+            covariances = backend.to_host(covariances)
+            for page, point in enumerate(query_set):
+                offsets = search_space[tree.query_ball_point(point, radius)] - point
+                offsets = offsets[np.linalg.norm(offsets, axis=1) < radius]
+                assert irows[page] == offsets.shape[0], "{}: wrong neighbor count".format(name)
+                if irows[page] == 0:
+                    continue
+                assert np.allclose(centroids[page], offsets.mean(0), atol=1e-6),\
+                    "{}: wrong centroid".format(name)
+                assert np.isclose(distances[page], np.linalg.norm(offsets.mean(0)), atol=1e-6),\
+                    "{}: wrong centroid distance".format(name)
+                known = np.cov(offsets.T, bias=True) * offsets.shape[0]
+                assert np.allclose(covariances[page], known, atol=1e-4),\
+                    "{}: wrong covariance".format(name)
+                values = np.linalg.eigvalsh(known)[::-1]
+                assert np.allclose(eigenvalues[page], values / (values.sum() + np.spacing(1)),
+                                   atol=1e-4),\
+                    "{}: wrong eigenvalues".format(name)
+        backend.release(neighborhoods)
+
+    backend = backends.NumpyBackend()
+    index = backend.box_query(search_space, [0.5, 0.5, 0.5], 0.2)
+    assert np.array_equal(index, np.flatnonzero(np.abs(search_space - 0.5).max(1) < 0.2)),\
+        "wrong box query"
+
+#---------------------------------------------------------------------------------------------------
+
+def test_backend_mso():
+    """
+    the prototype operator should agree with the CPU multiscale operator on every backend, with
+    the search space partitioned or not
+    """
+
+    search_space = np.random.rand(8000, 3) * 4
+    query_set = np.random.rand(1000, 3) * 4
+    scales = [0.2, 0.5, 0.4]
+
+    known = mso.geometric_mso(query_set, search_space, 0, scales)
+    for name in backends.available_backends():
+        backend = backends.get_backend(name)
+        for imax in [20000, 1500]:
+            test = backend.geometric_mso(query_set, search_space, 0, scales, imax=imax)
+            assert test.dtype == np.float32 and test.shape[1] == known.shape[1],\
+                "wrong output layout"
+            rows = test[:, 0].astype(int)
+            assert rows.size > 0.9 * known.shape[0], "{} backend dropped points".format(name)
+            assert np.allclose(test, known[rows], atol=1e-4),\
+                "{} backend disagrees with the CPU mso".format(name)
+
+#---------------------------------------------------------------------------------------------------
+
+def test_steps_far_from_origin():
+    """
+    single precision neighborhoods of clouds moved to a local frame shouldn't ruin the
+    eigenvalues of flat neighborhoods in UTM-sized coordinates
+    """
+
+    corner = np.array([512345.678, 4123456.789, 150.0])
+    search_space = np.random.rand(1500, 3) * [1, 1, 0.002] + corner
+    query_set = np.random.rand(100, 3) * [1, 1, 0.002] + corner
+    scales = [0.3, 0.15]
+    known = mso.geometric_mso(query_set, search_space, 0, scales)
+
+    backend = backends.NumpyBackend()
+    _, (query_set, search_space) = local_frame(query_set, search_space)
+    index = backend.search_index(search_space)
+    neighborhoods = backend.load(*backend.grab(index, query_set, scales[0]))
+    for scale_num, scale in enumerate(scales):
+        column = 1 + scale_num * 4
+        irows = backend.shrink(neighborhoods, scale)
+        assert np.allclose(irows, known[:, column] * mso._ball_volume(scale)),\
+            "wrong neighbor counts"
+        distances, centroids = backend.centroids(neighborhoods)
+        assert np.allclose(distances, known[:, column + 1], atol=1e-4), "wrong centroid distances"
+        eigenvalues = backend.eigenvalues(backend.covariances(neighborhoods, centroids))
+        assert np.allclose(eigenvalues[:, :2], known[:, column + 2:column + 4], atol=1e-4),\
+            "lost precision far from the origin"
+        # the two biggest normalized eigenvalues of a flat neighborhood sum to nearly 1
+        assert np.all(eigenvalues[:, 0] + eigenvalues[:, 1] > 0.999),\
+            "flat neighborhoods came out thick"
+
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    print("testing backend selection")
+    test_get_backend()
+    print("backends selected")
+    print("testing backend steps")
+    test_backend_steps()
+    print("backend steps match a brute force search")
+    print("testing backend mso")
+    test_backend_mso()
+    print("backend mso matches")
+    print("testing backend steps far from the origin")
+    test_steps_far_from_origin()
+    print("backend steps keep their precision far from the origin")
@@ -0,0 +1,186 @@
+# pylint: disable=E0401, E1101
+
+"""
+closed form eigendecomposition of stacks of 3x3 symmetric matrices (neighborhood covariances).
+
+numpy.linalg.eigh calls LAPACK once per matrix, which dominates the cost of the eigenfeatures when
+there are millions of small matrices. the functions here solve the characteristic cubic directly
+with the trigonometric form of Cardano's method, using plain array arithmetic over the whole
+stack, as ch.block_eigvals does on the GPU. eigenvectors come from cross products of the rows of
+the shifted matrices; matrices whose eigenvalues are too close together for that to be accurate
+fall back to numpy.linalg.eigh.
+"""
+
+import numpy as np
+
+
+# tiny number to protect against division by zero
+EPS = np.spacing(1)
+
+# eigenvalue gaps smaller than this, relative to the largest eigenvalue magnitude, are too
+# close together to find eigenvectors by cross products
+DEGENERACY_TOLERANCE = 1e-4
+
+# the features computed by eigen_features, in column order
+EIGEN_FEATURES = ["linearity", "planarity", "scattering", "omnivariance", "anisotropy",
+                  "eigenentropy", "change_of_curvature", "verticality", "normal_z"]
+
+#---------------------------------------------------------------------------------------------------
+
+def symmetric_eigvals(matrices):
+    """
+    given an (n, 3, 3) stack of symmetric matrices, return their eigenvalues as an (n, 3) float64
+    array in ascending order, like numpy.linalg.eigvalsh.
+    """
+
+    matrices, scale = _scaled(matrices)
+    return _eigvals(matrices) * scale
+
+#---------------------------------------------------------------------------------------------------
+
+def symmetric_eigh(matrices):
+    """
+    given an (n, 3, 3) stack of symmetric matrices, return their eigenvalues as an (n, 3) array
+    in ascending order and their unit eigenvectors as the columns of an (n, 3, 3) array, like
+    numpy.linalg.eigh. eigenvector signs are arbitrary.
+    """
+
+    matrices, scale = _scaled(matrices)
+    values = _eigvals(matrices)
+
+    # the largest and smallest eigenvectors are the null vectors of the shifted matrices, and
+    # the middle one is orthogonal to both
+    largest = _null_vectors(matrices, values[:, 2])
+    smallest = _null_vectors(matrices, values[:, 0])
+    middle = np.cross(smallest, largest)
+    middle /= np.sqrt(np.einsum("ij,ij->i", middle, middle)).reshape(-1, 1) + EPS
+    vectors = np.stack([smallest, middle, largest], axis=2)
+
+    # repeated (or nearly repeated) eigenvalues make the null vectors ill defined
+    gaps = np.diff(values, axis=1).min(1)
+    degenerate = gaps <= DEGENERACY_TOLERANCE * np.abs(values).max(1)
+    if degenerate.any():
+        values[degenerate], vectors[degenerate] = np.linalg.eigh(matrices[degenerate])
+
+    return values * scale, vectors
+
+#---------------------------------------------------------------------------------------------------
+
+def normalized_eigenvalues(covariances, vectors=False):
+    """
+    given an (n, 3, 3) stack of covariance matrices, return their eigenvalues as an (n, 3) array,
+    sorted in descending order and normalized to sum to 1. if vectors, also return the matching
+    unit eigenvectors as the columns of an (n, 3, 3) array.
+    """
+
+    if vectors:
+        eigenvalues, eigenvectors = symmetric_eigh(covariances)
+    else:
+        eigenvalues = symmetric_eigvals(covariances)
+    eigenvalues = eigenvalues[:, ::-1] / (eigenvalues.sum(1).reshape(-1, 1) + EPS)
+
+    if vectors:
+        return eigenvalues, eigenvectors[:, :, ::-1]
+    return eigenvalues
+
+#---------------------------------------------------------------------------------------------------
+
+def eigen_features(values, vectors):
+    """
+    given normalized eigenvalues in descending order and their eigenvectors, as returned by
+    normalized_eigenvalues(covariances, vectors=True), return an (n, len(EIGEN_FEATURES)) array of
+    the standard eigenvalue features of each neighborhood:
+        linearity: (l1 - l2) / l1
+        planarity: (l2 - l3) / l1
+        scattering: l3 / l1
+        omnivariance: (l1 l2 l3) ^ (1/3)
+        anisotropy: (l1 - l3) / l1
+        eigenentropy: -sum(l ln l)
+        change of curvature: l3 / (l1 + l2 + l3)
+        verticality: 1 - |normal z|
+        normal z: |normal z|
+    where the normal is the eigenvector of the smallest eigenvalue. neighborhoods with no spread
+    get 0 for the ratios.
+    """
+
+    largest, middle, smallest = values[:, 0], values[:, 1], values[:, 2]
+    divisor = np.where(largest > 0, largest, np.inf)
+    logs = np.log(np.where(values > 0, values, 1))
+    normal_z = np.abs(vectors[:, 2, 2])
+
+    return np.column_stack((
+        (largest - middle) / divisor,
+        (middle - smallest) / divisor,
+        smallest / divisor,
+        np.cbrt(np.maximum(largest * middle * smallest, 0)),
+        (largest - smallest) / divisor,
+        -(values * logs).sum(1),
+        smallest / (values.sum(1) + EPS),
+        1 - normal_z,
+        normal_z))
+
+#---------------------------------------------------------------------------------------------------
+
+def _scaled(matrices):
+    """
+    convert a stack of matrices to float64 and divide each by its largest magnitude entry, so the
+    cubic's coefficients can't overflow or underflow. return the scaled stack and the (n, 1)
+    scales to multiply the eigenvalues by.
+    """
+
+    matrices = np.asarray(matrices, dtype=np.float64)
+    if matrices.ndim != 3 or matrices.shape[1:] != (3, 3):
+        raise ValueError("need an (n, 3, 3) stack of matrices")
+    scale = np.abs(matrices).reshape(-1, 9).max(1, initial=0).reshape(-1, 1)
+    scale[scale == 0] = 1
+    return matrices / scale.reshape(-1, 1, 1), scale
+
+#---------------------------------------------------------------------------------------------------
+
+def _eigvals(matrices):
+    """
+    ascending eigenvalues of a stack of scaled symmetric matrices.
+
+    with q the mean of the eigenvalues and p their spread, the eigenvalues of A are
+    q + 2p cos(phi + 2k pi / 3), where 3 phi = arccos(det((A - qI) / p) / 2).
+    """
+
+    a00, a11, a22 = matrices[:, 0, 0], matrices[:, 1, 1], matrices[:, 2, 2]
+    a01, a02, a12 = matrices[:, 0, 1], matrices[:, 0, 2], matrices[:, 1, 2]
+
+    mean = (a00 + a11 + a22) / 3
+    d00, d11, d22 = a00 - mean, a11 - mean, a22 - mean
+    spread = np.sqrt((d00 * d00 + d11 * d11 + d22 * d22 +
+                      2 * (a01 * a01 + a02 * a02 + a12 * a12)) / 6)
+    # multiples of the identity have zero spread, and every eigenvalue equal to the mean
+    divisor = np.where(spread > 0, spread, 1)
+
+    b00, b11, b22 = d00 / divisor, d11 / divisor, d22 / divisor
+    b01, b02, b12 = a01 / divisor, a02 / divisor, a12 / divisor
+    half_det = (b00 * (b11 * b22 - b12 * b12) -
+                b01 * (b01 * b22 - b12 * b02) +
+                b02 * (b01 * b12 - b11 * b02)) / 2
+    phi = np.arccos(np.clip(half_det, -1, 1)) / 3
+
+    largest = mean + 2 * spread * np.cos(phi)
+    smallest = mean + 2 * spread * np.cos(phi + 2 * np.pi / 3)
+    # the trace fixes the middle one, without a third cosine
+    middle = 3 * mean - largest - smallest
+
+    return np.column_stack((smallest, middle, largest))
+
+#---------------------------------------------------------------------------------------------------
+
+def _null_vectors(matrices, values):
+    """
+    unit vectors spanning the null space of each (A - value I), for simple eigenvalues. any two
+    independent rows of the shifted matrix are orthogonal to the eigenvector, so it is the
+    longest of the cross products of their pairs.
+    """
+
+    shifted = matrices - values.reshape(-1, 1, 1) * np.eye(3)
+    crosses = np.cross(shifted[:, [0, 0, 1]], shifted[:, [1, 2, 2]])
+    lengths = np.einsum("ijk,ijk->ij", crosses, crosses)
+    best = lengths.argmax(1)
+    rows = np.arange(matrices.shape[0])
+    return crosses[rows, best] / (np.sqrt(lengths[rows, best]).reshape(-1, 1) + EPS)
@@ -0,0 +1,106 @@
+# pylint: disable=E0401, E1101
+
+"""
+incremental recomputation of multiscale features after points are added to or removed from the
+search space.
+
+a change can only alter the features of query points whose neighborhoods reach it: within the
+largest scale in radius mode, or within the distance to the farthest of the k nearest neighbors
+in knn mode. affected_rows finds those query points through a KD tree, and update_mso recomputes
+just their rows and writes them over the stored features, in place.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from nimrud.features import mso
+from nimrud.utils.geometry import VoxelFilter
+
+#---------------------------------------------------------------------------------------------------
+
+def affected_rows(query_set, search_space, changed_points, scales, scale_mode="radius",
+                  voxel_edge=0):
+    """
+    sorted rows of the query set whose features (at the given scales) can change when the points
+    in changed_points are added to or removed from the search space. search_space is the search
+    space after the change.
+
+    in radius mode, that is every query point within the largest scale of a changed point. in
+    knn mode it is every query point with a changed point no farther than its largest-k nearest
+    neighbor in the new search space: an added point has to be within that distance to join
+    the neighborhood, and a removed one was within the (smaller) distance before it left. with a
+    voxel_edge, that distance is measured among the voxel centers the operator searches, and the
+    reach grows by half a voxel diagonal, since the voxel a point moves into can be that far
+    from it.
+    """
+
+    changed_points = np.asarray(changed_points, dtype=np.float64).reshape(-1, 3)
+    if changed_points.shape[0] == 0 or query_set.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    scales = np.atleast_1d(np.asarray(scales, dtype=np.float64))
+    slack = voxel_edge * np.sqrt(3) / 2 if voxel_edge else 0
+
+    if scale_mode == "radius":
+        # search around the (usually few) changed points rather than the whole query set
+        neighbor_lists = cKDTree(query_set).query_ball_point(
+            changed_points, scales.max() + slack)
+        rows = [row for neighbors in neighbor_lists for row in neighbors]
+        return np.unique(np.asarray(rows, dtype=np.int64))
+
+    if scale_mode not in mso.SCALE_MODES:
+        raise ValueError("scale mode must be one of {}".format(mso.SCALE_MODES))
+    largest = int(scales.max())
+    if search_space.shape[0] == 0:
+        return np.arange(query_set.shape[0])
+    # the operator's neighbors are voxel centers, which are sparser than the points and reach
+    # farther, so measure the reach on the search space it actually searches
+    if voxel_edge:
+        search_space = VoxelFilter(search_space, voxel_edge).unique_voxels(search_space)
+    reach, _ = cKDTree(search_space).query(query_set, k=largest)
+    # rows with fewer than k neighbors in the whole search space get an infinite reach, so they
+    # see every change
+    reach = reach.reshape(query_set.shape[0], -1)[:, -1]
+    nearest_change, _ = cKDTree(changed_points).query(query_set)
+    return np.flatnonzero(nearest_change <= reach + slack)
+
+#---------------------------------------------------------------------------------------------------
+
+def update_mso(features, query_set, search_space, changed_points, voxel_edge, scales,
+               operator=mso.geometric_mso, scale_mode="radius", **options):
+    """
+    patch the stored output of a multiscale operator after the points in changed_points were
+    added to or removed from the search space.
+
+    features holds operator's output for query_set against the old search space, one row per
+    query set point (as geometric_mso, oriented_mso and covariance_mso return it). it may be an
+    array, a memmap, or the path of a .npy file, which is opened and patched on disk.
+    search_space is the search space after the change. only the rows found by affected_rows are
+    recomputed, with operator(query_set[rows], search_space, voxel_edge, scales,
+    scale_mode=scale_mode, **options), and written over their old values with their indices
+    kept. returns the rows that were recomputed.
+
+    with a voxel_edge, the voxel grid is anchored at the search space's minimum corner, so a
+    change that moves that corner (points added beyond the cloud's lower bounds) shifts every
+    voxel, and the whole cloud needs recomputing.
+    """
+
+    if isinstance(features, str):
+        features = np.load(features, mmap_mode="r+")
+    if features.shape[0] != query_set.shape[0]:
+        raise ValueError("need one row of features per query set point")
+
+    rows = affected_rows(query_set, search_space, changed_points, scales, scale_mode, voxel_edge)
+    if rows.size == 0:
+        return rows
+
+    updated = operator(query_set[rows], search_space, voxel_edge, scales,
+                       scale_mode=scale_mode, **options)
+    if updated.shape[1] != features.shape[1]:
+        raise ValueError("the operator's output doesn't match the stored features")
+    # keep the stored indices: the operator numbered the rows from 0
+    updated[:, 0] = features[rows, 0]
+    features[rows] = updated
+    if isinstance(features, np.memmap):
+        features.flush()
+
+    return rows
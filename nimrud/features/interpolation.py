@@ -0,0 +1,197 @@
+# pylint: disable=E0401, E1101
+
+"""
+interpolation of vector fields, given as features on the points of a cloud, to voxel centers.
+
+each voxel center gets the (optionally weighted) mean of the features of the points within the
+voxel edge of it, without a query set x search space distance matrix. a point can only be that close to the voxel centers of its own cell and
+of the neighboring cells on its side of each axis, so each point has at most 8 candidate voxels
+on the grid. the points are streamed through in chunks: every chunk is scattered to its
+candidates, sorted by voxel address, and summed per voxel with np.add.reduceat. the work is O(n)
+in the number of points and the memory is bounded by the chunk size and the number of voxels.
+
+query sets that aren't on one regular grid (voxels from partitions voxelized separately, say)
+go through interpolate_to_points instead, which gathers each query point's neighbors from a KD
+tree.
+"""
+
+from itertools import product
+
+import numpy as np
+
+from nimrud.utils.geometry import VoxelFilter
+from nimrud.utils.lazy import lazy_from
+
+# scipy is only needed for query sets off the grid
+cKDTree = lazy_from("scipy.spatial", "cKDTree")
+
+
+# ways of measuring the distance from a point to a voxel center
+MEASURES = ["cheby", "euclid"]
+
+# tolerance, in voxel edges, on voxel centers lying on a regular grid
+GRID_TOLERANCE = 1e-3
+
+#---------------------------------------------------------------------------------------------------
+
+def interpolate_to_voxels(voxels, points, features, edge, measure="cheby", weights=None,
+                          max_chunk=1000000):
+    """
+    mean of the features of the points strictly within edge of each voxel center, measured with
+    the chebyshev ("cheby") or euclidean ("euclid") distance. voxels must be centers of a regular
+    grid with that edge (as VoxelFilter.unique_voxels returns them), in any order. weights, one
+    per point, make it a weighted mean.
+
+    returns a (num voxels, num features) float64 array in the order of voxels. voxels with no
+    points in reach get zeros. points are processed max_chunk at a time.
+    """
+
+    if measure not in MEASURES:
+        raise ValueError("measure must be one of {}".format(MEASURES))
+    if edge <= 0:
+        raise ValueError("voxel edge must be positive")
+    voxels = np.asarray(voxels, dtype=np.float64).reshape(-1, 3)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    features = np.asarray(features, dtype=np.float64).reshape(points.shape[0], -1)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64).reshape(-1)
+        if weights.size != points.shape[0]:
+            raise ValueError("need one weight per point")
+
+    sums = np.zeros((voxels.shape[0], features.shape[1]))
+    totals = np.zeros(voxels.shape[0])
+    if voxels.shape[0] == 0 or points.shape[0] == 0:
+        return sums
+
+    # integer grid coordinates of the voxels, with a margin of a cell on every side
+    if not on_grid(voxels, edge):
+        raise ValueError("voxels must be centers of a grid with the given edge")
+    anchor = voxels[0]
+    cells = np.rint((voxels - anchor) / edge).astype(np.int64)
+    low = cells.min(0) - 1
+    shape = cells.max(0) - low + 2
+    if np.prod(shape.astype(np.float64)) >= 2 ** 63:
+        raise ValueError("edge is too small to address this grid")
+    addresses = np.ravel_multi_index((cells - low).T, shape)
+    voxel_order = np.argsort(addresses, kind="stable")
+    sorted_addresses = addresses[voxel_order]
+
+    for start in range(0, points.shape[0], max_chunk):
+        chunk = slice(start, start + max_chunk)
+        relative = (points[chunk] - anchor) / edge
+        nearest = np.rint(relative).astype(np.int64)
+        side = np.sign(relative - nearest).astype(np.int64)
+        chunk_features = features[chunk]
+        chunk_weights = np.ones(relative.shape[0]) if weights is None else weights[chunk]
+
+        for offset in product((0, 1), repeat=3):
+            offset = np.array(offset)
+            # a point on a center plane has no neighbor on its side along that axis
+            reach = ~np.any((side == 0) & (offset == 1), axis=1)
+            target = nearest + offset * side
+            gaps = np.abs(relative - target)
+            if measure == "cheby":
+                reach &= gaps.max(1) < 1
+            else:
+                reach &= np.einsum("ij,ij->i", gaps, gaps) < 1
+            target -= low
+            reach &= np.all((target >= 0) & (target < shape), axis=1)
+            if not reach.any():
+                continue
+
+            rows = np.flatnonzero(reach)
+            targets = np.ravel_multi_index(target[rows].T, shape)
+            found = np.minimum(np.searchsorted(sorted_addresses, targets), addresses.size - 1)
+            hit = sorted_addresses[found] == targets
+            rows, found = rows[hit], found[hit]
+            if rows.size == 0:
+                continue
+
+            # sum the contributions to each voxel over runs of equal addresses
+            order = np.argsort(found, kind="stable")
+            found, rows = found[order], rows[order]
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(found)) + 1))
+            voxel_rows = voxel_order[found[starts]]
+            row_weights = chunk_weights[rows]
+            sums[voxel_rows] += np.add.reduceat(
+                chunk_features[rows] * row_weights.reshape(-1, 1), starts, axis=0)
+            totals[voxel_rows] += np.add.reduceat(row_weights, starts)
+
+    occupied = totals > 0
+    sums[occupied] /= totals[occupied].reshape(-1, 1)
+    return sums
+
+#---------------------------------------------------------------------------------------------------
+
+def interpolate_to_points(query_set, points, features, radius, measure="cheby", weights=None,
+                          max_chunk=100000):
+    """
+    mean of the features of the points strictly within radius of each query point, like
+    interpolate_to_voxels, for query sets in no particular arrangement. the neighbors of
+    max_chunk query points at a time are found with a KD tree over the points and summed with
+    np.add.reduceat, so the cost follows the number of neighbors rather than query set x points.
+    """
+
+    if measure not in MEASURES:
+        raise ValueError("measure must be one of {}".format(MEASURES))
+    query_set = np.asarray(query_set, dtype=np.float64).reshape(-1, 3)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    features = np.asarray(features, dtype=np.float64).reshape(points.shape[0], -1)
+    if weights is None:
+        weights = np.ones(points.shape[0])
+    else:
+        weights = np.asarray(weights, dtype=np.float64).reshape(-1)
+        if weights.size != points.shape[0]:
+            raise ValueError("need one weight per point")
+
+    output = np.zeros((query_set.shape[0], features.shape[1]))
+    if query_set.shape[0] == 0 or points.shape[0] == 0:
+        return output
+    tree = cKDTree(points)
+    # the tree's balls are closed; the largest float below radius makes them open
+    reach = np.nextafter(radius, 0)
+    norm = np.inf if measure == "cheby" else 2
+
+    for start in range(0, query_set.shape[0], max_chunk):
+        neighbor_lists = tree.query_ball_point(query_set[start:start + max_chunk], reach, p=norm)
+        lengths = np.array([len(neighbors) for neighbors in neighbor_lists])
+        rows = np.flatnonzero(lengths) + start
+        if rows.size == 0:
+            continue
+        neighbors = np.concatenate([neighbors for neighbors in neighbor_lists if neighbors])
+        starts = np.concatenate(([0], np.cumsum(lengths[lengths > 0])[:-1]))
+        neighbor_weights = weights[neighbors]
+        totals = np.add.reduceat(neighbor_weights, starts)
+        output[rows] = np.add.reduceat(
+            features[neighbors] * neighbor_weights.reshape(-1, 1), starts, axis=0) /\
+            totals.reshape(-1, 1)
+
+    return output
+
+#---------------------------------------------------------------------------------------------------
+
+def on_grid(voxels, edge):
+    """
+    whether the voxel centers lie on one regular grid of the given edge, as
+    interpolate_to_voxels needs them to
+    """
+
+    voxels = np.asarray(voxels, dtype=np.float64).reshape(-1, 3)
+    if voxels.shape[0] == 0:
+        return True
+    grid = (voxels - voxels[0]) / edge
+    return bool(np.abs(grid - np.rint(grid)).max() <= GRID_TOLERANCE)
+
+#---------------------------------------------------------------------------------------------------
+
+def voxel_field(points, features, edge, measure="cheby", weights=None, max_chunk=1000000):
+    """
+    voxelize a point cloud at edge and interpolate its features to the voxel centers with
+    interpolate_to_voxels. returns (voxel centers in VoxelFilter.unique_voxels order, their
+    features).
+    """
+
+    points = np.asarray(points, dtype=np.float64)
+    voxels = VoxelFilter(points, edge).unique_voxels(points)
+    return voxels, interpolate_to_voxels(voxels, points, features, edge, measure, weights,
+                                         max_chunk)
@@ -0,0 +1,289 @@
+# pylint: disable=E0401, E1101
+
+"""
+implements PrefixMoments, running sums of the first and second moments of distance-sorted
+neighborhoods.
+
+because each neighborhood is sorted by distance, its sums of x and of x x^T at any radius are
+prefix sums over its row. accumulating them once per neighborhood makes the count, centroid and
+scatter matrix at every further scale cost a lookup per row, instead of another pass over the
+neighbors like RaggedNeighborhoods' reductions (and NBtensor's MP_displacement and MSPCA_cov).
+
+also implements VoxelMoments and VoxelPrefixMoments, which approximate large neighborhoods from
+the moments of the voxels whose centroids fall within them: the count, centroid and scatter of
+each voxel are computed once, and a neighborhood costs a pass over its voxels instead of its
+points. the approximation misplaces at most the points of voxels near the neighborhood boundary,
+which VoxelPrefixMoments.count_error reports as a bound on the error in the neighbor count.
+"""
+
+import numpy as np
+
+from nimrud.features.neighborhoods import Neighborhoods
+
+
+# row and column of each of the 6 distinct entries of a symmetric 3x3 matrix
+UPPER_TRIANGLE = (np.array([0, 0, 0, 1, 1, 2]), np.array([0, 1, 2, 1, 2, 2]))
+
+#---------------------------------------------------------------------------------------------------
+
+class PrefixMoments(object):
+    """
+    cumulative sums of the neighbor coordinates and their outer products over a
+    RaggedNeighborhoods, in its flat CSR order. it is used like RaggedNeighborhoods: drop to a
+    radius, then ask for the reductions of the active prefixes.
+    """
+
+    def __init__(self, neighborhoods):
+
+        self.neighborhoods = neighborhoods
+        self.num_rows = neighborhoods.num_rows
+        self.active_lengths = neighborhoods.row_lengths.copy()
+
+        coordinates = neighborhoods.coordinates.astype(np.float64)
+        num_neighbors = coordinates.shape[0]
+        # a leading row of zeros makes the sum over entries [start, stop) first[stop] - first[start]
+        self._first = np.zeros((num_neighbors + 1, 3))
+        np.cumsum(coordinates, axis=0, out=self._first[1:])
+        self._second = np.zeros((num_neighbors + 1, 6))
+        np.cumsum(coordinates[:, UPPER_TRIANGLE[0]] * coordinates[:, UPPER_TRIANGLE[1]],
+                  axis=0, out=self._second[1:])
+
+    #==================================
+
+    def drop(self, radius):
+        """
+        shrink the active neighborhoods to the neighbors strictly within radius, and return the
+        number of neighbors left in each row
+        """
+
+        self.active_lengths = self.neighborhoods.prefix_lengths(radius)
+        return self.active_lengths
+
+    #==================================
+
+    def keep_nearest(self, k):
+        """
+        shrink the active neighborhoods to their k nearest neighbors, and return the number of
+        neighbors left in each row
+        """
+
+        self.active_lengths = self.neighborhoods.nearest_lengths(k)
+        return self.active_lengths
+
+    #==================================
+
+    def sums(self):
+        """
+        (num_rows, 3) sums of the active coordinates and (num_rows, 6) sums of their products,
+        in UPPER_TRIANGLE order
+        """
+
+        starts = self.neighborhoods.row_offsets[:-1]
+        stops = starts + self.active_lengths
+        return (self._first.take(stops, axis=0) - self._first.take(starts, axis=0),
+                self._second.take(stops, axis=0) - self._second.take(starts, axis=0))
+
+    #==================================
+
+    def centroids(self):
+        """
+        centroid of each active neighborhood, relative to its query point. empty neighborhoods
+        get a centroid at the query point.
+        """
+
+        first, _ = self.sums()
+        return first / np.maximum(self.active_lengths, 1).reshape(-1, 1)
+
+    #==================================
+
+    def centroid_displacement(self):
+        """
+        distance from each query point to the centroid of its active neighborhood
+        """
+
+        centroids = self.centroids()
+        return np.sqrt(np.einsum("ij,ij->i", centroids, centroids))
+
+    #==================================
+
+    def scatter_matrices(self):
+        """
+        (num_rows, 3, 3) sums of the outer products of the active neighbors about their
+        centroid, from sum(x x^T) - sum(x) sum(x)^T / n
+        """
+
+        first, second = self.sums()
+        counts = np.maximum(self.active_lengths, 1)
+        upper = second - first[:, UPPER_TRIANGLE[0]] * first[:, UPPER_TRIANGLE[1]] /\
+            counts.reshape(-1, 1)
+        # with fewer than two neighbors the difference is pure round off, which normalizing the
+        # eigenvalues would blow up
+        upper[self.active_lengths < 2] = 0
+
+        scatter = np.zeros((self.num_rows, 3, 3))
+        scatter[:, UPPER_TRIANGLE[0], UPPER_TRIANGLE[1]] = upper
+        scatter[:, UPPER_TRIANGLE[1], UPPER_TRIANGLE[0]] = upper
+        return scatter
+
+#---------------------------------------------------------------------------------------------------
+
+class VoxelMoments(object):
+    """
+    the number of points in each occupied voxel of a point cloud, their centroid, and their
+    scatter matrix about that centroid (in UPPER_TRIANGLE order), on a grid of the given edge
+    length anchored at the cloud's minimum corner.
+    """
+
+    def __init__(self, points, edge):
+
+        points = np.asarray(points, dtype=np.float64)
+        if points.ndim != 2 or points.shape[1] != 3 or points.shape[0] == 0:
+            raise ValueError("need a nonempty nx3 point cloud")
+        if edge <= 0:
+            raise ValueError("voxel edge must be positive")
+
+        grid = np.floor((points - points.min(0)) / edge).astype(np.int64)
+        _, voxel_ids, counts = np.unique(grid, axis=0, return_inverse=True, return_counts=True)
+        voxel_ids = voxel_ids.ravel()
+        num_voxels = counts.size
+
+        self.edge = edge
+        # the farthest apart two points in a voxel can be, so the farthest a point can be from
+        # its voxel's centroid
+        self.spread = edge * np.sqrt(3)
+        self.counts = counts
+        self.centroids = np.column_stack([
+            np.bincount(voxel_ids, weights=points[:, dim], minlength=num_voxels)
+            for dim in range(3)]) / counts.reshape(-1, 1)
+        centered = points - self.centroids.take(voxel_ids, axis=0)
+        self.scatter = np.column_stack([
+            np.bincount(voxel_ids, weights=centered[:, first] * centered[:, second],
+                        minlength=num_voxels)
+            for first, second in zip(*UPPER_TRIANGLE)])
+
+    #==================================
+
+    def __len__(self):
+        return self.counts.size
+
+#---------------------------------------------------------------------------------------------------
+
+class VoxelPrefixMoments(object):
+    """
+    approximate neighborhood moments of a set of query points from VoxelMoments, used like
+    PrefixMoments: drop to a radius, then ask for the reductions. a neighborhood is taken to be
+    every voxel whose centroid is strictly within the radius.
+
+    the voxels are found once, out to radius plus the voxel spread, and sorted by distance, so
+    each smaller radius is a prefix again. the moments of the points in each prefix are
+    accumulated from the voxel moments relative to the query point (the parallel axis theorem),
+    which keeps them accurate far from the origin.
+    """
+
+    def __init__(self, voxels, query_set, radius, tree=None):
+
+        self.voxels = voxels
+        self.num_rows = query_set.shape[0]
+        # voxels past the radius can still hold points within it, and count toward the error
+        self.neighborhoods = Neighborhoods.radius_search(
+            voxels.centroids, query_set, radius + voxels.spread, tree)
+        self.active_lengths = self.neighborhoods.prefix_lengths(radius)
+
+        neighbor_ids = self.neighborhoods.neighbor_ids
+        offsets = voxels.centroids.take(neighbor_ids, axis=0) -\
+            query_set.take(self.neighborhoods.row_ids(), axis=0)
+        weights = voxels.counts.take(neighbor_ids).astype(np.float64)
+
+        # a leading row of zeros makes the sum over entries [start, stop) sum[stop] - sum[start]
+        num_neighbors = neighbor_ids.size
+        self._counts = np.zeros(num_neighbors + 1)
+        np.cumsum(weights, out=self._counts[1:])
+        self._first = np.zeros((num_neighbors + 1, 3))
+        np.cumsum(offsets * weights.reshape(-1, 1), axis=0, out=self._first[1:])
+        self._second = np.zeros((num_neighbors + 1, 6))
+        np.cumsum(offsets[:, UPPER_TRIANGLE[0]] * offsets[:, UPPER_TRIANGLE[1]] *
+                  weights.reshape(-1, 1) + voxels.scatter.take(neighbor_ids, axis=0),
+                  axis=0, out=self._second[1:])
+
+    #==================================
+
+    def drop(self, radius):
+        """
+        shrink the active neighborhoods to the voxels strictly within radius, and return the
+        (approximate) number of points left in each
+        """
+
+        self.active_lengths = self.neighborhoods.prefix_lengths(radius)
+        return self.counts()
+
+    #==================================
+
+    def counts(self):
+        """
+        number of points in the active voxels of each neighborhood
+        """
+        return self._prefix_sum(self._counts, self.active_lengths)
+
+    #==================================
+
+    def count_error(self, radius):
+        """
+        bound on the difference between the approximate and exact number of points within radius
+        of each query point: the points of every voxel whose centroid is within the voxel spread
+        of the radius. points in other voxels are on the same side of it as their centroid.
+        """
+
+        inner = self.neighborhoods.prefix_lengths(max(radius - self.voxels.spread, 0))
+        outer = self.neighborhoods.prefix_lengths(radius + self.voxels.spread)
+        return self._prefix_sum(self._counts, outer) - self._prefix_sum(self._counts, inner)
+
+    #==================================
+
+    def centroids(self):
+        """
+        centroid of the points in each active neighborhood, relative to its query point. empty
+        neighborhoods get a centroid at the query point.
+        """
+
+        first = self._prefix_sum(self._first, self.active_lengths)
+        return first / np.maximum(self.counts(), 1).reshape(-1, 1)
+
+    #==================================
+
+    def centroid_displacement(self):
+        """
+        distance from each query point to the centroid of the points in its active neighborhood
+        """
+
+        centroids = self.centroids()
+        return np.sqrt(np.einsum("ij,ij->i", centroids, centroids))
+
+    #==================================
+
+    def scatter_matrices(self):
+        """
+        (num_rows, 3, 3) scatter matrices of the points in the active neighborhoods about their
+        centroids
+        """
+
+        counts = self.counts()
+        first = self._prefix_sum(self._first, self.active_lengths)
+        second = self._prefix_sum(self._second, self.active_lengths)
+        upper = second - first[:, UPPER_TRIANGLE[0]] * first[:, UPPER_TRIANGLE[1]] /\
+            np.maximum(counts, 1).reshape(-1, 1)
+        upper[counts < 2] = 0
+
+        scatter = np.zeros((self.num_rows, 3, 3))
+        scatter[:, UPPER_TRIANGLE[0], UPPER_TRIANGLE[1]] = upper
+        scatter[:, UPPER_TRIANGLE[1], UPPER_TRIANGLE[0]] = upper
+        return scatter
+
+    #==================================
+
+    def _prefix_sum(self, cumulative, lengths):
+        """
+        sum of the first lengths[r] entries of each row r, from cumulative sums
+        """
+
+        starts = self.neighborhoods.row_offsets[:-1]
+        return cumulative.take(starts + lengths, axis=0) - cumulative.take(starts, axis=0)
@@ -0,0 +1,456 @@
+# pylint: disable=E0401, E1101
+
+"""
+multiscale operators (MSOs) computed on the CPU with numpy.
+
+these reproduce the feature layouts of the pycuda prototypes in nimrud.prototypes.mso, so that
+code consuming their output can switch over without changes.
+
+every operator takes its scales in one of two modes:
+    "radius": scales are spherical neighborhood radii, as in the prototypes.
+    "knn": scales are numbers of nearest neighbors. the cost per point no longer depends on the
+        point density, and sparse areas don't get empty neighborhoods. densities are taken over
+        the ball reaching the farthest of the k neighbors.
+either way the neighbors are found once, at the largest scale, and sorted by distance, so every
+smaller scale is a prefix of each neighborhood.
+
+in radius mode, the operators can also approximate their neighborhoods from voxel moments: with a
+moment_edge, the search space's points are binned into voxels of that edge, and each neighborhood
+is made of the voxels whose centroids are within it, aggregated from their count, centroid and
+scatter (see nimrud.features.moments.VoxelMoments). the cost per point then depends on the number
+of voxels in the largest ball rather than the number of points, which is what makes scales of
+several meters affordable. moment_count_error bounds the error this makes in the neighbor counts.
+
+query points are processed in partitions of max_chunk points. with workers greater than 1, the
+partitions are spread over that many processes, which share the point clouds and the output
+through shared memory (see nimrud.utils.shared). the search tree (or the voxel moments) is built
+once, before the workers start, so adding workers only splits the searches between them.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from nimrud.features.eigen import EIGEN_FEATURES, eigen_features, normalized_eigenvalues
+from nimrud.features.moments import (PrefixMoments, UPPER_TRIANGLE, VoxelMoments,
+                                     VoxelPrefixMoments)
+from nimrud.features.neighborhoods import Neighborhoods, RaggedNeighborhoods
+from nimrud.features.vertical import VERTICAL_FEATURES, VerticalProfile
+from nimrud.utils.geometry import VoxelFilter, local_frame
+from nimrud.utils.shared import run_partitioned
+
+
+# cubic centimeters in a cubic meter. densities are reported in points per cubic centimeter.
+DENSITY_CONVERSION = 100 * 100 * 100
+
+# ways of specifying the scales of a neighborhood
+SCALE_MODES = ["radius", "knn"]
+
+#---------------------------------------------------------------------------------------------------
+
+def geometric_mso(query_set, search_space, voxel_edge, scales, max_chunk=20000,
+                  scale_mode="radius", extended=False, vertical=False, workers=1,
+                  moment_edge=0):
+    """
+    first order (pure geometry) multiscale operator: the CPU counterpart of
+    nimrud.prototypes.mso.G_MSO.
+
+    for each query set point, find its neighbors in the search space (voxelized at voxel_edge,
+    unless that is 0) at the largest scale, sorted by distance. then for every scale take the
+    prefix of each neighborhood within that scale and compute the neighborhood density, the
+    distance from the query point to the neighborhood centroid and the two largest normalized
+    eigenvalues of the neighborhood covariance.
+
+    returns a float32 array laid out like G_MSO's output, with one row per query set point in
+    query set order:
+        [index, (density, centroid, eigval x2) x num scales]
+    where index is the row of the query set and scales are in descending order. query points
+    are processed max_chunk at a time to bound memory use, in workers processes.
+
+    if extended, each scale's block is followed by the eigen_features of the neighborhood
+    (nimrud.features.eigen.EIGEN_FEATURES), from the same eigendecomposition:
+        [index, (density, centroid, eigval x2, eigen features x9) x num scales]
+
+    if vertical, each scale's block (extended or not) is followed by the vertical features of the
+    neighborhood (nimrud.features.vertical.VERTICAL_FEATURES), from the same search:
+        [index, (density, centroid, eigval x2, vertical features x6) x num scales]
+
+    with a moment_edge, neighborhoods are approximated from voxel moments at that edge (see the
+    module docstring). the vertical features need the points themselves, so they can't be
+    approximated this way.
+    """
+
+    if vertical and moment_edge:
+        raise ValueError("vertical features can't be computed from voxel moments")
+    query_set, search_space, scales = _prepare_inputs(
+        query_set, search_space, voxel_edge, scales, scale_mode, moment_edge)
+    eigen_width = len(EIGEN_FEATURES) if extended else 0
+    width = 4 + eigen_width + (len(VERTICAL_FEATURES) if vertical else 0)
+    output = _indexed_output(query_set.shape[0], scales.size * width)
+    run_partitioned(_geometric_rows, (query_set, search_space), (output,), query_set.shape[0],
+                    max_chunk, workers, (scales, scale_mode, moment_edge, extended, vertical),
+                    _search_cache(search_space, moment_edge))
+    return output
+
+#---------------------------------------------------------------------------------------------------
+
+def oriented_mso(query_set, search_space, voxel_edge, scales, max_chunk=20000,
+                 scale_mode="radius", workers=1, moment_edge=0):
+    """
+    geometric multiscale operator with neighborhood orientation: the CPU counterpart of
+    nimrud.prototypes.mso.OG_MSO. see geometric_mso for the arguments.
+
+    returns a float32 array laid out like OG_MSO's output:
+        [index, (density, centroid, eigval x2, vec x4) x num scales]
+    where, as OGNB_process orders them, the eigenvalues are the two smallest normalized
+    eigenvalues in ascending order and the vector entries are the x and y components of their
+    unit eigenvectors (the neighborhood normal first).
+    """
+
+    query_set, search_space, scales = _prepare_inputs(
+        query_set, search_space, voxel_edge, scales, scale_mode, moment_edge)
+    output = _indexed_output(query_set.shape[0], scales.size * 8)
+    run_partitioned(_oriented_rows, (query_set, search_space), (output,), query_set.shape[0],
+                    max_chunk, workers, (scales, scale_mode, moment_edge),
+                    _search_cache(search_space, moment_edge))
+    return output
+
+#---------------------------------------------------------------------------------------------------
+
+def covariance_mso(query_set, search_space, voxel_edge, scales, max_chunk=20000,
+                   scale_mode="radius", workers=1, moment_edge=0):
+    """
+    covariance multiscale operator: the CPU counterpart of nimrud.prototypes.mso.C_MSO. see
+    geometric_mso for the arguments.
+
+    returns a float32 array laid out as C_MSO documents its output:
+        [index, (density, centroid, cov x6) x num scales]
+    where cov is the upper triangle (xx, xy, xz, yy, yz, zz) of the neighborhood scatter matrix
+    about its centroid, as computed by NBtensor.MSPCA_cov.
+    """
+
+    query_set, search_space, scales = _prepare_inputs(
+        query_set, search_space, voxel_edge, scales, scale_mode, moment_edge)
+    output = _indexed_output(query_set.shape[0], scales.size * 8)
+    run_partitioned(_covariance_rows, (query_set, search_space), (output,), query_set.shape[0],
+                    max_chunk, workers, (scales, scale_mode, moment_edge),
+                    _search_cache(search_space, moment_edge))
+    return output
+
+#---------------------------------------------------------------------------------------------------
+
+def moment_count_error(query_set, search_space, voxel_edge, scales, moment_edge, max_chunk=20000):
+    """
+    error bound for the voxel moment approximation: for each query set point and scale (in
+    descending order), a bound on the difference between the approximate and exact number of
+    search space points in the neighborhood, relative to the approximate number (or absolute, if
+    that is 0). returns a (num query points, num scales) array.
+
+    the densities reported by the operators are off by the same fraction. a bound well below 1
+    means the neighborhood is mostly made of voxels entirely inside it, so its centroid and
+    covariance are close to exact as well.
+    """
+
+    query_set, search_space, scales = _prepare_inputs(
+        query_set, search_space, voxel_edge, scales, "radius", moment_edge)
+    voxels = VoxelMoments(search_space, moment_edge)
+    tree = cKDTree(voxels.centroids)
+    errors = np.zeros((query_set.shape[0], scales.size))
+
+    for start in range(0, query_set.shape[0], max_chunk):
+        rows = slice(start, start + max_chunk)
+        moments = VoxelPrefixMoments(voxels, query_set[rows], scales[0], tree)
+        for scale_num, scale in enumerate(scales):
+            counts = moments.drop(scale)
+            errors[rows, scale_num] = moments.count_error(scale) / np.maximum(counts, 1)
+
+    return errors
+
+#---------------------------------------------------------------------------------------------------
+
+def vector_mso(query_set, search_space, features, scales, max_chunk=20000, scale_mode="radius",
+               workers=1):
+    """
+    vector multiscale operator: the CPU counterpart of nimrud.prototypes.mso.V_MSO, without the
+    search space voxelization. features holds a row vector for each search space point.
+
+    returns a float32 array laid out like V_MSO's output, with one row per query set point in
+    query set order:
+        [index, mean (num features x num scales)]
+    where scales are in descending order. see vector_statistics for more than the means.
+    """
+
+    _, _, means, _ = vector_statistics(
+        query_set, search_space, features, scales, max_chunk, scale_mode, workers)
+    output = _indexed_output(means.shape[0], means.shape[1] * means.shape[2])
+    output[:, 1:] = means.reshape(means.shape[0], -1)
+    return output
+
+#---------------------------------------------------------------------------------------------------
+
+def vector_statistics(query_set, search_space, features, scales, max_chunk=20000,
+                      scale_mode="radius", workers=1):
+    """
+    count, sum, mean and (population) variance of the search space features within each scale
+    of each query set point, with scales in descending order. returns (num query points,
+    num scales) counts, and (num query points, num scales, num features) sums, means and
+    variances. empty neighborhoods get means and variances of 0.
+
+    instead of V_MSO's dense query set x search space distance matrices, the neighbors are found
+    once at the largest scale and each scale is a sparse adjacency matrix built from the prefixes
+    of the rows, so the work is proportional to the number of neighbors.
+    """
+
+    features = np.asarray(features, dtype=np.float64)
+    features = features.reshape(features.shape[0], -1)
+    if features.shape[0] != search_space.shape[0]:
+        raise ValueError("need one feature vector per search space point")
+    query_set, search_space, scales = _prepare_inputs(
+        query_set, search_space, 0, scales, scale_mode)
+
+    num_points = query_set.shape[0]
+    shape = (num_points, scales.size, features.shape[1])
+    counts = np.zeros(shape[:2], dtype=np.int64)
+    sums, means, variances = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    run_partitioned(_vector_rows, (query_set, search_space, features),
+                    (counts, sums, means, variances), num_points, max_chunk, workers,
+                    (scales, scale_mode), _search_cache(search_space))
+
+    return counts, sums, means, variances
+
+#---------------------------------------------------------------------------------------------------
+
+def _geometric_rows(inputs, outputs, start, stop, cache, scales, scale_mode, moment_edge,
+                    extended, vertical, neighborhoods=None):
+    """
+    fill rows start:stop of geometric_mso's output. neighborhoods are the rows' neighborhoods at
+    the largest scale, if they were found already (see _scale_moments).
+    """
+
+    output, = outputs
+    rows = slice(start, stop)
+    eigen_width = len(EIGEN_FEATURES) if extended else 0
+    width = (output.shape[1] - 1) // scales.size
+
+    for scale_num, densities, moments in _scale_moments(
+            inputs, start, stop, cache, scales, scale_mode, moment_edge, neighborhoods):
+        column = 1 + scale_num * width
+        output[rows, column] = densities
+        output[rows, column + 1] = moments.centroid_displacement()
+        if extended:
+            values, vectors = normalized_eigenvalues(moments.scatter_matrices(), vectors=True)
+            output[rows, column + 4:column + 4 + eigen_width] = eigen_features(values, vectors)
+        else:
+            values = normalized_eigenvalues(moments.scatter_matrices())
+        output[rows, column + 2:column + 4] = values[:, :2]
+        if vertical:
+            # the profile follows the moments' prefixes
+            if scale_num == 0:
+                profile = VerticalProfile(moments.neighborhoods)
+            profile.active_lengths = moments.active_lengths
+            output[rows, column + 4 + eigen_width:column + width] = profile.vertical_features()
+
+#---------------------------------------------------------------------------------------------------
+
+def _oriented_rows(inputs, outputs, start, stop, cache, scales, scale_mode, moment_edge,
+                   neighborhoods=None):
+    """
+    fill rows start:stop of oriented_mso's output, as _geometric_rows does
+    """
+
+    output, = outputs
+    rows = slice(start, stop)
+    for scale_num, densities, moments in _scale_moments(
+            inputs, start, stop, cache, scales, scale_mode, moment_edge, neighborhoods):
+        column = 1 + scale_num * 8
+        values, vectors = normalized_eigenvalues(moments.scatter_matrices(), vectors=True)
+        output[rows, column] = densities
+        output[rows, column + 1] = moments.centroid_displacement()
+        output[rows, column + 2:column + 4] = values[:, [2, 1]]
+        # vectors are columns: take the x and y rows of the smallest two, one vector at a time
+        output[rows, column + 4:column + 8] =\
+            vectors[:, :2, [2, 1]].transpose(0, 2, 1).reshape(-1, 4)
+
+#---------------------------------------------------------------------------------------------------
+
+def _covariance_rows(inputs, outputs, start, stop, cache, scales, scale_mode, moment_edge,
+                     neighborhoods=None):
+    """
+    fill rows start:stop of covariance_mso's output, as _geometric_rows does
+    """
+
+    output, = outputs
+    rows = slice(start, stop)
+    for scale_num, densities, moments in _scale_moments(
+            inputs, start, stop, cache, scales, scale_mode, moment_edge, neighborhoods):
+        column = 1 + scale_num * 8
+        output[rows, column] = densities
+        output[rows, column + 1] = moments.centroid_displacement()
+        output[rows, column + 2:column + 8] =\
+            moments.scatter_matrices()[:, UPPER_TRIANGLE[0], UPPER_TRIANGLE[1]]
+
+#---------------------------------------------------------------------------------------------------
+
+def _vector_rows(inputs, outputs, start, stop, cache, scales, scale_mode):
+    """
+    fill rows start:stop of vector_statistics' counts, sums, means and variances
+    """
+
+    query_set, search_space, features = inputs
+    counts, sums, means, variances = outputs
+    if "squares" not in cache:
+        cache["squares"] = features * features
+    neighborhoods = _search(
+        search_space, query_set[start:stop], scales[0], scale_mode, _tree(cache, search_space))
+
+    for scale_num, scale in enumerate(scales):
+        if scale_mode == "radius":
+            lengths = neighborhoods.prefix_lengths(scale)
+        else:
+            lengths = neighborhoods.nearest_lengths(scale)
+        adjacency = neighborhoods.prefix_adjacency(lengths, search_space.shape[0])
+        divisor = np.maximum(lengths, 1).reshape(-1, 1)
+        counts[start:stop, scale_num] = lengths
+        sums[start:stop, scale_num] = adjacency.dot(features)
+        means[start:stop, scale_num] = sums[start:stop, scale_num] / divisor
+        variances[start:stop, scale_num] = np.maximum(
+            adjacency.dot(cache["squares"]) / divisor - means[start:stop, scale_num] ** 2, 0)
+
+#---------------------------------------------------------------------------------------------------
+
+def _scale_moments(inputs, start, stop, cache, scales, scale_mode, moment_edge=0,
+                   neighborhoods=None):
+    """
+    search once at the largest scale for query set points start:stop and accumulate the moments
+    of every prefix of the neighborhoods. then for each scale, yield the scale number, the
+    neighborhood densities and the PrefixMoments (or, with a moment_edge, VoxelPrefixMoments)
+    dropped to that scale. distance sorted neighborhoods at the largest scale that were already
+    found (by scaleset_mso, say) replace the search.
+    """
+
+    query_set, search_space = inputs
+    query_chunk = query_set[start:stop]
+    if moment_edge:
+        voxels, voxel_tree = _voxel_moments(cache, search_space, moment_edge)
+        moments = VoxelPrefixMoments(voxels, query_chunk, scales[0], voxel_tree)
+        for scale_num, scale in enumerate(scales):
+            yield scale_num, moments.drop(scale) / _ball_volume(scale), moments
+        return
+
+    if neighborhoods is None:
+        neighborhoods = _search(
+            search_space, query_chunk, scales[0], scale_mode, _tree(cache, search_space))
+    neighborhoods = RaggedNeighborhoods.from_neighborhoods(neighborhoods, search_space, query_chunk)
+    moments = PrefixMoments(neighborhoods)
+
+    for scale_num, scale in enumerate(scales):
+        if scale_mode == "radius":
+            densities = moments.drop(scale) / _ball_volume(scale)
+        else:
+            counts = moments.keep_nearest(scale)
+            volumes = _ball_volume(neighborhoods.prefix_radii(counts))
+            densities = counts / np.where(volumes > 0, volumes, np.inf)
+        yield scale_num, densities, moments
+
+#---------------------------------------------------------------------------------------------------
+
+def _tree(cache, search_space):
+    """
+    the search space's cKDTree, from cache or built once per process and kept there
+    """
+
+    if "tree" not in cache:
+        cache["tree"] = cKDTree(search_space)
+    return cache["tree"]
+
+#---------------------------------------------------------------------------------------------------
+
+def _search_cache(search_space, moment_edge=0):
+    """
+    a partition cache with the search structures every partition needs already built: the voxel
+    moments and their tree with a moment_edge, or the search space's tree
+    """
+
+    cache = {}
+    if moment_edge:
+        _voxel_moments(cache, search_space, moment_edge)
+    else:
+        _tree(cache, search_space)
+    return cache
+
+#---------------------------------------------------------------------------------------------------
+
+def _voxel_moments(cache, search_space, moment_edge):
+    """
+    the search space's VoxelMoments at moment_edge and a cKDTree of their centroids, from cache
+    or built once per process and kept there
+    """
+
+    if "voxels" not in cache:
+        cache["voxels"] = VoxelMoments(search_space, moment_edge)
+        cache["voxel tree"] = cKDTree(cache["voxels"].centroids)
+    return cache["voxels"], cache["voxel tree"]
+
+#---------------------------------------------------------------------------------------------------
+
+def _search(search_space, query_set, scale, scale_mode, tree):
+    """
+    distance sorted neighborhoods at the given (largest) scale
+    """
+
+    if scale_mode == "radius":
+        return Neighborhoods.radius_search(search_space, query_set, scale, tree)
+    return Neighborhoods.knn_search(search_space, query_set, scale, tree)
+
+#---------------------------------------------------------------------------------------------------
+
+def _prepare_inputs(query_set, search_space, voxel_edge, scales, scale_mode="radius",
+                    moment_edge=0):
+    """
+    validate the point clouds and scales, voxelize the search space if requested, and put the
+    scales in descending order.
+    """
+
+    for points in [query_set, search_space]:
+        if points.ndim != 2 or points.shape[1] != 3:
+            raise ValueError("query set and search space must be nx3 point clouds")
+    if scale_mode not in SCALE_MODES:
+        raise ValueError("scale mode must be one of {}".format(SCALE_MODES))
+    if moment_edge and scale_mode != "radius":
+        raise ValueError("voxel moments only approximate radius neighborhoods")
+    if moment_edge < 0:
+        raise ValueError("moment edge can't be negative")
+
+    scales = np.sort(np.atleast_1d(np.asarray(scales, dtype=np.float64)))[::-1]
+    if scales.size == 0 or scales[-1] <= 0:
+        raise ValueError("need at least one positive scale")
+    if scale_mode == "knn":
+        if np.any(scales != np.round(scales)):
+            raise ValueError("knn scales must be whole numbers of neighbors")
+        scales = scales.astype(np.int64)
+
+    # every feature depends only on offsets between points, which round off less near the origin
+    _, (query_set, search_space) = local_frame(query_set, search_space, dtype=np.float64)
+    if voxel_edge:
+        search_space = VoxelFilter(search_space, voxel_edge).unique_voxels(search_space)
+
+    return query_set, search_space, scales
+
+#---------------------------------------------------------------------------------------------------
+
+def _indexed_output(num_points, width):
+    """
+    float32 output array for num_points query set points and width features, with the query set
+    index in the first column
+    """
+
+    output = np.zeros((num_points, 1 + width), dtype=np.float32)
+    output[:, 0] = np.arange(num_points)
+    return output
+
+#---------------------------------------------------------------------------------------------------
+
+def _ball_volume(radius):
+    """
+    volume of a ball of the given radius in meters, in cubic centimeters
+    """
+    return DENSITY_CONVERSION * (4 / 3) * np.pi * radius ** 3
@@ -0,0 +1,332 @@
+# pylint: disable=E0401, E1101
+
+"""
+implements Neighborhoods, a compressed sparse row (CSR) store of search space neighbors for a set
+of query points, sorted by distance within each row.
+
+because each row is sorted by distance, the neighborhood of a query point at any radius smaller
+than the one searched is a prefix of its row. multiscale operators search once at their largest
+scale and get every smaller scale by finding prefix lengths, instead of searching or compacting
+the neighborhoods again for each scale (as PTshrink does in the prototypes).
+"""
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+
+
+class Neighborhoods(object):
+    """
+    neighbors of num_rows query points, stored as three arrays:
+        row_offsets: num_rows + 1 offsets. row r holds entries row_offsets[r]:row_offsets[r+1].
+        neighbor_ids: index of each neighbor in the search space.
+        distances: distance of each neighbor from its query point, ascending within each row.
+    """
+
+    def __init__(self, row_offsets, neighbor_ids, distances):
+
+        if row_offsets.ndim != 1 or row_offsets.size < 1 or row_offsets[0] != 0:
+            raise ValueError("row offsets must be a 1D array starting at 0")
+        if np.any(np.diff(row_offsets) < 0):
+            raise ValueError("row offsets must be nondecreasing")
+        if neighbor_ids.size != row_offsets[-1] or distances.size != row_offsets[-1]:
+            raise ValueError("row offsets do not match the number of neighbors")
+
+        self.row_offsets = row_offsets.astype(np.int64)
+        self.neighbor_ids = neighbor_ids
+        self.distances = distances
+        self.num_rows = row_offsets.size - 1
+        self.row_lengths = np.diff(self.row_offsets)
+        # the row number plus the distance scaled into [0, 1) sorts the whole store in one
+        # increasing sequence, so one searchsorted call finds a prefix length for every row
+        self._distance_scale = distances.max() * 2 + 1 if distances.size else 1.0
+        self._sort_keys = self.row_ids() + distances / self._distance_scale
+
+    #==================================
+
+    @classmethod
+    def radius_search(cls, search_space, query_set, radius, tree=None):
+        """
+        find every search space point strictly within radius of each query point. a cKDTree
+        built on the search space may be passed in to avoid rebuilding it.
+        """
+
+        if tree is None:
+            tree = cKDTree(search_space)
+        neighbor_lists = tree.query_ball_point(query_set, radius)
+        row_lengths = np.fromiter((len(neighbors) for neighbors in neighbor_lists),
+                                  dtype=np.int64, count=len(neighbor_lists))
+        row_ids = np.repeat(np.arange(query_set.shape[0]), row_lengths)
+        if row_ids.size:
+            neighbor_ids = np.concatenate([np.asarray(neighbors, dtype=np.int64)
+                                           for neighbors in neighbor_lists])
+        else:
+            neighbor_ids = np.zeros(0, dtype=np.int64)
+        offsets = search_space.take(neighbor_ids, axis=0) - query_set.take(row_ids, axis=0)
+        distances = np.sqrt(np.einsum("ij,ij->i", offsets, offsets))
+
+        # query_ball_point includes points at exactly the radius; the prototypes don't
+        keep = distances < radius
+        return cls.from_unsorted(
+            row_ids.compress(keep),
+            neighbor_ids.compress(keep),
+            distances.compress(keep),
+            query_set.shape[0])
+
+    #==================================
+
+    @classmethod
+    def knn_search(cls, search_space, query_set, k, tree=None):
+        """
+        find the k nearest search space points to each query point (all of them, if the search
+        space has fewer than k points). a cKDTree built on the search space may be passed in.
+        """
+
+        if tree is None:
+            tree = cKDTree(search_space)
+        num_rows = query_set.shape[0]
+        k = min(int(k), search_space.shape[0])
+        if k == 0:
+            return cls(np.zeros(num_rows + 1, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                       np.zeros(0))
+
+        # cKDTree returns each row sorted by distance already
+        distances, neighbor_ids = tree.query(query_set, k)
+        return cls(
+            np.arange(num_rows + 1, dtype=np.int64) * k,
+            neighbor_ids.reshape(-1).astype(np.int64),
+            distances.reshape(-1))
+
+    #==================================
+
+    @classmethod
+    def from_unsorted(cls, row_ids, neighbor_ids, distances, num_rows):
+        """
+        build from (row, neighbor, distance) triples in any order
+        """
+
+        # one argsort of the row number plus the distance scaled into [0, 1) (like the prefix
+        # search keys) is far cheaper than a lexsort. the keys round off the distances a little,
+        # so fall back on the lexsort in the rare case that put two neighbors of a row out of order.
+        distance_scale = distances.max() * 2 + 1 if distances.size else 1.0
+        order = np.argsort(row_ids + distances / distance_scale)
+        sorted_rows = row_ids.take(order)
+        sorted_distances = distances.take(order)
+        if np.any((sorted_distances[1:] < sorted_distances[:-1]) &
+                  (sorted_rows[1:] == sorted_rows[:-1])):
+            order = np.lexsort((distances, row_ids))
+        row_offsets = np.zeros(num_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row_ids, minlength=num_rows), out=row_offsets[1:])
+        return cls(row_offsets, neighbor_ids.take(order), distances.take(order))
+
+    #==================================
+
+    def row_ids(self):
+        """
+        the query row of every stored neighbor
+        """
+        return np.repeat(np.arange(self.num_rows), self.row_lengths)
+
+    #==================================
+
+    def prefix_lengths(self, radius):
+        """
+        number of neighbors strictly within radius in each row. costs one binary search per row,
+        independent of the number of neighbors stored.
+        """
+
+        if self.distances.size == 0:
+            return np.zeros(self.num_rows, dtype=np.int64)
+        row_starts = self.row_offsets[:-1]
+        row_stops = self.row_offsets[1:]
+        targets = np.arange(self.num_rows) + radius / self._distance_scale
+        stops = np.searchsorted(self._sort_keys, targets, side="left")
+        stops = stops.clip(row_starts, row_stops)
+
+        # the keys round off the distances a little, so nudge any stop that landed on the wrong
+        # side of a neighbor sitting right at the radius
+        while True:
+            back = (stops > row_starts) & (self.distances.take(stops - 1, mode="clip") >= radius)
+            ahead = (stops < row_stops) & (self.distances.take(stops, mode="clip") < radius)
+            if not (back.any() or ahead.any()):
+                break
+            stops = stops - back + ahead
+
+        return stops - row_starts
+
+    #==================================
+
+    def nearest_lengths(self, k):
+        """
+        number of neighbors among the k nearest in each row: k, or the whole row if it is shorter
+        """
+        return np.minimum(self.row_lengths, k)
+
+    #==================================
+
+    def prefix_radii(self, lengths):
+        """
+        distance to the farthest of the first lengths[r] neighbors of each row r, or 0 for an
+        empty prefix
+        """
+
+        lengths = np.asarray(lengths, dtype=np.int64)
+        last = self.distances.take(self.row_offsets[:-1] + lengths - 1, mode="clip")
+        return np.where(lengths > 0, last, 0)
+
+    #==================================
+
+    def prefix_index(self, lengths):
+        """
+        positions in the flat neighbor arrays of the first lengths[r] neighbors of each row r,
+        in row order. the cost is proportional to the number of positions returned.
+        """
+
+        lengths = np.asarray(lengths, dtype=np.int64)
+        prefix_offsets = np.zeros(lengths.size + 1, dtype=np.int64)
+        np.cumsum(lengths, out=prefix_offsets[1:])
+        # each position is its row's start plus its rank within the prefix
+        shifts = np.repeat(self.row_offsets[:-1] - prefix_offsets[:-1], lengths)
+        return np.arange(prefix_offsets[-1]) + shifts
+
+    #==================================
+
+    def prefix_adjacency(self, lengths, num_columns):
+        """
+        sparse (num_rows, num_columns) matrix with a 1 linking each row to each of its first
+        lengths[r] neighbors, where num_columns is the size of the search space. multiplying it
+        by a matrix of search space features sums the features over each neighborhood.
+        """
+
+        positions = self.prefix_index(lengths)
+        row_offsets = np.zeros(self.num_rows + 1, dtype=np.int64)
+        np.cumsum(lengths, out=row_offsets[1:])
+        return csr_matrix(
+            (np.ones(positions.size), self.neighbor_ids.take(positions), row_offsets),
+            shape=(self.num_rows, num_columns))
+
+#---------------------------------------------------------------------------------------------------
+
+class RaggedNeighborhoods(Neighborhoods):
+    """
+    Neighborhoods which also carry the coordinates of every neighbor relative to its query point,
+    flat in the same CSR order. this is the CPU counterpart of the padded neighborhood tensors
+    built by NB_build in the prototypes: it holds only the real neighbors, so its size doesn't
+    depend on the largest neighborhood.
+
+    like NBtensor, it is used by dropping the neighborhoods to a radius and then reducing the
+    active part of each row. dropping only changes the active prefix lengths; nothing is moved.
+    """
+
+    def __init__(self, row_offsets, neighbor_ids, distances, coordinates):
+
+        super(RaggedNeighborhoods, self).__init__(row_offsets, neighbor_ids, distances)
+        if coordinates.shape != (neighbor_ids.size, 3):
+            raise ValueError("need one 3D coordinate per neighbor")
+        self.coordinates = coordinates
+        self.active_lengths = self.row_lengths.copy()
+
+    #==================================
+
+    @classmethod
+    def from_neighborhoods(cls, neighborhoods, search_space, query_set, dtype=np.float32):
+        """
+        look up the coordinates of the neighbors in a Neighborhoods, relative to their query
+        points, and store them at the given precision.
+        """
+
+        coordinates = search_space.take(neighborhoods.neighbor_ids, axis=0) -\
+            query_set.take(neighborhoods.row_ids(), axis=0)
+        return cls(
+            neighborhoods.row_offsets,
+            neighborhoods.neighbor_ids,
+            neighborhoods.distances,
+            coordinates.astype(dtype))
+
+    #==================================
+
+    def drop(self, radius):
+        """
+        shrink the active neighborhoods to the neighbors strictly within radius, and return the
+        number of neighbors left in each row. radius may be larger than the last one dropped to.
+        """
+
+        self.active_lengths = self.prefix_lengths(radius)
+        return self.active_lengths
+
+    #==================================
+
+    def keep_nearest(self, k):
+        """
+        shrink the active neighborhoods to their k nearest neighbors, and return the number of
+        neighbors left in each row
+        """
+
+        self.active_lengths = self.nearest_lengths(k)
+        return self.active_lengths
+
+    #==================================
+
+    def active(self):
+        """
+        return the row of every active neighbor and its coordinates, in float64
+        """
+
+        row_ids = np.repeat(np.arange(self.num_rows), self.active_lengths)
+        coordinates = self.coordinates.take(self.prefix_index(self.active_lengths), axis=0)
+        return row_ids, coordinates.astype(np.float64)
+
+    #==================================
+
+    def centroids(self):
+        """
+        centroid of each active neighborhood, relative to its query point. empty neighborhoods
+        get a centroid at the query point.
+        """
+
+        row_ids, coordinates = self.active()
+        return self._centroids(row_ids, coordinates)
+
+    #==================================
+
+    def centroid_displacement(self):
+        """
+        distance from each query point to the centroid of its active neighborhood, as returned
+        by NBtensor.MP_displacement
+        """
+
+        centroids = self.centroids()
+        return np.sqrt(np.einsum("ij,ij->i", centroids, centroids))
+
+    #==================================
+
+    def scatter_matrices(self):
+        """
+        (num_rows, 3, 3) sums of the outer products of the active neighbors about their
+        centroid. this is the unnormalized covariance computed by NBtensor.MSPCA_cov.
+        """
+
+        row_ids, coordinates = self.active()
+        centered = coordinates - self._centroids(row_ids, coordinates).take(row_ids, axis=0)
+        scatter = np.zeros((self.num_rows, 3, 3))
+        for first in range(3):
+            for second in range(first, 3):
+                scatter[:, first, second] = np.bincount(
+                    row_ids,
+                    weights=centered[:, first] * centered[:, second],
+                    minlength=self.num_rows)
+                scatter[:, second, first] = scatter[:, first, second]
+
+        return scatter
+
+    #==================================
+
+    def _centroids(self, row_ids, coordinates):
+        """
+        per row means of active coordinates which have already been gathered
+        """
+
+        sums = np.column_stack([
+            np.bincount(row_ids, weights=coordinates[:, dim], minlength=self.num_rows)
+            for dim in range(3)])
+        return sums / np.maximum(self.active_lengths, 1).reshape(-1, 1)
@@ -0,0 +1,304 @@
+# pylint: disable=E0401, E1101
+
+"""
+runs a multiscale operator over a scaleset: a list of (voxel edge, scales) tuples like the ones
+gmso_APC and ogmso_APC loop over, where bigger scales are paired with coarser voxels.
+
+rather than a full operator run per tuple, scaleset_mso goes through the query set partitions
+once and processes every tuple on each partition. the search spaces come from a voxel pyramid
+built once, where each level is voxelized from a finer level instead of the full cloud whenever
+that gives the same voxels, and tuples sharing a voxel edge share one level.
+
+each query chunk is searched once at the largest buffer any level needs, and the search is reused
+down the pyramid: a level whose voxels nest in a coarser level's (an edge of 0, or an odd fraction
+of the coarser edge) takes the neighbors it found there, expands them into the finer points they
+hold, and cuts those to its own radius by their exact distances. a voxel's points all lie within
+its reach (the farthest any of them sits from its center), so a coarser search reaching the finer
+radius plus that reach finds every finer neighbor, and only levels nested in nothing coarser are
+searched with a tree. knn scales and voxel moments fall back on a search per level.
+
+the output has the columns the tuples' separate runs would have, in scaleset order.
+"""
+
+import numpy as np
+
+from nimrud.features import mso
+from nimrud.features.eigen import EIGEN_FEATURES
+from nimrud.features.neighborhoods import Neighborhoods
+from nimrud.features.vertical import VERTICAL_FEATURES
+from nimrud.utils.cache import cached_operator
+from nimrud.utils.geometry import VoxelFilter
+from nimrud.utils.shared import run_partitioned
+
+
+# operators scaleset_mso can run, as named in its operator argument
+SCALESET_OPERATORS = ["geometric", "oriented", "covariance"]
+
+#---------------------------------------------------------------------------------------------------
+
+@cached_operator("scaleset_mso", ignore=("workers",))
+def scaleset_mso(query_set, search_space, scaleset, operator="geometric", max_chunk=20000,
+                 scale_mode="radius", workers=1, moment_edge=0, extended=False, vertical=False):
+    """
+    run the named operator (geometric_mso, oriented_mso or covariance_mso) for every
+    (voxel edge, scales) tuple in scaleset, sharing the partitioning, voxelization and neighbor
+    searches between them. extended and vertical are geometric_mso's options; the other
+    arguments are as in geometric_mso.
+
+    returns a float32 array with one row per query set point in query set order:
+        [index, tuple 1 features, tuple 2 features, ...]
+    where each tuple's features are the columns (everything but the index) of
+    operator(query_set, search_space, voxel edge, scales), so its scales are in descending
+    order. takes a cache keyword like the prototype operators (see
+    nimrud.utils.cache.cached_operator).
+    """
+
+    if operator not in SCALESET_OPERATORS:
+        raise ValueError("operator must be one of {}".format(SCALESET_OPERATORS))
+    if operator != "geometric" and (extended or vertical):
+        raise ValueError("only the geometric operator has extended and vertical features")
+    if vertical and moment_edge:
+        raise ValueError("vertical features can't be computed from voxel moments")
+    scaleset = [(edge, np.sort(np.atleast_1d(np.asarray(scales, dtype=np.float64)))[::-1])
+                for edge, scales in scaleset]
+    if not scaleset:
+        raise ValueError("need at least one (voxel edge, scales) tuple")
+
+    # validate everything at once, and move the clouds into the operators' frame
+    query_set, search_space, _ = mso._prepare_inputs(
+        query_set, search_space, 0, np.concatenate([scales for _, scales in scaleset]),
+        scale_mode, moment_edge)
+    width = _feature_width(operator, extended, vertical)
+
+    # one level per voxel edge, searched at the union of its tuples' scales. each tuple's scales
+    # are blocks of their level's output, copied to the tuple's columns.
+    edges = sorted(set(edge for edge, _ in scaleset))
+    levels = []
+    for edge in edges:
+        scales = np.unique(np.concatenate([s for e, s in scaleset if e == edge]))[::-1]
+        if scale_mode == "knn":
+            scales = scales.astype(np.int64)
+        levels.append((scales, [], []))
+    column = 1
+    for edge, scales in scaleset:
+        level_scales, blocks, columns = levels[edges.index(edge)]
+        for scale in scales:
+            blocks.append(int(np.flatnonzero(level_scales == scale)[0]))
+            columns.append(column)
+            column += width
+
+    output = mso._indexed_output(query_set.shape[0], column - 1)
+    pyramid = voxel_pyramid(search_space, edges)
+    if scale_mode == "radius" and not moment_edge:
+        parents = pyramid_parents(search_space, edges, pyramid)
+        # each level is searched (or expanded) far enough to serve the levels nested in it
+        search_radii = [scales[0] for scales, _, _ in levels]
+        for level_num, nested in enumerate(parents):
+            if nested is not None:
+                search_radii[nested[0]] = max(search_radii[nested[0]],
+                                              search_radii[level_num] + nested[3])
+    else:
+        parents, search_radii = [None] * len(edges), None
+
+    # the search trees (or voxel moments) of the levels that get searched are built once, before
+    # any workers start
+    cache = dict((level_num, mso._search_cache(level, moment_edge))
+                 for level_num, (level, nested) in enumerate(zip(pyramid, parents))
+                 if nested is None)
+    run_partitioned(_scaleset_rows, (query_set,) + tuple(pyramid), (output,), query_set.shape[0],
+                    max_chunk, workers,
+                    (operator, levels, width, scale_mode, moment_edge, extended, vertical, parents,
+                     search_radii), cache)
+    return output
+
+#---------------------------------------------------------------------------------------------------
+
+def voxel_pyramid(points, edges):
+    """
+    the points voxelized at each of edges (or left alone, for an edge of 0), in the same order.
+    every level holds exactly the voxels VoxelFilter(points, edge).unique_voxels(points) would.
+
+    each level is voxelized from the coarsest finer level whose edge it is an odd multiple of,
+    if there is one. VoxelFilter centers its grid on the lowest point, so those levels' voxels
+    are whole blocks of the finer ones, and their centers never sit on a coarser boundary.
+    """
+
+    levels = {}
+    for edge in sorted(set(edges)):
+        if not edge:
+            levels[edge] = points
+            continue
+        source = points
+        for finer in sorted(levels, reverse=True):
+            if finer and _odd_multiple(edge, finer) and levels[finer].shape[0] > 1:
+                source = levels[finer]
+                break
+        levels[edge] = VoxelFilter(source, edge).unique_voxels(source)
+
+    return [levels[edge] for edge in edges]
+
+#---------------------------------------------------------------------------------------------------
+
+def pyramid_parents(points, edges, levels):
+    """
+    group the points of each level of a voxel pyramid (edges sorted in ascending order, with
+    levels from voxel_pyramid(points, edges)) under the voxels of the finest coarser level they
+    nest in.
+
+    returns a list with, for each level that nests in a coarser one, (parent level, child offsets,
+    child ids, reach): the points in voxel v of the parent level are
+    child_ids[child_offsets[v]:child_offsets[v+1]], and none of them sits reach or farther from
+    v's center. levels that nest in no coarser level get None.
+    """
+
+    parents = [None] * len(edges)
+    for parent in range(len(edges) - 1, 0, -1):
+        edge = edges[parent]
+        if not edge or levels[parent].shape[0] < 2:
+            continue
+        # the level's voxels are those of the full cloud's grid at its edge
+        grid = VoxelFilter(points, edge)
+        addresses = grid.coordinate_to_address(levels[parent])
+        order = np.argsort(addresses)
+        sorted_addresses = addresses.take(order)
+
+        for level_num in range(parent):
+            finer = edges[level_num]
+            if finer and not _odd_multiple(edge, finer):
+                continue
+            level_addresses = grid.coordinate_to_address(levels[level_num])
+            positions = np.searchsorted(sorted_addresses, level_addresses).clip(max=order.size - 1)
+            voxels = order.take(positions)
+            if not np.array_equal(addresses.take(voxels), level_addresses):
+                continue
+
+            # coarser parents are overwritten by finer ones, which reach less far
+            child_offsets = np.zeros(order.size + 1, dtype=np.int64)
+            np.cumsum(np.bincount(voxels, minlength=order.size), out=child_offsets[1:])
+            offsets = levels[level_num] - levels[parent].take(voxels, axis=0)
+            # pad the reach a little so round off can't lose a neighbor right at a scale
+            reach = np.sqrt(np.einsum("ij,ij->i", offsets, offsets).max()) * (1 + 1e-6) + 1e-9
+            parents[level_num] = (parent, child_offsets, np.argsort(voxels, kind="stable"), reach)
+
+    return parents
+
+#---------------------------------------------------------------------------------------------------
+
+def _odd_multiple(edge, finer):
+    """
+    whether edge is an odd whole number (above 1) of finer edges, up to round off
+    """
+
+    ratio = edge / finer
+    whole = int(round(ratio))
+    return whole > 1 and whole % 2 == 1 and abs(ratio - whole) < 1e-9 * ratio
+
+#---------------------------------------------------------------------------------------------------
+
+def _feature_width(operator, extended, vertical):
+    """
+    number of output columns per scale of the named operator
+    """
+
+    if operator == "geometric":
+        return 4 + (len(EIGEN_FEATURES) if extended else 0) +\
+            (len(VERTICAL_FEATURES) if vertical else 0)
+    return 8
+
+#---------------------------------------------------------------------------------------------------
+
+def _scaleset_rows(inputs, outputs, start, stop, cache, operator, levels, width, scale_mode,
+                   moment_edge, extended, vertical, parents, search_radii):
+    """
+    fill rows start:stop of scaleset_mso's output. inputs are the query set followed by the
+    search space at each level.
+    """
+
+    output, = outputs
+    query_chunk = inputs[0][start:stop]
+    num_rows = stop - start
+    found = {}
+
+    # coarse levels first, so every nested level finds its parent's neighborhoods
+    for level_num in range(len(levels) - 1, -1, -1):
+        scales, blocks, columns = levels[level_num]
+        level = inputs[1 + level_num]
+        # levels nested in nothing coarser have their own search tree (or voxel moments)
+        level_cache = cache.setdefault(level_num, {})
+        if search_radii is None:
+            neighborhoods = None
+        else:
+            nested = parents[level_num]
+            if nested is None:
+                found[level_num] = mso._search(level, query_chunk, search_radii[level_num],
+                                               scale_mode, mso._tree(level_cache, level))
+            else:
+                found[level_num] = _child_neighborhoods(found[nested[0]], nested[1:], level,
+                                                        query_chunk, search_radii[level_num])
+            neighborhoods = _prefix_neighborhoods(found[level_num], scales[0])
+
+        local_inputs = (query_chunk, level)
+        local = np.zeros((num_rows, 1 + scales.size * width), dtype=np.float32)
+        if operator == "geometric":
+            mso._geometric_rows(local_inputs, (local,), 0, num_rows, level_cache, scales,
+                                scale_mode, moment_edge, extended, vertical, neighborhoods)
+        elif operator == "oriented":
+            mso._oriented_rows(local_inputs, (local,), 0, num_rows, level_cache, scales,
+                               scale_mode, moment_edge, neighborhoods)
+        else:
+            mso._covariance_rows(local_inputs, (local,), 0, num_rows, level_cache, scales,
+                                 scale_mode, moment_edge, neighborhoods)
+
+        for block, column in zip(blocks, columns):
+            first = 1 + block * width
+            output[start:stop, column:column + width] = local[:, first:first + width]
+
+#---------------------------------------------------------------------------------------------------
+
+def _prefix_neighborhoods(neighborhoods, radius):
+    """
+    the Neighborhoods cut to the neighbors strictly within radius
+    """
+
+    if neighborhoods.distances.size == 0 or neighborhoods.distances.max() < radius:
+        return neighborhoods
+
+    lengths = neighborhoods.prefix_lengths(radius)
+    positions = neighborhoods.prefix_index(lengths)
+    row_offsets = np.zeros(lengths.size + 1, dtype=np.int64)
+    np.cumsum(lengths, out=row_offsets[1:])
+    return Neighborhoods(row_offsets, neighborhoods.neighbor_ids.take(positions),
+                         neighborhoods.distances.take(positions))
+
+#---------------------------------------------------------------------------------------------------
+
+def _child_neighborhoods(coarse, nested, level, query_chunk, radius):
+    """
+    the distance sorted neighborhoods strictly within radius of the query chunk in a nested
+    level, from the chunk's Neighborhoods in its parent level and the (child offsets, child ids,
+    reach) of its pyramid_parents entry. every parent neighbor within radius plus the reach is
+    expanded into the level's points it holds, and those are cut to radius by their own distances.
+    """
+
+    child_offsets, child_ids, reach = nested
+    lengths = coarse.prefix_lengths(radius + reach)
+    positions = coarse.prefix_index(lengths)
+    parents = coarse.neighbor_ids.take(positions)
+    parent_rows = np.repeat(np.arange(coarse.num_rows), lengths)
+
+    # each coarse neighbor's points are a run of child_ids: line the runs up one after another
+    counts = child_offsets.take(parents + 1) - child_offsets.take(parents)
+    run_starts = np.zeros(counts.size, dtype=np.int64)
+    np.cumsum(counts[:-1], out=run_starts[1:])
+    shifts = np.repeat(child_offsets.take(parents) - run_starts, counts)
+    neighbor_ids = child_ids.take(np.arange(counts.sum()) + shifts)
+    row_ids = np.repeat(parent_rows, counts)
+
+    offsets = level.take(neighbor_ids, axis=0) - query_chunk.take(row_ids, axis=0)
+    distances = np.sqrt(np.einsum("ij,ij->i", offsets, offsets))
+    keep = distances < radius
+    return Neighborhoods.from_unsorted(
+        row_ids.compress(keep),
+        neighbor_ids.compress(keep),
+        distances.compress(keep),
+        coarse.num_rows)
@@ -0,0 +1,141 @@
+# pylint: disable=E0401, E1101
+
+"""
+tests for the closed form 3x3 eigensolver
+"""
+
+import numpy as np
+
+from nimrud.features import eigen
+
+SEED = 10
+np.random.seed(SEED)
+
+#---------------------------------------------------------------------------------------------------
+
+def random_covariances(num, points=20):
+    """
+    scatter matrices of random point sets, including some squashed into lines and planes
+    """
+
+    clouds = np.random.randn(num, points, 3) * np.random.rand(num, 1, 3)
+    clouds[:num // 3, :, 1:] *= 1e-3
+    clouds[num // 3:2 * num // 3, :, 2] = 0
+    centered = clouds - clouds.mean(1, keepdims=True)
+    return np.einsum("nij,nik->njk", centered, centered)
+
+#---------------------------------------------------------------------------------------------------
+
+def test_eigvals():
+    """
+    eigenvalues should match LAPACK's, in ascending order
+    """
+
+    covariances = random_covariances(3000)
+    known = np.linalg.eigvalsh(covariances)
+    values = eigen.symmetric_eigvals(covariances)
+    assert values.shape == (3000, 3), "wrong output shape"
+    # nearly repeated eigenvalues lose about half the digits, relative to the largest
+    assert np.allclose(values, known, rtol=0, atol=1e-7 * np.abs(known).max(1, keepdims=True)),\
+        "eigenvalues don't match numpy"
+
+    # degenerate matrices and float32 input
+    special = np.array([np.zeros((3, 3)), np.eye(3) * 5, np.diag([3., 1., 1.]),
+                        np.diag([-2., 0., 7.]), np.ones((3, 3))])
+    assert np.allclose(eigen.symmetric_eigvals(special.astype(np.float32)),
+                       np.linalg.eigvalsh(special)), "degenerate eigenvalues are wrong"
+    assert eigen.symmetric_eigvals(np.zeros((0, 3, 3))).shape == (0, 3), "mishandled no matrices"
+
+    try:
+        eigen.symmetric_eigvals(np.zeros((4, 2, 2)))
+        assert False, "accepted 2x2 matrices"
+    except ValueError:
+        pass
+
+#---------------------------------------------------------------------------------------------------
+
+def test_eigh():
+    """
+    eigenvectors should be orthonormal and diagonalize the matrices, degenerate or not
+    """
+
+    covariances = np.concatenate([
+        random_covariances(3000),
+        np.array([np.zeros((3, 3)), np.eye(3) * 5, np.diag([3., 1., 1.]), np.ones((3, 3))])])
+    values, vectors = eigen.symmetric_eigh(covariances)
+
+    assert np.allclose(values, np.linalg.eigvalsh(covariances)), "eigenvalues don't match numpy"
+    assert np.allclose(np.einsum("nji,njk->nik", vectors, vectors), np.eye(3), atol=1e-8),\
+        "eigenvectors aren't orthonormal"
+    scale = np.abs(values).max(1).reshape(-1, 1, 1) + 1
+    residual = np.einsum("nij,njk->nik", covariances, vectors) - vectors * values[:, None, :]
+    assert np.all(np.abs(residual) <= 1e-7 * scale), "eigenvectors don't diagonalize the matrices"
+
+#---------------------------------------------------------------------------------------------------
+
+def test_normalized_eigenvalues():
+    """
+    normalized eigenvalues should be descending, sum to 1, and keep their vectors in step
+    """
+
+    covariances = random_covariances(500)
+    values, vectors = eigen.normalized_eigenvalues(covariances, vectors=True)
+    assert np.allclose(values.sum(1), 1), "didn't normalize"
+    assert np.all(np.diff(values, axis=1) <= 0), "didn't sort descending"
+    assert np.allclose(values, eigen.normalized_eigenvalues(covariances)),\
+        "values depend on whether vectors were asked for"
+
+    totals = np.trace(covariances, axis1=1, axis2=2).reshape(-1, 1, 1)
+    residual = np.einsum("nij,njk->nik", covariances / totals, vectors) -\
+        vectors * values[:, None, :]
+    assert np.all(np.abs(residual) < 1e-7), "vectors don't match their values"
+
+#---------------------------------------------------------------------------------------------------
+
+def test_eigen_features():
+    """
+    a line, a plane and a ball of points should each score highest on their own feature, and a
+    horizontal plane should have a vertical normal
+    """
+
+    rand = np.random.rand(400, 3) - 0.5
+    shapes = {
+        "line": rand * [10, 0.01, 0.01],
+        "plane": rand * [10, 10, 0.01],
+        "ball": rand * [10, 10, 10]}
+    centered = [points - points.mean(0) for points in shapes.values()]
+    covariances = np.array([points.T.dot(points) for points in centered])
+    features = eigen.eigen_features(*eigen.normalized_eigenvalues(covariances, vectors=True))
+    assert features.shape == (3, len(eigen.EIGEN_FEATURES)), "wrong number of features"
+    named = dict(zip(eigen.EIGEN_FEATURES, features.T))
+
+    assert np.argmax(named["linearity"]) == 0, "line isn't the most linear"
+    assert np.argmax(named["planarity"]) == 1, "plane isn't the most planar"
+    assert np.argmax(named["scattering"]) == 2, "ball isn't the most scattered"
+    assert np.argmax(named["omnivariance"]) == 2, "ball doesn't vary most in every direction"
+    assert np.argmax(named["eigenentropy"]) == 2, "ball isn't the least ordered"
+    assert named["normal_z"][1] > 0.999 and named["verticality"][1] < 1e-3,\
+        "horizontal plane has the wrong normal"
+    assert np.allclose(named["linearity"] + named["planarity"] + named["scattering"], 1),\
+        "dimensionality features don't sum to 1"
+
+    # no spread at all gives zeros instead of nans
+    flat = eigen.eigen_features(*eigen.normalized_eigenvalues(np.zeros((2, 3, 3)), vectors=True))
+    assert np.all(np.isfinite(flat)), "features of empty neighborhoods aren't finite"
+    assert np.all(flat[:, :7] == 0), "features of empty neighborhoods aren't 0"
+
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    print("testing eigenvalues")
+    test_eigvals()
+    print("eigenvalues match")
+    print("testing eigenvectors")
+    test_eigh()
+    print("eigenvectors match")
+    print("testing normalized eigenvalues")
+    test_normalized_eigenvalues()
+    print("normalized eigenvalues match")
+    print("testing eigen features")
+    test_eigen_features()
+    print("eigen features work")
@@ -0,0 +1,70 @@
+# pylint: disable=E0401, E1101
+
+"""
+tests for incremental feature recomputation
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from nimrud.features import incremental, mso
+
+SEED = 10
+np.random.seed(SEED)
+
+#---------------------------------------------------------------------------------------------------
+
+def test_update_mso():
+    """
+    patching the features of the affected rows should give the same features as recomputing
+    everything, in both scale modes, for additions and removals
+    """
+
+    search_space = np.random.rand(4000, 3) * [10, 10, 1]
+    query_set = search_space[::4]
+    added = np.random.rand(50, 3) * [1, 1, 1] + [2, 2, 0]
+    removed = np.flatnonzero(np.linalg.norm(search_space[:, :2] - [7, 7], axis=1) < 0.5)
+    new_search_space = np.vstack((np.delete(search_space, removed, axis=0), added))
+    changed = np.vstack((added, search_space[removed]))
+
+    for scale_mode, scales in [("radius", [0.3, 0.6]), ("knn", [10, 30])]:
+        features = mso.geometric_mso(query_set, search_space, 0, scales, scale_mode=scale_mode)
+        known = mso.geometric_mso(query_set, new_search_space, 0, scales, scale_mode=scale_mode)
+        rows = incremental.update_mso(features, query_set, new_search_space, changed, 0, scales,
+                                      scale_mode=scale_mode)
+        assert 0 < rows.size < query_set.shape[0] / 4, "recomputed too much"
+        assert np.allclose(features, known, atol=1e-6), "patched features are wrong"
+
+    # voxelized knn neighborhoods reach much farther than the raw points' do
+    cube = np.random.rand(20000, 3) * 5
+    strip = np.random.rand(100, 3) * [0.5, 5, 5] + [5, 0, 0]
+    features = mso.geometric_mso(cube[::10], cube, 0.25, [30, 10], scale_mode="knn")
+    known = mso.geometric_mso(cube[::10], np.vstack((cube, strip)), 0.25, [30, 10],
+                              scale_mode="knn")
+    incremental.update_mso(features, cube[::10], np.vstack((cube, strip)), strip, 0.25,
+                           [30, 10], scale_mode="knn")
+    assert np.allclose(features, known, atol=1e-6), "missed rows reached through voxels"
+
+    # a stored asset on disk gets patched in place, with the covariance operator this time
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "features.npy")
+    np.save(path, mso.covariance_mso(query_set, search_space, 0, [0.4]))
+    incremental.update_mso(path, query_set, new_search_space, changed, 0, [0.4],
+                           operator=mso.covariance_mso)
+    known = mso.covariance_mso(query_set, new_search_space, 0, [0.4])
+    assert np.allclose(np.load(path), known, atol=1e-6), "didn't patch the file"
+    shutil.rmtree(directory)
+
+    # nothing changed, nothing to do
+    assert incremental.affected_rows(query_set, search_space, np.zeros((0, 3)), [0.5]).size == 0,\
+        "found rows affected by no change"
+
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    print("testing incremental updates")
+    test_update_mso()
+    print("incremental updates match")
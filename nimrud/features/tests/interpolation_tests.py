@@ -0,0 +1,124 @@
+# pylint: disable=E0401, E1101
+
+"""
+tests for vector field interpolation to voxel centers
+"""
+
+import numpy as np
+
+from nimrud.features import interpolation
+from nimrud.utils.geometry import VoxelFilter
+
+SEED = 10
+np.random.seed(SEED)
+
+#---------------------------------------------------------------------------------------------------
+
+def brute_force_interpolation(voxels, points, features, edge, measure, weights):
+    """
+    weighted mean of the features within edge of each voxel, from a full distance matrix
+    """
+
+    offsets = np.abs(voxels[:, None, :] - points[None, :, :])
+    if measure == "cheby":
+        distances = offsets.max(2)
+    else:
+        distances = np.sqrt((offsets ** 2).sum(2))
+    within = (distances < edge) * weights[None, :]
+    totals = within.sum(1)
+    return within.dot(features) / np.maximum(totals, 1e-300).reshape(-1, 1)
+
+#---------------------------------------------------------------------------------------------------
+
+def test_interpolate_to_voxels():
+    """
+    streamed interpolation should match the distance matrix in both measures, with weights and
+    small chunks, including points sitting exactly on voxel centers
+    """
+
+    # a power of 2 edge from the origin, so that voxel centers are exact and the distance matrix
+    # has no round off at the ties
+    edge = 0.25
+    points = np.random.rand(3000, 3) * [3, 3, 1]
+    voxels = np.unique(np.floor(points / edge), axis=0) * edge + edge / 2
+    # some points right on voxel centers, where a point has no neighbor on "its side"
+    points = np.vstack((points, voxels[::7]))
+    features = np.random.rand(points.shape[0], 4)
+    weights = np.random.rand(points.shape[0]) + 0.5
+    # a voxel nothing can reach, in a shuffled voxel order
+    voxels = np.vstack((voxels, voxels[0] + [0, 0, 20 * edge]))
+    order = np.random.permutation(voxels.shape[0])
+    voxels = voxels[order]
+    unreachable = np.flatnonzero(order == order.size - 1)[0]
+
+    for measure in interpolation.MEASURES:
+        known = brute_force_interpolation(voxels, points, features, edge, measure, weights)
+        test = interpolation.interpolate_to_voxels(voxels, points, features, edge, measure,
+                                                   weights, max_chunk=500)
+        assert np.allclose(test, known), "wrong {} interpolation".format(measure)
+
+    unweighted = interpolation.interpolate_to_voxels(voxels, points, features[:, 0], edge)
+    known = brute_force_interpolation(voxels, points, features[:, :1], edge, "cheby",
+                                      np.ones(points.shape[0]))
+    assert np.allclose(unweighted, known), "wrong unweighted interpolation"
+    assert unweighted[unreachable, 0] == 0, "unreachable voxel should be 0"
+
+    off_grid = voxels.copy()
+    off_grid[1] += edge / 3
+    try:
+        interpolation.interpolate_to_voxels(off_grid, points, features, edge)
+        assert False, "accepted voxels off the grid"
+    except ValueError:
+        pass
+
+#---------------------------------------------------------------------------------------------------
+
+def test_interpolate_to_points():
+    """
+    query sets off a single grid, like two partitions voxelized on their own grids, should
+    match the distance matrix through the KD tree path
+    """
+
+    edge = 0.2
+    points = np.random.rand(3000, 3) * [2, 2, 1]
+    halves = [points[points[:, 0] < 1], points[points[:, 0] >= 1]]
+    query_set = np.vstack([VoxelFilter(half, edge).unique_voxels(half) for half in halves])
+    features = np.random.rand(points.shape[0], 3)
+    weights = np.random.rand(points.shape[0]) + 0.5
+
+    assert not interpolation.on_grid(query_set, edge), "partition grids shouldn't line up"
+    for measure in interpolation.MEASURES:
+        known = brute_force_interpolation(query_set, points, features, edge, measure, weights)
+        test = interpolation.interpolate_to_points(query_set, points, features, edge, measure,
+                                                   weights, max_chunk=100)
+        assert np.allclose(test, known), "wrong {} interpolation".format(measure)
+
+#---------------------------------------------------------------------------------------------------
+
+def test_voxel_field():
+    """
+    voxelizing a field should give VoxelFilter's voxels with their interpolated features
+    """
+
+    edge = 0.2
+    points = np.random.rand(2000, 3) + [512000.0, 4100000.0, 100.0]
+    features = np.random.rand(points.shape[0], 2)
+    voxels, voxel_features = interpolation.voxel_field(points, features, edge)
+
+    assert np.array_equal(voxels, VoxelFilter(points, edge).unique_voxels(points)),\
+        "wrong voxels"
+    known = brute_force_interpolation(voxels, points, features, edge, "cheby",
+                                      np.ones(points.shape[0]))
+    assert np.allclose(voxel_features, known), "wrong voxel features"
+
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    print("testing voxel interpolation")
+    test_interpolate_to_voxels()
+    print("interpolated features match")
+    test_interpolate_to_points()
+    print("off grid features match")
+    print("testing voxel field")
+    test_voxel_field()
+    print("voxel field matches")
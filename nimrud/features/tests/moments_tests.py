@@ -0,0 +1,106 @@
+# pylint: disable=E0401, E1101
+
+"""
+tests for the prefix sum neighborhood moments
+"""
+
+import numpy as np
+
+from nimrud.features import moments, neighborhoods
+
+SEED = 10
+np.random.seed(SEED)
+
+#---------------------------------------------------------------------------------------------------
+
+def test_prefix_moments():
+    """
+    moments from prefix sums should match the gathered reductions of the ragged neighborhoods at
+    every scale, including empty neighborhoods
+    """
+
+    search_space = np.random.rand(3000, 3)
+    query_set = np.vstack((np.random.rand(150, 3), [[5, 5, 5]]))
+    nbhds = neighborhoods.RaggedNeighborhoods.from_neighborhoods(
+        neighborhoods.Neighborhoods.radius_search(search_space, query_set, 0.3),
+        search_space,
+        query_set)
+    prefix = moments.PrefixMoments(nbhds)
+
+    for radius in [0.3, 0.2, 0.05, 0.25]:
+        counts = prefix.drop(radius)
+        assert np.array_equal(counts, nbhds.drop(radius)), "dropped to the wrong counts"
+        assert counts[-1] == 0, "found neighbors for an isolated point"
+        assert np.allclose(prefix.centroids(), nbhds.centroids(), atol=1e-9),\
+            "wrong centroids at radius {}".format(radius)
+        assert np.allclose(prefix.centroid_displacement(), nbhds.centroid_displacement(),
+                           atol=1e-9), "wrong centroid displacement at radius {}".format(radius)
+        assert np.allclose(prefix.scatter_matrices(), nbhds.scatter_matrices(), atol=1e-9),\
+            "wrong scatter matrices at radius {}".format(radius)
+
+#---------------------------------------------------------------------------------------------------
+
+def test_voxel_moments():
+    """
+    voxel moments should sum to the moments of the whole cloud, and each voxel's moments should
+    be those of its points
+    """
+
+    points = np.random.rand(2000, 3)
+    voxels = moments.VoxelMoments(points, 0.1)
+
+    assert voxels.counts.sum() == points.shape[0], "lost points"
+    assert len(voxels) <= 1000, "more voxels than grid cells"
+    assert np.allclose((voxels.centroids * voxels.counts[:, None]).sum(0), points.sum(0)),\
+        "wrong voxel centroids"
+    # the scatter of the cloud is the voxel scatters plus the scatter of the weighted centroids
+    offsets = voxels.centroids - points.mean(0)
+    spread = np.einsum("vi,vj,v->ij", offsets, offsets, voxels.counts)
+    centered = points - points.mean(0)
+    total = centered.T.dot(centered) - spread
+    rows, columns = moments.UPPER_TRIANGLE
+    assert np.allclose(voxels.scatter.sum(0), total[rows, columns]), "wrong voxel scatter"
+
+#---------------------------------------------------------------------------------------------------
+
+def test_voxel_prefix_moments():
+    """
+    voxel neighborhoods should be exact when every point has a voxel of its own, and otherwise
+    miss the exact counts by no more than count_error
+    """
+
+    search_space = np.random.rand(3000, 3)
+    query_set = np.vstack((np.random.rand(100, 3), [[5, 5, 5]]))
+    nbhds = neighborhoods.RaggedNeighborhoods.from_neighborhoods(
+        neighborhoods.Neighborhoods.radius_search(search_space, query_set, 0.3),
+        search_space,
+        query_set)
+    exact = moments.PrefixMoments(nbhds)
+    fine = moments.VoxelPrefixMoments(moments.VoxelMoments(search_space, 1e-6), query_set, 0.3)
+    coarse = moments.VoxelPrefixMoments(moments.VoxelMoments(search_space, 0.04), query_set, 0.3)
+
+    for radius in [0.3, 0.2, 0.1]:
+        counts = exact.drop(radius)
+        assert np.array_equal(fine.drop(radius), counts), "fine voxels dropped to the wrong counts"
+        assert np.allclose(fine.centroids(), exact.centroids(), atol=1e-6),\
+            "wrong centroids at radius {}".format(radius)
+        assert np.allclose(fine.scatter_matrices(), exact.scatter_matrices(), atol=1e-6),\
+            "wrong scatter matrices at radius {}".format(radius)
+
+        approximate = coarse.drop(radius)
+        assert approximate[-1] == 0, "found neighbors for an isolated point"
+        assert np.all(np.abs(approximate - counts) <= coarse.count_error(radius)),\
+            "count error exceeds its bound at radius {}".format(radius)
+
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    print("testing prefix moments")
+    test_prefix_moments()
+    print("prefix moments match")
+    print("testing voxel moments")
+    test_voxel_moments()
+    print("voxel moments match")
+    print("testing voxel prefix moments")
+    test_voxel_prefix_moments()
+    print("voxel prefix moments match")
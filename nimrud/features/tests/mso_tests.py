@@ -0,0 +1,378 @@
+# pylint: disable=E0401, E1101
+
+"""
+tests for the CPU multiscale operators
+"""
+
+import numpy as np
+
+from nimrud.features import eigen, mso, vertical
+
+SEED = 10
+np.random.seed(SEED)
+
+#---------------------------------------------------------------------------------------------------
+
+def brute_force_gmso(query_set, search_space, scales):
+    """
+    compute the G_MSO feature layout one point and one scale at a time
+    """
+
+    scales = np.sort(scales)[::-1]
+    output = np.zeros((query_set.shape[0], 1 + scales.size * 4))
+    output[:, 0] = np.arange(query_set.shape[0])
+    for row, point in enumerate(query_set):
+        offsets = search_space - point
+        distances = np.linalg.norm(offsets, axis=1)
+        for scale_num, scale in enumerate(scales):
+            neighbors = offsets[distances < scale]
+            column = 1 + scale_num * 4
+            output[row, column] = neighbors.shape[0] / (1e6 * 4 / 3 * np.pi * scale ** 3)
+            if neighbors.shape[0] == 0:
+                continue
+            centroid = neighbors.mean(0)
+            output[row, column + 1] = np.linalg.norm(centroid)
+            centered = neighbors - centroid
+            eigenvalues = np.sort(np.linalg.eigvalsh(centered.T.dot(centered)))[::-1]
+            output[row, column + 2:column + 4] = (eigenvalues / (eigenvalues.sum() + eigen.EPS))[:2]
+
+    return output
+
+#---------------------------------------------------------------------------------------------------
+
+def test_geometric_mso():
+    """
+    the vectorized operator should agree with the brute force one, in G_MSO's layout
+    """
+
+    search_space = np.random.rand(2000, 3)
+    query_set = np.random.rand(300, 3)
+    scales = np.array([0.1, 0.3, 0.2])
+
+    known = brute_force_gmso(query_set, search_space, scales)
+    # small chunks so we go through the chunk loop a few times
+    test = mso.geometric_mso(query_set, search_space, 0, scales, max_chunk=70)
+
+    assert test.shape == (300, 1 + 3 * 4), "wrong output layout"
+    assert test.dtype == np.float32, "wrong output type"
+    assert np.allclose(known, test, atol=1e-5), "features disagree with brute force"
+
+#---------------------------------------------------------------------------------------------------
+
+def test_geometric_mso_voxel():
+    """
+    voxelizing the search space should give the same result as voxelizing it first
+    """
+
+    search_space = np.random.rand(5000, 3)
+    query_set = search_space[:200]
+    scales = [0.2, 0.15]
+    voxel_edge = 0.05
+
+    voxels = mso.VoxelFilter(search_space, voxel_edge).unique_voxels(search_space)
+    known = mso.geometric_mso(query_set, voxels, 0, scales)
+    test = mso.geometric_mso(query_set, search_space, voxel_edge, scales)
+    assert np.allclose(known, test), "voxelized search space incorrectly"
+
+#---------------------------------------------------------------------------------------------------
+
+def test_geometric_mso_plane():
+    """
+    a flat neighborhood should have (almost) all of its variance in the two largest eigenvalues
+    """
+
+    search_space = np.random.rand(3000, 3)
+    search_space[:, 2] = 0
+    query_set = search_space[:100] * 0.5 + 0.25
+    query_set[:, 2] = 0
+    test = mso.geometric_mso(query_set, search_space, 0, [0.2])
+    assert np.allclose(test[:, 3] + test[:, 4], 1), "plane has a nonzero third eigenvalue"
+
+    # bad scales
+    for bad_scales in [[], [0.1, -0.1]]:
+        try:
+            mso.geometric_mso(query_set, search_space, 0, bad_scales)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("accepted scales {}".format(bad_scales))
+
+#---------------------------------------------------------------------------------------------------
+
+def test_geometric_mso_extended():
+    """
+    the extended layout should keep G_MSO's features for each scale, followed by the eigen
+    features of the same neighborhoods
+    """
+
+    search_space = np.random.rand(2000, 3)
+    query_set = np.random.rand(200, 3)
+    scales = np.array([0.1, 0.2])
+
+    plain = mso.geometric_mso(query_set, search_space, 0, scales)
+    test = mso.geometric_mso(query_set, search_space, 0, scales, extended=True)
+    width = 4 + len(eigen.EIGEN_FEATURES)
+    assert test.shape == (200, 1 + 2 * width), "wrong output layout"
+    assert np.array_equal(test[:, 0], plain[:, 0]), "wrong index"
+
+    for scale_num, scale in enumerate(np.sort(scales)[::-1]):
+        column = 1 + scale_num * width
+        plain_column = 1 + scale_num * 4
+        assert np.allclose(test[:, column:column + 4], plain[:, plain_column:plain_column + 4]),\
+            "geometric features changed at scale {}".format(scale)
+        point = query_set[7]
+        offsets = search_space[np.linalg.norm(search_space - point, axis=1) < scale] - point
+        centered = offsets - offsets.mean(0)
+        known = eigen.eigen_features(
+            *eigen.normalized_eigenvalues(centered.T.dot(centered)[None], vectors=True))
+        assert np.allclose(test[7, column + 4:column + width], known[0], atol=1e-5),\
+            "wrong eigen features at scale {}".format(scale)
+
+#---------------------------------------------------------------------------------------------------
+
+def test_geometric_mso_vertical():
+    """
+    vertical features should follow each scale's block, after the eigen features if those are
+    asked for, and match the heights of each neighborhood
+    """
+
+    search_space = np.random.rand(2000, 3)
+    query_set = np.random.rand(100, 3)
+    scales = np.array([0.1, 0.2])
+
+    plain = mso.geometric_mso(query_set, search_space, 0, scales, max_chunk=30, extended=True)
+    test = mso.geometric_mso(query_set, search_space, 0, scales, max_chunk=30, extended=True,
+                             vertical=True)
+    leading = 4 + len(eigen.EIGEN_FEATURES)
+    width = leading + len(vertical.VERTICAL_FEATURES)
+    assert test.shape == (100, 1 + 2 * width), "wrong output layout"
+
+    for scale_num, scale in enumerate([0.2, 0.1]):
+        column = 1 + scale_num * width
+        plain_column = 1 + scale_num * leading
+        assert np.allclose(test[:, column:column + leading],
+                           plain[:, plain_column:plain_column + leading]),\
+            "other features changed at scale {}".format(scale)
+        for row in [0, 33, 99]:
+            offsets = search_space - query_set[row]
+            heights = offsets[np.linalg.norm(offsets, axis=1) < scale, 2]
+            features = test[row, column + leading:column + width]
+            assert np.isclose(features[0], heights[np.argmax(np.abs(heights))]), "wrong sazo"
+            assert np.isclose(features[1], np.ptp(heights)), "wrong z range"
+            assert np.isclose(features[2], heights.std(), atol=1e-5), "wrong z std"
+            assert features[4] == (heights > 0).sum(), "wrong count above"
+
+#---------------------------------------------------------------------------------------------------
+
+def test_oriented_covariance_mso():
+    """
+    the oriented and covariance operators should share the geometric operator's density and
+    centroid, and lay out the eigenvectors and scatter matrices like OG_MSO and C_MSO
+    """
+
+    search_space = np.random.rand(2000, 3)
+    query_set = np.random.rand(100, 3)
+    scales = [0.3, 0.15]
+
+    geometric = mso.geometric_mso(query_set, search_space, 0, scales)
+    oriented = mso.oriented_mso(query_set, search_space, 0, scales, max_chunk=30)
+    covariance = mso.covariance_mso(query_set, search_space, 0, scales, max_chunk=30)
+    assert oriented.shape == covariance.shape == (100, 1 + 2 * 8), "wrong output layout"
+
+    for scale_num, scale in enumerate(scales):
+        column = 1 + scale_num * 8
+        geometric_columns = [1 + scale_num * 4, 2 + scale_num * 4]
+        for test in [oriented, covariance]:
+            assert np.allclose(test[:, column:column + 2], geometric[:, geometric_columns]),\
+                "density and centroid don't match the geometric operator"
+
+        for row, point in enumerate(query_set):
+            offsets = search_space - point
+            neighbors = offsets[np.linalg.norm(offsets, axis=1) < scale]
+            if neighbors.shape[0] < 4:
+                continue
+            centered = neighbors - neighbors.mean(0)
+            scatter = centered.T.dot(centered)
+            values, vectors = np.linalg.eigh(scatter)
+            assert np.allclose(oriented[row, column + 2:column + 4], values[:2] / values.sum(),
+                               atol=1e-6), "wrong smallest eigenvalues"
+            for vector_num in range(2):
+                known = vectors[:2, vector_num]
+                test = oriented[row, column + 4 + vector_num * 2:column + 6 + vector_num * 2]
+                assert np.allclose(test, known, atol=1e-4) or\
+                    np.allclose(test, -known, atol=1e-4), "wrong eigenvector components"
+            assert np.allclose(covariance[row, column + 2:column + 8],
+                               scatter[np.triu_indices(3)], atol=1e-5), "wrong covariance"
+
+#---------------------------------------------------------------------------------------------------
+
+def test_knn_mso():
+    """
+    knn scales should be served as prefixes of one nearest neighbor search
+    """
+
+    search_space = np.random.rand(1000, 3)
+    query_set = np.random.rand(60, 3)
+    scales = [5, 20, 12]
+
+    test = mso.geometric_mso(query_set, search_space, 0, scales, max_chunk=25, scale_mode="knn")
+    _, _, means, _ = mso.vector_statistics(
+        query_set, search_space, search_space[:, :2], scales, scale_mode="knn")
+    for row, point in enumerate(query_set):
+        offsets = search_space - point
+        distances = np.linalg.norm(offsets, axis=1)
+        order = np.argsort(distances)
+        for scale_num, k in enumerate([20, 12, 5]):
+            neighbors = offsets[order[:k]]
+            column = 1 + scale_num * 4
+            volume = 1e6 * 4 / 3 * np.pi * distances[order[k - 1]] ** 3
+            assert np.isclose(test[row, column], k / volume, rtol=1e-5), "wrong knn density"
+            centroid = neighbors.mean(0)
+            assert np.isclose(test[row, column + 1], np.linalg.norm(centroid), atol=1e-6),\
+                "wrong knn centroid"
+            centered = neighbors - centroid
+            eigenvalues = np.sort(np.linalg.eigvalsh(centered.T.dot(centered)))[::-1]
+            assert np.allclose(test[row, column + 2:column + 4],
+                               (eigenvalues / eigenvalues.sum())[:2], atol=1e-5),\
+                "wrong knn eigenvalues"
+            assert np.allclose(means[row, scale_num], search_space[order[:k], :2].mean(0)),\
+                "wrong knn feature means"
+
+    # more neighbors than points takes the whole search space
+    whole = mso.covariance_mso(query_set, search_space[:10], 0, [50], scale_mode="knn")
+    assert np.allclose(whole[:, 2], np.linalg.norm(search_space[:10].mean(0) - query_set, axis=1),
+                       atol=1e-6), "didn't take the whole search space"
+
+    for bad_scales, scale_mode in [([2.5], "knn"), ([2], "nearest")]:
+        try:
+            mso.geometric_mso(query_set, search_space, 0, bad_scales, scale_mode=scale_mode)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("accepted {} scales {}".format(scale_mode, bad_scales))
+
+#---------------------------------------------------------------------------------------------------
+
+def test_vector_mso():
+    """
+    neighborhood feature statistics should match brute force, and the means should come out in
+    V_MSO's layout
+    """
+
+    search_space = np.random.rand(2000, 3)
+    features = np.random.rand(2000, 4)
+    query_set = np.vstack((np.random.rand(150, 3), [[5, 5, 5]]))
+    scales = np.array([0.1, 0.25])
+
+    counts, sums, means, variances = mso.vector_statistics(
+        query_set, search_space, features, scales, max_chunk=40)
+    assert counts.shape == (151, 2) and means.shape == (151, 2, 4), "wrong output shapes"
+    for row, point in enumerate(query_set):
+        distances = np.linalg.norm(search_space - point, axis=1)
+        for scale_num, scale in enumerate([0.25, 0.1]):
+            neighbors = features[distances < scale]
+            assert counts[row, scale_num] == neighbors.shape[0], "wrong neighbor count"
+            assert np.allclose(sums[row, scale_num], neighbors.sum(0)), "wrong sums"
+            if neighbors.shape[0]:
+                assert np.allclose(means[row, scale_num], neighbors.mean(0)), "wrong means"
+                assert np.allclose(variances[row, scale_num], neighbors.var(0)),\
+                    "wrong variances"
+    assert not means[-1].any() and not variances[-1].any(), "empty neighborhood isn't 0"
+
+    # scalar features, in the prototype's layout
+    test = mso.vector_mso(query_set, search_space, features[:, 0], scales)
+    assert test.shape == (151, 3) and test.dtype == np.float32, "wrong output layout"
+    assert np.array_equal(test[:, 0], np.arange(151)), "wrong indices"
+    assert np.allclose(test[:, 1:], means[:, :, 0]), "wrong means for scalar features"
+
+    try:
+        mso.vector_mso(query_set, search_space, features[1:], scales)
+        assert False, "accepted the wrong number of feature vectors"
+    except ValueError:
+        pass
+
+#---------------------------------------------------------------------------------------------------
+
+
+
+
+def test_mso_workers():
+    """
+    every operator should give the same output in a process pool as in a single process
+    """
+
+    search_space = np.random.rand(1500, 3)
+    query_set = np.random.rand(250, 3)
+    features = np.random.rand(1500, 2)
+    scales = [0.1, 0.2]
+
+    for operator in [mso.geometric_mso, mso.oriented_mso, mso.covariance_mso]:
+        serial = operator(query_set, search_space, 0, scales, max_chunk=60)
+        pooled = operator(query_set, search_space, 0, scales, max_chunk=60, workers=3)
+        assert np.array_equal(serial, pooled), "{} differs in a pool".format(operator.__name__)
+
+    serial = mso.vector_mso(query_set, search_space, features, scales, max_chunk=60)
+    pooled = mso.vector_mso(query_set, search_space, features, scales, max_chunk=60, workers=3)
+    assert np.array_equal(serial, pooled), "vector_mso differs in a pool"
+
+#---------------------------------------------------------------------------------------------------
+
+def test_moment_edge_mso():
+    """
+    the voxel moment approximation should be exact with tiny voxels, and coarser voxels should
+    stay within the count error bound
+    """
+
+    search_space = np.random.rand(2000, 3)
+    query_set = np.random.rand(100, 3)
+    scales = [0.3, 0.15]
+
+    truth = mso.covariance_mso(query_set, search_space, 0, scales, max_chunk=40)
+    test = mso.covariance_mso(query_set, search_space, 0, scales, max_chunk=40, moment_edge=1e-6)
+    assert np.allclose(test, truth, atol=1e-5), "tiny voxel moments differ from exact ones"
+
+    approximate = mso.geometric_mso(query_set, search_space, 0, scales, moment_edge=0.03)
+    exact = mso.geometric_mso(query_set, search_space, 0, scales)
+    errors = mso.moment_count_error(query_set, search_space, 0, scales, 0.03)
+    volumes = np.array([1e6 * 4 / 3 * np.pi * scale ** 3 for scale in sorted(scales)[::-1]])
+    approximate_counts = np.rint(approximate[:, 1::4] * volumes)
+    exact_counts = np.rint(exact[:, 1::4] * volumes)
+    assert np.all(np.abs(approximate_counts - exact_counts)
+                  <= errors * np.maximum(approximate_counts, 1) + 0.5), "count error exceeds bound"
+
+    for options in [dict(scale_mode="knn"), dict(vertical=True)]:
+        try:
+            mso.geometric_mso(query_set, search_space, 0, [5], moment_edge=0.03, **options)
+        except ValueError:
+            continue
+        raise AssertionError("voxel moments accepted {}".format(options))
+
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    print("testing geometric mso")
+    test_geometric_mso()
+    print("geometric features match")
+    test_geometric_mso_voxel()
+    print("search space voxelized")
+    test_geometric_mso_plane()
+    print("planes are flat")
+    test_geometric_mso_extended()
+    print("extended features match")
+    test_geometric_mso_vertical()
+    print("vertical features match")
+    print("testing oriented and covariance mso")
+    test_oriented_covariance_mso()
+    print("oriented and covariance features match")
+    print("testing knn mso")
+    test_knn_mso()
+    print("knn features match")
+    print("testing vector mso")
+    test_vector_mso()
+    print("vector features match")
+    print("testing mso workers")
+    test_mso_workers()
+    print("pooled features match")
+    print("testing voxel moment mso")
+    test_moment_edge_mso()
+    print("voxel moment features within bounds")
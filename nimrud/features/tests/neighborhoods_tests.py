@@ -0,0 +1,166 @@
+# pylint: disable=E0401, E1101
+
+"""
+tests for the CSR neighborhood store
+"""
+
+import numpy as np
+
+from nimrud.features import neighborhoods
+
+SEED = 10
+np.random.seed(SEED)
+
+#---------------------------------------------------------------------------------------------------
+
+def test_radius_search():
+    """
+    rows should hold exactly the neighbors within the radius, sorted by distance
+    """
+
+    search_space = np.random.rand(2000, 3)
+    query_set = np.random.rand(200, 3)
+    radius = 0.2
+
+    nbhds = neighborhoods.Neighborhoods.radius_search(search_space, query_set, radius)
+    assert nbhds.num_rows == 200, "wrong number of rows"
+
+    for row, point in enumerate(query_set):
+        distances = np.linalg.norm(search_space - point, axis=1)
+        start, stop = nbhds.row_offsets[row], nbhds.row_offsets[row + 1]
+        assert np.array_equal(
+            np.sort(nbhds.neighbor_ids[start:stop]),
+            np.flatnonzero(distances < radius)), "row {} has the wrong neighbors".format(row)
+        assert np.all(np.diff(nbhds.distances[start:stop]) >= 0),\
+            "row {} isn't sorted by distance".format(row)
+        assert np.allclose(nbhds.distances[start:stop],
+                           distances.take(nbhds.neighbor_ids[start:stop])),\
+            "row {} has the wrong distances".format(row)
+
+#---------------------------------------------------------------------------------------------------
+
+def test_prefixes():
+    """
+    the prefix of each row at a smaller radius should be what a search at that radius finds
+    """
+
+    search_space = np.random.rand(2000, 3)
+    query_set = np.random.rand(200, 3)
+    nbhds = neighborhoods.Neighborhoods.radius_search(search_space, query_set, 0.3)
+
+    for radius in [0.3, 0.2, 0.05, 0.0]:
+        known = neighborhoods.Neighborhoods.radius_search(search_space, query_set, radius)
+        lengths = nbhds.prefix_lengths(radius)
+        assert np.array_equal(lengths, known.row_lengths),\
+            "wrong prefix lengths at radius {}".format(radius)
+        positions = nbhds.prefix_index(lengths)
+        assert np.array_equal(nbhds.distances.take(positions), known.distances),\
+            "wrong prefix positions at radius {}".format(radius)
+
+    # a radius landing exactly on stored distances has to exclude them
+    for radius in nbhds.distances[::97]:
+        lengths = nbhds.prefix_lengths(radius)
+        positions = nbhds.prefix_index(lengths)
+        assert np.all(nbhds.distances.take(positions) < radius), "kept a neighbor at the radius"
+        assert lengths.sum() == (nbhds.distances < radius).sum(), "dropped a neighbor"
+
+#---------------------------------------------------------------------------------------------------
+
+def test_knn_search():
+    """
+    rows should hold the k nearest neighbors sorted by distance, and shorter prefixes should be
+    the nearest fewer
+    """
+
+    search_space = np.random.rand(500, 3)
+    query_set = np.random.rand(50, 3)
+    nbhds = neighborhoods.Neighborhoods.knn_search(search_space, query_set, 8)
+    assert np.array_equal(nbhds.row_lengths, np.full(50, 8)), "wrong row lengths"
+
+    lengths = nbhds.nearest_lengths(3)
+    radii = nbhds.prefix_radii(lengths)
+    positions = nbhds.prefix_index(lengths)
+    for row, point in enumerate(query_set):
+        distances = np.linalg.norm(search_space - point, axis=1)
+        order = np.argsort(distances)
+        assert np.array_equal(nbhds.neighbor_ids[row * 8:(row + 1) * 8], order[:8]),\
+            "row {} has the wrong neighbors".format(row)
+        assert np.array_equal(nbhds.neighbor_ids.take(positions[row * 3:(row + 1) * 3]),
+                              order[:3]), "row {} has the wrong prefix".format(row)
+        assert np.isclose(radii[row], distances[order[2]]), "wrong prefix radius"
+
+    assert np.array_equal(nbhds.prefix_radii(np.zeros(50, dtype=int)), np.zeros(50)),\
+        "empty prefixes have a radius"
+    small = neighborhoods.Neighborhoods.knn_search(search_space[:5], query_set, 8)
+    assert np.array_equal(small.row_lengths, np.full(50, 5)), "didn't take the whole search space"
+    empty = neighborhoods.Neighborhoods.knn_search(search_space[:0], query_set, 8)
+    assert empty.num_rows == 50 and not empty.row_lengths.any(), "mishandled an empty search space"
+
+#---------------------------------------------------------------------------------------------------
+
+def test_ragged():
+    """
+    ragged neighborhoods should store only real neighbors, and reduce their active prefixes like
+    NBtensor reduces its pages
+    """
+
+    search_space = np.random.rand(2000, 3)
+    query_set = np.random.rand(100, 3)
+    nbhds = neighborhoods.RaggedNeighborhoods.from_neighborhoods(
+        neighborhoods.Neighborhoods.radius_search(search_space, query_set, 0.3),
+        search_space,
+        query_set)
+    assert nbhds.coordinates.shape == (nbhds.row_offsets[-1], 3), "stored padding"
+    assert nbhds.coordinates.dtype == np.float32, "stored the wrong precision"
+
+    for radius in [0.3, 0.1, 0.2]:
+        counts = nbhds.drop(radius)
+        displacement = nbhds.centroid_displacement()
+        scatter = nbhds.scatter_matrices()
+        for row, point in enumerate(query_set):
+            offsets = search_space - point
+            neighbors = offsets[np.linalg.norm(offsets, axis=1) < radius]
+            assert counts[row] == neighbors.shape[0], "dropped to the wrong count"
+            if neighbors.shape[0] == 0:
+                continue
+            centroid = neighbors.mean(0)
+            centered = neighbors - centroid
+            assert np.isclose(displacement[row], np.linalg.norm(centroid), atol=1e-6),\
+                "wrong centroid displacement at radius {}".format(radius)
+            assert np.allclose(scatter[row], centered.T.dot(centered), atol=1e-5),\
+                "wrong scatter matrix at radius {}".format(radius)
+
+#---------------------------------------------------------------------------------------------------
+
+def test_bad_offsets():
+    """
+    row offsets have to describe the neighbor arrays
+    """
+
+    ids = np.arange(5)
+    distances = np.arange(5.0)
+    for bad_offsets in [np.array([1, 5]), np.array([0, 3, 2, 5]), np.array([0, 4])]:
+        try:
+            neighborhoods.Neighborhoods(bad_offsets, ids, distances)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("accepted row offsets {}".format(bad_offsets))
+
+#---------------------------------------------------------------------------------------------------
+
+
+
+
+if __name__ == '__main__':
+    print("testing radius search")
+    test_radius_search()
+    print("neighbors found")
+    test_prefixes()
+    print("prefixes found")
+    test_knn_search()
+    print("nearest neighbors found")
+    test_ragged()
+    print("ragged neighborhoods reduced")
+    test_bad_offsets()
+    print("bad offsets rejected")
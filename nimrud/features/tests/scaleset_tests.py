@@ -0,0 +1,117 @@
+# pylint: disable=E0401, E1101
+
+"""
+tests for the scaleset executor
+"""
+
+import numpy as np
+
+from nimrud.features import mso, scaleset
+from nimrud.utils.geometry import VoxelFilter
+
+SEED = 10
+np.random.seed(SEED)
+
+#---------------------------------------------------------------------------------------------------
+
+def separate_runs(operator, query_set, search_space, scales_by_edge, **options):
+    """
+    the scaleset's features the slow way, with one operator run per tuple
+    """
+
+    return np.hstack([np.arange(query_set.shape[0]).reshape(-1, 1)] + [
+        operator(query_set, search_space, edge, scales, **options)[:, 1:]
+        for edge, scales in scales_by_edge])
+
+#---------------------------------------------------------------------------------------------------
+
+def test_voxel_pyramid():
+    """
+    every level of the pyramid should hold the voxels of the full cloud, whether it was built
+    from a finer level (odd edge ratios) or not
+    """
+
+    points = np.random.rand(5000, 3) * [4, 4, 2]
+    edges = [0.3, 0, 0.1, 0.2, 0.05]
+    levels = scaleset.voxel_pyramid(points, edges)
+
+    assert levels[1] is points, "an edge of 0 should leave the points alone"
+    for edge, level in zip(edges, levels):
+        if not edge:
+            continue
+        known = VoxelFilter(points, edge).unique_voxels(points)
+        assert level.shape == known.shape, "wrong number of voxels at edge {}".format(edge)
+        assert np.allclose(level, known, atol=1e-9, rtol=0),\
+            "wrong voxels at edge {}".format(edge)
+    assert scaleset._odd_multiple(0.3, 0.1) and not scaleset._odd_multiple(0.2, 0.1),\
+        "wrong edge ratios"
+
+    # every point of a nested level sits in the parent voxel it's grouped under
+    edges = sorted(set(edges))
+    levels = scaleset.voxel_pyramid(points, edges)
+    parents = scaleset.pyramid_parents(points, edges, levels)
+    assert [nested and nested[0] for nested in parents] == [1, None, 4, None, None],\
+        "wrong nesting"
+    for edge, level, nested in zip(edges, levels, parents):
+        if nested is None:
+            continue
+        parent, child_offsets, child_ids, reach = nested
+        grid = VoxelFilter(points, edges[parent])
+        voxels = np.repeat(np.arange(levels[parent].shape[0]), np.diff(child_offsets))
+        assert np.array_equal(np.sort(child_ids), np.arange(level.shape[0])),\
+            "lost points at edge {}".format(edge)
+        assert np.array_equal(grid.coordinate_to_address(level[child_ids]),
+                              grid.coordinate_to_address(levels[parent][voxels])),\
+            "wrong parents at edge {}".format(edge)
+        assert reach <= edges[parent] * np.sqrt(3) / 2 + 1e-6, "reach is too far"
+
+#---------------------------------------------------------------------------------------------------
+
+def test_scaleset_mso():
+    """
+    one scaleset run should match the separate runs of its tuples, including tuples sharing a
+    voxel edge and a scale, and levels that don't nest in the coarsest one
+    """
+
+    search_space = np.random.rand(3000, 3) * [3, 3, 1]
+    query_set = search_space[::10]
+    tuples = [(0.15, [0.6, 0.45]), (0.1, [0.4]), (0.05, [0.3, 0.25]), (0.05, [0.25]),
+              (0, [0.2, 0.1])]
+
+    test = scaleset.scaleset_mso(query_set, search_space, tuples, max_chunk=70, extended=True)
+    known = separate_runs(mso.geometric_mso, query_set, search_space, tuples, max_chunk=70,
+                          extended=True)
+    assert test.shape == known.shape and test.dtype == np.float32, "wrong output layout"
+    assert np.allclose(test, known, atol=1e-5), "geometric scaleset disagrees with separate runs"
+
+    test = scaleset.scaleset_mso(query_set, search_space, tuples, "covariance", max_chunk=70,
+                                 workers=2)
+    known = separate_runs(mso.covariance_mso, query_set, search_space, tuples, max_chunk=70)
+    assert np.allclose(test, known, atol=1e-5), "covariance scaleset disagrees with separate runs"
+
+    test = scaleset.scaleset_mso(query_set, search_space, tuples[2:], "oriented", max_chunk=70)
+    known = separate_runs(mso.oriented_mso, query_set, search_space, tuples[2:], max_chunk=70)
+    assert np.allclose(np.abs(test), np.abs(known), atol=1e-5),\
+        "oriented scaleset disagrees with separate runs"
+
+    knn_tuples = [(0.05, [30, 20]), (0, [10])]
+    test = scaleset.scaleset_mso(query_set, search_space, knn_tuples, scale_mode="knn")
+    known = separate_runs(mso.geometric_mso, query_set, search_space, knn_tuples,
+                          scale_mode="knn")
+    assert np.allclose(test, known, atol=1e-5), "knn scaleset disagrees with separate runs"
+
+    try:
+        scaleset.scaleset_mso(query_set, search_space, tuples, "oriented", vertical=True)
+        assert False, "accepted vertical features for the oriented operator"
+    except ValueError:
+        pass
+
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    print("testing voxel pyramid")
+    test_voxel_pyramid()
+    print("pyramid levels match")
+    print("testing scaleset mso")
+    test_scaleset_mso()
+    print("scaleset features match")
@@ -0,0 +1,77 @@
+# pylint: disable=E0401, E1101
+
+"""
+tests for the vertical profile features
+"""
+
+import numpy as np
+
+from nimrud.features import neighborhoods, vertical
+
+SEED = 10
+np.random.seed(SEED)
+
+#---------------------------------------------------------------------------------------------------
+
+def brute_force_vertical(offsets):
+    """
+    the vertical features of one neighborhood, given its offsets from the query point
+    """
+
+    if offsets.shape[0] == 0:
+        return np.zeros(len(vertical.VERTICAL_FEATURES))
+    heights = offsets[:, 2]
+    biggest = heights[np.argmax(np.abs(heights))]
+    return np.array([
+        biggest,
+        heights.max() - heights.min(),
+        heights.std(),
+        -heights.min(),
+        (heights > 0).sum(),
+        (heights < 0).sum()])
+
+#---------------------------------------------------------------------------------------------------
+
+def test_vertical_profile():
+    """
+    the running statistics should match each neighborhood reduced on its own at every scale,
+    including empty neighborhoods and both scale modes
+    """
+
+    search_space = np.random.rand(3000, 3)
+    # repeated heights make sure ties rank properly
+    search_space[::7, 2] = 0.5
+    query_set = np.vstack((np.random.rand(120, 3), [[5, 5, 5]]))
+    nbhds = neighborhoods.RaggedNeighborhoods.from_neighborhoods(
+        neighborhoods.Neighborhoods.radius_search(search_space, query_set, 0.3),
+        search_space,
+        query_set,
+        dtype=np.float64)
+    profile = vertical.VerticalProfile(nbhds)
+
+    for radius in [0.3, 0.05, 0.2]:
+        profile.drop(radius)
+        features = profile.vertical_features()
+        assert features.shape == (121, len(vertical.VERTICAL_FEATURES)), "wrong layout"
+        for row, point in enumerate(query_set):
+            offsets = search_space - point
+            known = brute_force_vertical(offsets[np.linalg.norm(offsets, axis=1) < radius])
+            # the std comes from prefix sums of z and z^2, so it only keeps about half the digits
+            assert np.allclose(features[row], known, atol=1e-6),\
+                "wrong features at radius {}".format(radius)
+        assert np.array_equal(profile.sazo(), features[:, 0]), "sazo disagrees"
+
+    profile.keep_nearest(5)
+    lowest, highest = profile.extremes()
+    known = np.array([
+        [nbhds.coordinates[start:start + length, 2].min(),
+         nbhds.coordinates[start:start + length, 2].max()] if length else [0, 0]
+        for start, length in zip(nbhds.row_offsets[:-1], np.minimum(nbhds.row_lengths, 5))])
+    assert np.array_equal(np.column_stack((lowest, highest)), known), "wrong knn extremes"
+
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    print("testing vertical profiles")
+    test_vertical_profile()
+    print("vertical features match")
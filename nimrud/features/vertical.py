@@ -0,0 +1,143 @@
+# pylint: disable=E0401, E1101
+
+"""
+implements VerticalProfile, running z statistics of distance-sorted neighborhoods: the signed
+maximum z offset (SAZO), z range, z standard deviation, height above the neighborhood minimum and
+the numbers of points above and below the query point.
+
+like PrefixMoments, everything is accumulated once per neighborhood over the flat CSR order of a
+RaggedNeighborhoods, so each further scale costs a lookup per row. sums are prefix sums, and the
+running maxima and minima are segmented scans: each z value is replaced by its rank among all the
+z values, offset by its row so that a single maximum.accumulate over the whole store never carries
+a value from one row into the next.
+"""
+
+import numpy as np
+
+
+# the vertical features, in the order vertical_features returns them
+VERTICAL_FEATURES = [
+    "sazo",
+    "z_range",
+    "z_std",
+    "height_above_minimum",
+    "points_above",
+    "points_below"]
+
+#---------------------------------------------------------------------------------------------------
+
+class VerticalProfile(object):
+    """
+    running z statistics over a RaggedNeighborhoods, whose coordinates are relative to their
+    query points. it is used like PrefixMoments: drop to a radius (or keep the nearest k), then
+    ask for the statistics of the active prefixes.
+    """
+
+    def __init__(self, neighborhoods):
+
+        self.neighborhoods = neighborhoods
+        self.num_rows = neighborhoods.num_rows
+        self.active_lengths = neighborhoods.row_lengths.copy()
+
+        heights = neighborhoods.coordinates[:, 2].astype(np.float64)
+        num_neighbors = heights.size
+        # a leading row of zeros makes the sum over entries [start, stop) sum[stop] - sum[start]
+        self._sums = np.zeros((num_neighbors + 1, 4))
+        np.cumsum(
+            np.column_stack((heights, heights * heights, heights > 0, heights < 0)),
+            axis=0, out=self._sums[1:])
+
+        # rank every height, then push each row's ranks above all the previous rows' ranks. a
+        # running maximum of the ranks is then the running maximum within each row, and a running
+        # maximum of the reversed ranks is the running minimum, exactly.
+        self._sorted = np.sort(heights)
+        ranks = np.searchsorted(self._sorted, heights)
+        offsets = neighborhoods.row_ids() * num_neighbors
+        self._highest = np.maximum.accumulate(offsets + ranks) - offsets
+        reversed_ranks = num_neighbors - 1 - ranks
+        self._lowest = num_neighbors - 1 -\
+            (np.maximum.accumulate(offsets + reversed_ranks) - offsets)
+
+    #==================================
+
+    def drop(self, radius):
+        """
+        shrink the active neighborhoods to the neighbors strictly within radius, and return the
+        number of neighbors left in each row
+        """
+
+        self.active_lengths = self.neighborhoods.prefix_lengths(radius)
+        return self.active_lengths
+
+    #==================================
+
+    def keep_nearest(self, k):
+        """
+        shrink the active neighborhoods to their k nearest neighbors, and return the number of
+        neighbors left in each row
+        """
+
+        self.active_lengths = self.neighborhoods.nearest_lengths(k)
+        return self.active_lengths
+
+    #==================================
+
+    def extremes(self):
+        """
+        lowest and highest z offset from the query point in each active neighborhood. empty
+        neighborhoods get 0 for both.
+        """
+
+        last = self.neighborhoods.row_offsets[:-1] + self.active_lengths - 1
+        empty = self.active_lengths == 0
+        if self._sorted.size == 0:
+            return np.zeros(self.num_rows), np.zeros(self.num_rows)
+        lowest = self._sorted.take(self._lowest.take(last, mode="clip"))
+        highest = self._sorted.take(self._highest.take(last, mode="clip"))
+        lowest[empty] = 0
+        highest[empty] = 0
+        return lowest, highest
+
+    #==================================
+
+    def sazo(self):
+        """
+        signed maximum z offset: the z offset from the query point with the largest magnitude in
+        each active neighborhood, with its sign. this is what NBtensor.SAZO returns.
+        """
+
+        lowest, highest = self.extremes()
+        return np.where(highest >= -lowest, highest, lowest)
+
+    #==================================
+
+    def vertical_features(self):
+        """
+        (num_rows, len(VERTICAL_FEATURES)) array of the vertical features of each active
+        neighborhood:
+            sazo: signed maximum z offset from the query point
+            z range: highest minus lowest z
+            z std: population standard deviation of z
+            height above minimum: height of the query point above the lowest neighbor
+            points above: number of neighbors higher than the query point
+            points below: number of neighbors lower than the query point
+        empty neighborhoods get 0 for all of them.
+        """
+
+        starts = self.neighborhoods.row_offsets[:-1]
+        sums = self._sums.take(starts + self.active_lengths, axis=0) -\
+            self._sums.take(starts, axis=0)
+        counts = np.maximum(self.active_lengths, 1)
+        means = sums[:, 0] / counts
+        variances = np.maximum(sums[:, 1] / counts - means * means, 0)
+        # with fewer than two neighbors the difference is pure round off
+        variances[self.active_lengths < 2] = 0
+        lowest, highest = self.extremes()
+
+        return np.column_stack((
+            np.where(highest >= -lowest, highest, lowest),
+            highest - lowest,
+            np.sqrt(variances),
+            -lowest,
+            sums[:, 2],
+            sums[:, 3]))
@@ -5,26 +5,33 @@ import numpy
 import os
 import shutil
 import mso 
-import ch
 import time
 import pickle
-import matplotlib.pyplot as plt
-from scipy.interpolate import spline
-import pycuda.gpuarray as gpua
-import pycuda.driver as cuda
 import gc
 import ml
-from sklearn import svm
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.ensemble import ExtraTreesClassifier
-from sklearn.ensemble import RandomTreesEmbedding
-from sklearn.neural_network import BernoulliRBM
-from sklearn.naive_bayes import BernoulliNB
-from sklearn.linear_model import SGDClassifier
-from sklearn.kernel_approximation import (RBFSampler,Nystroem)
-from sklearn.decomposition import FactorAnalysis as FA
-from sklearn import preprocessing
-from sklearn import manifold
+from nimrud.utils.buffers import OutputBuffer
+from nimrud.utils.lazy import lazy_import, lazy_from
+
+# heavy dependencies are only loaded once something here uses them, so short
+# jobs (merge, chop, label export) start quickly and don't need a CUDA driver.
+ch=lazy_import('ch')
+plt=lazy_import('matplotlib.pyplot')
+spline=lazy_from('scipy.interpolate','spline')
+gpua=lazy_import('pycuda.gpuarray')
+cuda=lazy_import('pycuda.driver')
+svm=lazy_import('sklearn.svm')
+RandomForestClassifier=lazy_from('sklearn.ensemble','RandomForestClassifier')
+ExtraTreesClassifier=lazy_from('sklearn.ensemble','ExtraTreesClassifier')
+RandomTreesEmbedding=lazy_from('sklearn.ensemble','RandomTreesEmbedding')
+BernoulliRBM=lazy_from('sklearn.neural_network','BernoulliRBM')
+BernoulliNB=lazy_from('sklearn.naive_bayes','BernoulliNB')
+SGDClassifier=lazy_from('sklearn.linear_model','SGDClassifier')
+RBFSampler=lazy_from('sklearn.kernel_approximation','RBFSampler')
+Nystroem=lazy_from('sklearn.kernel_approximation','Nystroem')
+FA=lazy_from('sklearn.decomposition','FactorAnalysis')
+preprocessing=lazy_import('sklearn.preprocessing')
+manifold=lazy_import('sklearn.manifold')
+scaleset_mso=lazy_from('nimrud.features.scaleset','scaleset_mso')
 
 #-------------------------------------------------------------------------------
 
@@ -49,51 +56,41 @@ def quick_builder(fnames,indir,aname,ext,delimiter,fcols):
     # saves a new label apc
     
     
-    # start the point cloud
-    inc = numpy.zeros((0,3))
-    
-    # start the label sets
-    elabels = numpy.zeros(0)
-    plabels = numpy.zeros(0)
-    
-    # start the feature sets
-    efeats = numpy.zeros((0,fcols))
-    pfeats = numpy.zeros((0,fcols))
-    
-    # start the index sets
-    eidx = numpy.zeros(0,dtype=numpy.uint32)
-    pidx = numpy.zeros(0,dtype=numpy.uint32)
+    # collect the pieces in lists and concatenate once at the end. stacking
+    # inside the loop copies everything loaded so far on each file, which is
+    # quadratic in the number of files.
+    incs = []
+    elabels = []
+    efeats = []
+    eidx = []
+    npoints = 0     # number of points collected so far
     
     # load loop
     for labelset in fnames:
-        qse=numpy.zeros((0,3+fcols))
-        ssp=qse.copy()
         # acquire qse and ssp for this class
-        for name in labelset[1]:
-            qse=numpy.vstack((qse,numpy.genfromtxt(indir+name+ext,delimiter=delimiter)))
-        for name in labelset[2]:
-            ssp=numpy.vstack((ssp,numpy.genfromtxt(indir+name+ext,delimiter=delimiter)))
-        # build up labels
-        qselabs=numpy.zeros(qse.shape[0])+labelset[0]
-        ssplabs=numpy.zeros(ssp.shape[0])+ssplabnum
-        # build up indices
-        qseidx=numpy.arange(qse.shape[0])
-        sspidx=numpy.arange(ssp.shape[0])
-        
-        # put qse in inc
-        qseidx+=inc.shape[0]
-        inc=numpy.vstack((inc,qse[:,:3]))
-        # and store its features, labels and indices
-        elabels=numpy.hstack((elabels,qselabs))
-        efeats=numpy.vstack((efeats,qse[:,3:]))
-        eidx=numpy.hstack((eidx,qseidx))
+        qse=[numpy.genfromtxt(indir+name+ext,delimiter=delimiter) for name in labelset[1]]
+        ssp=[numpy.genfromtxt(indir+name+ext,delimiter=delimiter) for name in labelset[2]]
+        qse=numpy.vstack([numpy.zeros((0,3+fcols))]+qse)
+        ssp=numpy.vstack([numpy.zeros((0,3+fcols))]+ssp)
+        
+        # put qse in inc, and store its features, labels and indices
+        incs.append(qse[:,:3])
+        elabels.append(numpy.zeros(qse.shape[0])+labelset[0])
+        efeats.append(qse[:,3:])
+        eidx.append(numpy.arange(qse.shape[0])+npoints)
+        npoints+=qse.shape[0]
         
         # and now for ssp
-        sspidx+=inc.shape[0]
-        inc=numpy.vstack((inc,ssp[:,:3]))
-        elabels=numpy.hstack((elabels,ssplabs))
-        efeats=numpy.vstack((efeats,ssp[:,3:]))
-        eidx=numpy.hstack((eidx,sspidx))
+        incs.append(ssp[:,:3])
+        elabels.append(numpy.zeros(ssp.shape[0])+ssplabnum)
+        efeats.append(ssp[:,3:])
+        eidx.append(numpy.arange(ssp.shape[0])+npoints)
+        npoints+=ssp.shape[0]
+    
+    inc = numpy.concatenate([numpy.zeros((0,3))]+incs)
+    elabels = numpy.concatenate([numpy.zeros(0)]+elabels)
+    efeats = numpy.concatenate([numpy.zeros((0,fcols))]+efeats)
+    eidx = numpy.concatenate([numpy.zeros(0,dtype=numpy.uint32)]+eidx).astype(numpy.uint32)
             
     # make an APC
     apc=APC(inc,0,aname)
@@ -494,7 +491,7 @@ def dainty_loader(filename):
                 
 #-------------------------------------------------------------------------------    
 
-def gmso_APC(apcname, scaleset):
+def gmso_APC(apcname, scaleset, cache=None, workers=1):
     # g mills 17/10/14
     # build multiscale geometric features for the point cloud, or a subset
     # thereof.  
@@ -516,13 +513,16 @@ def gmso_APC(apcname, scaleset):
     #   (next biggest vox, array[next biggest scale after first set...])]
     # ...
     #   ( smallest vox, array[small scale... smallest scale]) ]
+    # cache = nimrud.utils.cache.FeatureCache (or True for the default one) 
+            # that the MSOs look up and store their results in. None skips it.
+    # workers = number of CPU processes the scaleset executor runs the
+            # query set chunks in. above 1, they share a process pool.
     
     # PARAMETERS
     apc_dir='APC/'
     minpoints=100       # minimum number of points in a metapartition
     budget=1700000000   # space (bytes) needed on the GPU for G_MSO
     ssplabelnum=999     # this label means a point is unlabeled. 
-    imax=13000          # maximum size of a partition in G_MSO function
     
     # OUTPUT
     # saves features and their indices in the point cloud to *apc*'s dictionary
@@ -564,12 +564,9 @@ def gmso_APC(apcname, scaleset):
     # calculate size of the features
     fsize=sum([len(x[1]) for x in scaleset])*4
             
-    # initialize output
-    feats=numpy.zeros((0,fsize+1))
-    if isinstance(labels,numpy.ndarray):
-        outlabels=numpy.zeros(0)
-    else:
-        outlabels=0
+    # initialize output: a row for every point in the cloud, written by point
+    # index and kept on disk until we know which rows we filled
+    feats=OutputBuffer(apc.inc.shape[0],fsize+1,dtype=numpy.float64,directory=apc_dir)
         
     # get the largest scale
     smax = scaleset[0][1][0]
@@ -624,52 +621,41 @@ def gmso_APC(apcname, scaleset):
             ssp=apc.inc.take(sspidx,axis=0)
             qse=apc.inc.take(qseidx,axis=0)
         
-            # build output vector holding array
+            # build output vector holding array, and track which of its rows
+            # get features
             ovh=numpy.zeros((qse.shape[0],fsize+1))
-            rrl=numpy.zeros(qse.shape[0])
-            
-            # index holder for the starting write column of output block
-            dc=1
+            filled=numpy.zeros(qse.shape[0],dtype=bool)
             
             # clear the GPU if we decided the point cloud it holds is too big
             if shuffler:
                 apc.gpu_inc_purge()
             print("processing "+str(qse.shape[0])+" query set points")
             
-            # loop over scale/ voxel edge combinations to fill holding array
-            for s in scaleset:
-                # get the scales and voxel edge length to use
-                vxl=s[0]
-                sc=s[1]
-                ss=sc.size  # num scales being processed in this instance
-            
-                # build features
-                oc=mso.G_MSO(qse,ssp,vxl,sc,imax=imax)
-        
-                # split off the indices (int type needed)
-                oci=numpy.int64(oc[:,0])
-        
-                # slot in the features-- scale-major now
-                ovh[oci,dc:dc+ss*4] = oc[:,1:]
-        
-                # now slot in the indices we built features for: if a point gets
-                # a feature from at least one pass in g_mso it will be
-                # represented in the index set. use the qse index set to map
-                # the given indices back to the original point cloud
-                ovh[oci,0]=qseidx.take(oci)
-                if isinstance(labels,numpy.ndarray):
-                    rrl[oci]=relabels.take(qseidx.take(oci))
-            
-                dc+=ss*4        # update starting index
-        
-            # stack to output
-            feats=numpy.vstack((feats,ovh))
-            if isinstance(labels,numpy.ndarray):
-                outlabels=numpy.hstack((outlabels,rrl))     
+            # the scaleset executor partitions the query set once, searches
+            # each chunk once at the largest buffer and reuses those
+            # neighborhoods at every voxel edge. features come out laid out
+            # scale-major, one tuple after another.
+            oc=scaleset_mso(qse,ssp,scaleset,workers=workers,cache=cache)
+            oci=numpy.int64(oc[:,0])
+            ovh[oci,1:]=oc[:,1:]
+            ovh[oci,0]=qseidx.take(oci)
+            filled[oci]=True
+        
+            # write the points that got features to their rows of the output
+            feats.write(qseidx.compress(filled),ovh.compress(filled,axis=0))
             
     # clean up the gpu
     apc.gpu_inc_purge()
     
+    # keep the rows we filled, in point cloud order, and look up their labels
+    rows=feats.filled_rows()
+    feats.close()
+    feats=rows
+    if isinstance(labels,numpy.ndarray):
+        outlabels=relabels.take(feats[:,0].astype(numpy.int64))
+    else:
+        outlabels=0
+    
     num=feats.shape[0]
     outime=time.clock()-outime
     rate=num/outime
@@ -2164,7 +2150,7 @@ def collapse(apcname):
     
 #-------------------------------------------------------------------------------                
 
-def ogmso_APC(apcname, scaleset):
+def ogmso_APC(apcname, scaleset, cache=None, workers=1):
     # g mills 24/8/15
     # build oriented geometric multiscale features for the point cloud, or a
     # subset thereof.
@@ -2179,6 +2165,10 @@ def ogmso_APC(apcname, scaleset):
     #   (next biggest vox, array[next biggest scale after first set...])]
     # ...
     #   ( smallest vox, array[small scale... smallest scale]) ]
+    # cache = nimrud.utils.cache.FeatureCache (or True for the default one) 
+            # that the MSOs look up and store their results in. None skips it.
+    # workers = number of CPU processes the scaleset executor runs the
+            # query set chunks in. above 1, they share a process pool.
     
     # PARAMETERS
     apc_dir='APC/'
@@ -2186,7 +2176,6 @@ def ogmso_APC(apcname, scaleset):
     budget=1700000000   # space (bytes) needed on the GPU for OG_MSO
     ssplabelnum=999     # this label means a point is unlabeled. makes sense.
     outwidth=8          # 8 for gmso + eigvecs
-    imax = 14000        # max partition size in ogmso
     
     # OUTPUT
     # saves features and their indices in the point cloud to *apc*'s dictionary
@@ -2297,42 +2286,21 @@ def ogmso_APC(apcname, scaleset):
             ovh=numpy.zeros((qse.shape[0],fsize+1))
             rrl=numpy.zeros(qse.shape[0])
             
-            # holder to first write index in output block
-            dc=1
-            
             # clear the GPU if we decided the point cloud it holds is too big
             if shuffler:
                 apc.gpu_inc_purge()
             print("processing "+str(qse.shape[0])+" query set points")
-            # loop over scale/ voxel edge combinations to fill holding array
-            for s in scaleset:
-                # get the scales and voxel edge length to use
-                vxl=s[0]
-                sc=s[1]
-                ss=sc.size
-            
-                # build features
-                if cov_switch:
-                    oc=mso.C_MSO(qse,ssp,vxl,sc,imax=imax)
-                else:
-                    oc=mso.OG_MSO(qse,ssp,vxl,sc,imax=imax)
-        
-                # split off the indices (int type needed)
-                oci=numpy.int64(oc[:,0])
-        
-                # slot in the features in scale-major order
-                ovh[oci,dc:dc+ss*outwidth] = oc[:,1:]
-                
-                # now slot in the indices we built features for: if a point
-                # gets a feature from at least one pass in og_mso it will be
-                # represented in the index set. 
-                # use the qse index set to map the given indices back to the
-                # original point cloud.
-                ovh[oci,0]=qseidx.take(oci)
-                if isinstance(labels,numpy.ndarray):
-                    rrl[oci]=relabels.take(qseidx.take(oci))
-            
-                dc+=ss*outwidth     # update starting index
+            # the scaleset executor partitions the query set once, searches
+            # each chunk once at the largest buffer and reuses those
+            # neighborhoods at every voxel edge. features come out laid out
+            # scale-major, one tuple after another.
+            operator='covariance' if cov_switch else 'oriented'
+            oc=scaleset_mso(qse,ssp,scaleset,operator,workers=workers,cache=cache)
+            oci=numpy.int64(oc[:,0])
+            ovh[oci,1:]=oc[:,1:]
+            ovh[oci,0]=qseidx.take(oci)
+            if isinstance(labels,numpy.ndarray):
+                rrl[oci]=relabels.take(qseidx.take(oci))
         
             # stack to output
             feats=numpy.vstack((feats,ovh))
@@ -2354,7 +2322,7 @@ def ogmso_APC(apcname, scaleset):
 
 #-------------------------------------------------------------------------------                
 
-def vmso_APC(apcname, skip, scaleset):
+def vmso_APC(apcname, skip, scaleset, cache=None):
     # g mills 13/12/14
     # build multiscale vector features for the point cloud, or a subset thereof.
     
@@ -2369,6 +2337,8 @@ def vmso_APC(apcname, skip, scaleset):
     #   (next biggest vox, array[next biggest scale after first set...])]
     # ...
     #   ( smallest vox, array[small scale... smallest scale]) ]
+    # cache = nimrud.utils.cache.FeatureCache (or True for the default one) 
+            # that the MSOs look up and store their results in. None skips it.
     
     # PARAMETERS
     apc_dir='APC/'
@@ -2495,7 +2465,7 @@ def vmso_APC(apcname, skip, scaleset):
                 ss=sc.size
     
                 # build features
-                oc=mso.V_MSO(qse,mapidx,ssp,sspvec,vxl,sc,imax=imax)
+                oc=mso.V_MSO(qse,mapidx,ssp,sspvec,vxl,sc,imax=imax,cache=cache)
         
                 # split off the indices (int type needed)
                 oci=oc[:,0].astype(numpy.int64)
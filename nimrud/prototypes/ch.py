@@ -265,160 +265,6 @@ def make_dmat(qse,ssp,measure):
 
 
 
-#-------------------------------------------------------------------------------
-
-def vox_vf_interp(ssp,sspfeats,qse,thresh,measure):
-	# g mills 11/10/14	
-	# use distance mat kernels to do a basic interpolation of a point cloud
-	# vector field to its voxelized representation. just use the mean of all
-	# the points in range.
-	
-	# INPUT
-	# gpuarrays all
-	# ssp = search space
-	# sspfeats = features corresponding to search space
-	# qse = query set to receive new features
-	# thresh = mean-taking distance
-	# measure = 'euclid' or 'cheby'. exactly what it is.
-	
-	# PARAMETERS
-	qserows=numpy.uint32(qse.shape[0])
-	ssprows=numpy.uint32(ssp.shape[0])
-	featrows=numpy.uint32(sspfeats.shape[0])
-	blockx=int(32)	# update static shared allocations in kernel if you change 
-	blocky=int(4)	# also update static shared allocations for this
-	blockz=int(1)	# pattern depends on this being 1
-	gridx=int(1)	# pattern depends on this being 1
-	gridy=int(numpy.ceil(qserows/blocky))
-	gridz=int(featrows)
-	thresh=numpy.float32(thresh)
-	
-	# OUTPUT
-	# new feature vectors for the voxel representation
-	qsefeats = gpuarray.zeros((qserows,featrows),dtype=numpy.float32)	
-	
-	
-	mod=SourceModule("""
-	
-	__global__ void dmat_mean_blind(float *dmat, float *feats, float *acc, float thresh, int qserows, int ssprows, int featrows)
-	{
-		// this version is for interpolating a vector field point cloud over its voxel 
-		// representation, and is not concerned with returning the number of neighboring 
-		// observations.
-		
-		// in this case the search space is the original point cloud and the query set is the
-		// voxelized representation of it-- the search space we'll use later.
-		
-		// calculates mean feature vectors for each point in the query set. tiles over distance
-		// and feat matrices in search space direction (x), and if a thread finds the distance 
-		// it reads from *dmat* is less than *thresh*, it adds that value to its accumulator in
-		// shared memory. last thread in the x dim sums over shared and writes to *acc*. only 
-		// one block in the x dim. 
-		
-				
-		// thread coords
-		int tx = threadIdx.x;							// tiles ssp
-		int ty = blockIdx.y*blockDim.y+threadIdx.y;		// spans qse
-		int tz = blockIdx.z;							// spans feats
-		
-		// shared memory declaration- block level accumulator-- assuming 32x, 4y yields 128
-		__shared__ float bacc[128];
-		
-		// block level counter-- 32x, 4y yields 128 (only used if blockIdx.z==num feats)
-		__shared__ float bcount[128];		
-		
-		// shared accumulator write position
-		int saw = threadIdx.y*blockDim.x+threadIdx.x;
-		
-		// shared counter write position
-		int scw = threadIdx.y*blockDim.x+threadIdx.x;
-		
-		// let's go ahead and initialize those shared arrays to zero just to be safe.
-		bacc[saw]=0.f;
-		bcount[scw]=0.f;
-		
-		// global accumulator write position
-		int gaw = ty*featrows+tz;
-		
-		// thread read condition (qse only, since we re-evaluate ssp condition on each tile)
-		int rc = 0;
-		if (ty < qserows) {rc=1;}
-				
-		// accumulator write condition
-		int ac = 0;
-		if (tx == blockDim.x-1) {ac=1;}		
-				
-		// *dmat* read position-- add tile offset in tile loop
-		int dr = ty*ssprows+tx;
-		
-		// *feats* read position-- again, tile offset (z dim check not needed)
-		int fr = tz*ssprows+tx;
-		
-		// tile over ssp dim
-		for (int i=0; i<ssprows; i+=blockDim.x)
-		{
-			// check we haven't overshot the edge of *dmat*
-			if ( (tx+i<ssprows) && (rc==1) )
-			{
-				// load this distance from *dmat* and compare to *thresh*
-				if (dmat[dr+i]<thresh)
-				{
-					// throw the feature value on the block accumulator
-					bacc[saw]=__fadd_rn(feats[fr+i],bacc[saw]);
-					
-					// increment the block counter-- probably faster not to check if this thread
-					// is in a position to ever use this value and just do it anyway.
-					bcount[scw]=__fadd_rn(bcount[scw],1.f);
-				}
-			}
-		}
-		
-		// synchronize before we sum up and write to *acc* and *cmat*
-		__syncthreads();
-		
-		
-		// block accumulator sum
-		float featsum=0.f;
-		// block counter sum
-		float csum=0.f;		
-		
-		// sum over the block accumulator and get the mean
-		if (ac==1)
-		{
-						
-			// shared sum position
-			int bp=threadIdx.y*blockDim.x;
-			
-			// sum over the block accumulator and counter arrays
-			for (int j=0; j<blockDim.x; j++)
-			{
-				featsum=__fadd_rn(bacc[bp+j],featsum);
-				csum=__fadd_rn(bcount[bp+j],csum);
-			}
-			
-			// write the mean to the global accumulator
-			acc[gaw]=__fdiv_rn(featsum,(csum+0.0000000001f));
-		}
-				
-	}
-	
-	
-	
-	""")
-
-	func=mod.get_function('dmat_mean_blind')
-	
-	# build the appropriate distance matrix
-	dmat=make_dmat(qse,ssp,measure)
-	
-	# use the distance matrix to interpolate the vector field observations
-	func(dmat,sspfeats,qsefeats,thresh,qserows,ssprows,featrows,block=(blockx,blocky,blockz),grid=(gridx,gridy,gridz))
-
-	return qsefeats
-
-
-
-
 #-------------------------------------------------------------------------------
 
 def rule_threshold(inc, rule):
@@ -550,8 +396,10 @@ def PT_cov(a,cents,irows):
 		// row index in *a* for clarity, modified each pass
 		int ta;
 
-		// sum to be written to *c*
-		float csum = 0.f;
+		// sum to be written to *c*. the points are stored in single precision
+		// but accumulated in double, so long neighborhoods don't lose the
+		// small eigenvalues to round off
+		double csum = 0.0;
 
 		// stopping point for looping over the page
 		int stopping=irows[tz];
@@ -589,14 +437,14 @@ def PT_cov(a,cents,irows):
 
 			// transpose, multiply, add to the sum. nested intrinsics in place
 			// of a loop.
-			csum=__fmaf_rn(smat[tx],smat[ty],csum);
-			csum=__fmaf_rn(smat[tx+3],smat[ty+3],csum);
-			csum=__fmaf_rn(smat[tx+6],smat[ty+6],csum);
+			csum=__fma_rn((double)smat[tx],(double)smat[ty],csum);
+			csum=__fma_rn((double)smat[tx+3],(double)smat[ty+3],csum);
+			csum=__fma_rn((double)smat[tx+6],(double)smat[ty+6],csum);
 
 		}
 
 		// write to *c*
-		c[wi]=csum;
+		c[wi]=(float)csum;
 
 	}
 
@@ -662,10 +510,10 @@ def PTcentroid(gnb,irows):
 		int iro = ipo+ty*3*dom;		// read *inc*
 		int aro = apo+ty*3;			// write *acc*
 
-		// local accumulators
-		float x = 0.f;
-		float y = 0.f;
-		float z = 0.f;
+		// local accumulators, in double precision like PT_cov's
+		double x = 0.0;
+		double y = 0.0;
+		double z = 0.0;
 
 		// number of interesting rows
 		int ir=irows[tx];
@@ -684,9 +532,9 @@ def PTcentroid(gnb,irows):
 				}
 			}
 			// write to the big accumulator
-			acc[aro]=x;
-			acc[aro+1]=y;
-			acc[aro+2]=z;
+			acc[aro]=(float)x;
+			acc[aro+1]=(float)y;
+			acc[aro+2]=(float)z;
 		}
 
 		__syncthreads();
@@ -695,9 +543,9 @@ def PTcentroid(gnb,irows):
 		if (ty==0)
 		{
 			// reset accumulators
-			x=0.f;
-			y=0.f;
-			z=0.f;
+			x=0.0;
+			y=0.0;
+			z=0.0;
 
 			// loop over the interesting part of the page in *acc*
 			for (int f=0; f<arows; f++)
@@ -708,9 +556,9 @@ def PTcentroid(gnb,irows):
 			}
 
 			// fill output
-			cent[tx*3]=x;
-			cent[tx*3+1]=y;
-			cent[tx*3+2]=z;
+			cent[tx*3]=(float)x;
+			cent[tx*3+1]=(float)y;
+			cent[tx*3+2]=(float)z;
 		}
 
 
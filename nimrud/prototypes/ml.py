@@ -3,8 +3,11 @@
 
 import numpy
 import os
-import matplotlib.pyplot as plt
 import time
+from nimrud.utils.lazy import lazy_import
+
+# matplotlib is only loaded once something here plots
+plt=lazy_import('matplotlib.pyplot')
 
 #------------------------------------------------------------------------------------------------
 
@@ -1,15 +1,30 @@
 # multiscale feature generation algorithms
 
 import numpy
-import pycuda.gpuarray as gpua
-import ch
 import time
-from numpy.linalg import eigh as eig
+from nimrud.utils.buffers import OutputBuffer
+from nimrud.utils.spill import SpillStore
+from nimrud.utils.lazy import lazy_import
+from nimrud.utils.cache import cached_operator
+from nimrud.cuda.backends import get_backend
+from nimrud.utils.geometry import local_frame
+from nimrud.features.interpolation import (interpolate_to_voxels, interpolate_to_points,
+	on_grid, voxel_field)
+from nimrud.features.eigen import symmetric_eigh as eig
+from nimrud.features.eigen import EIGEN_FEATURES, eigen_features, normalized_eigenvalues
+
+# pycuda (and the CUDA context *ch* creates with pycuda.autoinit) and scipy are
+# only loaded once something here uses them.
+gpua=lazy_import('pycuda.gpuarray')
+cuda=lazy_import('pycuda.driver')
+ch=lazy_import('ch')
+cpu_mso=lazy_import('nimrud.features.mso')
 
 
 #-------------------------------------------------------------------------------
 
-def V_MSO(qse,qseidx,ssp,sspvec,sspedge,scales,imax=20000):
+@cached_operator('V_MSO',ignore=('workers',))
+def V_MSO(qse,qseidx,ssp,sspvec,sspedge,scales,imax=20000,scale_mode='radius',workers=1):
 	# g mills 10/12/14
 	# vector multiscale operator processing chain handler. takes vectors of
 	# float values for each point, and returns for each scale the mean vector
@@ -23,6 +38,12 @@ def V_MSO(qse,qseidx,ssp,sspvec,sspedge,scales,imax=20000):
 	# sspedge = edge length for search space voxelization. use 0 to skip vox. 
 	# scales = numpy array of spherical neighborhood radii to use
 	# imax = maximum number of points in a search space partition
+	# scale_mode = 'radius', or 'knn' to give scales as numbers of neighbors
+	# workers = number of CPU processes. above 1, the CPU operator is run in a
+			# process pool with the point clouds in shared memory
+	# cache = (keyword) nimrud.utils.cache.FeatureCache to look for the results 
+			# of an identical earlier run in and store new results to, or True
+			# for the default one. no caching if None.
 	
 	# FIRST: put scales in descending order and make float32
 	scales=numpy.float32(numpy.sort(scales)[::-1])
@@ -41,24 +62,33 @@ def V_MSO(qse,qseidx,ssp,sspvec,sspedge,scales,imax=20000):
 	
 	# OUTPUT
 	# outc = indices to point cloud (query set points) with multiscale vectors
-	# appended. scales in descending order. points in no guaranteed order.
+	# appended. scales in descending order. points in query set order.
 	# [IDX, mean (vdim*numscales)]
-	outc=numpy.zeros((0,1+scales.size*vdim),dtype=numpy.float32)
+	outc=OutputBuffer(qse.shape[0],1+scales.size*vdim)
 	
 	
 	# memento mori	
 	alltime=time.time()
 		
-	# manually set types
-	ssp=ssp.astype(numpy.float32)
+	# manually set types. the clouds go into a frame centered on them first,
+	# so their offsets keep their precision in float32 (see local_frame)
+	_,(qse,ssp)=local_frame(qse,ssp)
 	sspvec=sspvec.astype(numpy.float32)
-	qse=qse.astype(numpy.float32)
 	
-	# voxelize the search space point cloud
+	# voxelize the search space point cloud and interpolate the vector field
+	# to the voxel centers, in one streaming pass on the CPU
 	if sspedge!=0:
-		sspv=double_vox(ssp,sspedge).astype(numpy.float32)		
-		# interpolate the vector field to the search space
-		ssp,sspvec=vec_field_interp(sspv,ssp,sspvec,sspedge,imeasure)
+		ssp,sspvec=voxel_field(ssp,sspvec,sspedge,imeasure)
+		ssp=ssp.astype(numpy.float32)
+		sspvec=sspvec.astype(numpy.float32)
+	
+	# kNN scales (numbers of neighbors) and process pools are served by the
+	# CPU operator
+	if scale_mode=='knn' or workers>1:
+		outc=cpu_mso.vector_mso(qse,ssp,sspvec,scales,scale_mode=scale_mode,
+			workers=workers)
+		outc[:,0]=qseidx
+		return outc
 	
 	
 	# partition the search space
@@ -84,9 +114,11 @@ def V_MSO(qse,qseidx,ssp,sspvec,sspedge,scales,imax=20000):
 			# process the points
 			soutc=V_MSO_process(lssp,lqse,oIDX,lsspvec,scales,qsebite)
 			
-			# concatenate to output
-			outc=numpy.vstack((outc,soutc))			
+			# write to the query set points' rows of the output
+			outc.write(numpy.flatnonzero(qse_mask),soutc)
 		
+	# keep the rows of the points we processed
+	outc=outc.filled_rows()
 			
 	finaltime=time.time()-alltime
 	finalpoints=outc.shape[0]
@@ -124,7 +156,7 @@ def V_MSO_process(ssp,qse,qseidx,sspfeats,scales,qsebite):
 	# outc = indices point cloud (query set points) with multiscale vectors
 	# appended. scales in descending order. mean only.
 	# [idx, mean (feats*scales)]
-	outc=numpy.zeros((0,1+ns*nf),dtype=numpy.float32)
+	outc=numpy.zeros((ne,1+ns*nf),dtype=numpy.float32)
 	
 	
 	# transpose the features and make sure they're C-contiguous
@@ -140,8 +172,8 @@ def V_MSO_process(ssp,qse,qseidx,sspfeats,scales,qsebite):
 		# load query set chunk
 		lqse=gpua.to_gpu(qse[d:d+qsebite])
 		
-		# initialize output chunk
-		soutc=numpy.zeros((lqse.shape[0],1+ns*nf),dtype=numpy.float32)
+		# the output chunk is a view on its rows of *outc*
+		soutc=outc[d:d+qsebite]
 		
 		# slot in the indices
 		soutc[:,0]=qseidx[d:d+qsebite]
@@ -162,9 +194,6 @@ def V_MSO_process(ssp,qse,qseidx,sspfeats,scales,qsebite):
 		# purge the query set from the GPU
 		dmat.gpudata.free()
 		lqse.gpudata.free()
-		
-		# concatenate output chunk to *outc*
-		outc=numpy.vstack((outc,soutc))
 					
 	# just to be safe
 	gssp.gpudata.free()
@@ -179,6 +208,13 @@ def vec_field_interp(qse,ssp,sspfeats,qseedge,measure):
 	# g mills 12/10/14
 	# interpolate a vector field represented as a point cloud to a voxel grid.
 	
+	# 18/10/26 modification: runs on the CPU instead of building query set x
+	# search space distance matrices on the GPU (see
+	# nimrud.features.interpolation). a query set on one regular grid of edge
+	# *qseedge* (VoxelFilter's voxels) is interpolated by streaming over the
+	# search space. any other query set, such as double_vox output, whose
+	# partitions each have their own grid, gets the neighbors of each query
+	# point from a KD tree. every query point is kept, in query set order.
 	
 	# INPUT
 	# qse = query set: in this case the voxel set
@@ -187,80 +223,30 @@ def vec_field_interp(qse,ssp,sspfeats,qseedge,measure):
 	# qseedge = voxel edge length
 	# measure = 'euclid' or 'cheby'
 	
-	# FIRST OFF:
-	# make sure the feats are row vectors, even if they're scalars. NxM.
-	sspfeats=sspfeats.reshape(ssp.shape[0],-1).astype(numpy.float32)
-	# we also need to make sure they're all float32
-	qse=qse.astype(numpy.float32)
-	ssp=ssp.astype(numpy.float32)
-	ivt = 10	# ignore voxel threshold
-	
-	
 	# PARAMETERS
-	leaf = 100000
-	imax = 30000		# maximum number of points in a search space partition
-	qsebite = 10000		# maximum number of query set points to search at a time
-	minrad=qseedge*2
-	ominrad=minrad*3
+	chunk = 1000000		# maximum number of search space points to scatter at once
 	
 	# OUTPUT
-	# outqse = RE-ORDERED coordinates of observations in...
-	# qsefeats = set of feature vectors 
-	outqse=numpy.zeros((0,3),dtype=numpy.float32)
-	qsefeats=numpy.zeros((0,sspfeats.shape[1]))
-	
-		
-	# interpolate input features to query set points-- note we're doing this on
-	# a separate partition array from V_MSO because the search space/ query
-	# set designation is flipped from the main process and the partitions would
-	# be the wrong size if we did them together.
-	
-	# partition the search space
-	partset = Partitions(ssp,imax,qseedge,ominrad,minrad,ivt)
-	# put the qse and ssp on the gpu for faster partitioning
-	g_qse=gpua.to_gpu(qse)
-	g_ssp=gpua.to_gpu(ssp)
+	# outqse = coordinates of the voxels, as float32
+	# qsefeats = mean feature vector of the observations within *qseedge* of
+			# each voxel center
 	
-	# iterate over the set of partitions
-	for qse_mask, ssp_mask in partset.partition_generator(g_qse,g_ssp):
-	
-		# check for sufficient membership
-		if qse_mask.sum()>=ivt:
-	
-			# get the partitions and features
-			gsspfeats=gpua.to_gpu(numpy.compress(ssp_mask,sspfeats,axis=0).T.astype(numpy.float32,order='C'))
-			gpssp=gpua.to_gpu(numpy.compress(ssp_mask,ssp,axis=0))
-			
-			# we need to process smaller pieces of the query set at once, which
-			# we can't do all on gpu.
-			lqse=numpy.compress(qse_mask,qse,axis=0)
-			
-			# preserve the ordering of query set points and features as they go
-			# through the blender 
-			outqse=numpy.vstack((outqse,lqse))
-			
-			# break off chunks of query set in this partition
-			for b in range(0,lqse.shape[0],qsebite):						
-				# put on gpu
-				gpqse=gpua.to_gpu(lqse[b:b+qsebite].copy())
-				# interpolate
-				featchunk=ch.vox_vf_interp(gpssp,gsspfeats,gpqse,qseedge,measure).get()
-				# concatenate to output
-				qsefeats=numpy.vstack((qsefeats,featchunk))
-				
+	# make sure the feats are row vectors, even if they're scalars. NxM.
+	sspfeats=sspfeats.reshape(ssp.shape[0],-1)
+	if on_grid(qse,qseedge):
+		qsefeats=interpolate_to_voxels(qse,ssp,sspfeats,qseedge,measure,max_chunk=chunk)
+	else:
+		qsefeats=interpolate_to_points(qse,ssp,sspfeats,qseedge,measure)
 	
-	# clean up 		
-	gpqse=0
-	gpssp=0
-	gsspfeats=0
-			
-	return outqse,qsefeats
+	return qse.astype(numpy.float32),qsefeats.astype(numpy.float32)
 
 
 
 #-------------------------------------------------------------------------------
 
-def G_MSO(qse,ssp,sspedge,scales,imax=20000):
+@cached_operator('G_MSO',ignore=('workers','spill_dir','backend'))
+def G_MSO(qse,ssp,sspedge,scales,imax=20000,scale_mode='radius',extended=False,workers=1,
+	spill_dir=None,backend=None):
 	# g mills 30/9/14
 	# first order (pure geometry) multiscale operator processing chain. 
 	# voxelizes and processes MSOs for input point cloud at given scales, then 
@@ -268,6 +254,12 @@ def G_MSO(qse,ssp,sspedge,scales,imax=20000):
 	
 	# 29/8/15 modification: outgoing features are grouped by scale.
 	
+	# kNN scales (numbers of neighbors) and process pools are served by the
+	# CPU operator
+	if scale_mode=='knn' or workers>1:
+		return cpu_mso.geometric_mso(qse,ssp,sspedge,scales,scale_mode=scale_mode,
+			extended=extended,workers=workers)
+	
 	# FIRST: put scales in descending order and make float32
 	scales=numpy.float32(numpy.sort(scales)[::-1])
 	
@@ -277,33 +269,97 @@ def G_MSO(qse,ssp,sspedge,scales,imax=20000):
 	# sspedge = edge length for search space voxelization. 0 skips subsampling.
 	# scales = numpy array of spherical neighborhood radii to use
 	# imax= maximum number of points in a ssp partition
+	# scale_mode = 'radius', or 'knn' to give scales as numbers of neighbors
+	# workers = number of CPU processes. above 1, the CPU operator is run in a
+			# process pool with the point clouds in shared memory
+	# spill_dir = directory to spill neighborhoods that outgrow RAM to (3 GB
+			# segment files). None uses $NIMRUD_SPILL_DIR, or the system's temp
+			# directory.
+	# backend = compute backend running the chain: a name or Backend (see
+			# nimrud.cuda.backends.get_backend). numpy by default.
+	# cache = (keyword) nimrud.utils.cache.FeatureCache to look for the results 
+			# of an identical earlier run in and store new results to, or True
+			# for the default one. no caching if None.
+	# extended = also return the eigen features (linearity, planarity...) 
+			# listed in nimrud.features.eigen.EIGEN_FEATURES for each scale
+	
+	# PARAMETERS
+	outwidth=4+len(EIGEN_FEATURES) if extended else 4	# outputs per scale
+	
+	# OUTPUT
+	# outc = point cloud (query set points) with multiscale vectors appended. 
+	# scales in descending order. points in query set order.
+	# [index, (density, centroid, eigval x2) x num scales]
+	# or if extended:
+	# [index, (density, centroid, eigval x2, eigen features x9) x num scales]
+	
+	# reduce each set of neighborhoods the chain builds
+	def process(nb,qseidx,outc,backend):
+		NB_process(nb,scales,qseidx,outc,extended,backend)
+	
+	return MSO_chain(qse,ssp,sspedge,scales,imax,outwidth,process,spill_dir,backend,'gmso')
+
+
+
+
+
+
+#-------------------------------------------------------------------------------
+
+def MSO_chain(qse,ssp,sspedge,scales,imax,outwidth,process,spill_dir=None,backend=None,
+	name='mso'):
+	# processing chain shared by G_MSO, OG_MSO and C_MSO: voxelizes the search
+	# space, partitions it, builds the ragged neighborhoods of the query set
+	# points in each partition and hands them to *process*. every step runs
+	# on a compute backend (nimrud.cuda.backends), so the chain runs on
+	# CPU-only nodes (numpy) as well as GPU nodes (cuda).
+	
+	# INPUT
+	# qse = query set
+	# ssp = search space
+	# sspedge = edge length for search space voxelization. 0 skips subsampling.
+	# scales = numpy array of radii, in descending order and float32
+	# imax = maximum number of points in a ssp partition
+	# outwidth = number of outputs per scale
+	# process = process(nb,qseidx,outc,backend) reduces the neighborhoods *nb*
+			# of the query set points *qseidx* into their rows of *outc*
+	# spill_dir = directory to spill neighborhoods that outgrow RAM to. None
+			# uses $NIMRUD_SPILL_DIR, or the system's temp directory.
+	# backend = Backend or backend name (see nimrud.cuda.backends.get_backend)
+	# name = operator name for the timing printout
 	
 	# PARAMETERS
+	backend=get_backend(backend)
 	inrows=qse.shape[0]
-	#imax=20000			# maximum number of points in a ssp partition
 	minrad=scales[-1]	# absolute minimum radius of a qse partition
 	ominrad=minrad*3	# minimum radius of a query set partition in octree
 	buffer=scales[0]	# size difference between query set and search space rad
 	ivt = 10			# ignore voxel threshold- number of points needed in a 
 						# search space partition in order to justify work on it
-	pdir='nbtemp/nb'	# directory name and prefix for temp storage of tensors
-	pidx=0				# starting save file index
+	spill=SpillStore(directory=spill_dir)	# memory mapped temp storage, only
+						# used if the neighborhoods outgrow RAM
 	
 	# OUTPUT
-	# outc = point cloud (query set points) with multiscale vectors appended. 
-	# scales in descending order. points in no guaranteed order.
-	# [index, (density, centroid, eigval x2) x num scales]
-	outc=numpy.zeros((0,1+scales.size*4),dtype=numpy.float32)
+	# outc = point cloud indices (query set points) with multiscale vectors
+	# appended, *outwidth* per scale. scales in descending order, points in
+	# query set order.
+	outc=OutputBuffer(inrows,1+scales.size*outwidth)
 	
 				
 	# some timers		
 	alltime=time.time()
 	
+	# move both clouds into a float32 frame centered on them. the features only
+	# depend on offsets between points, which keep their precision there, where
+	# absolute (e.g. UTM) coordinates would round them to centimeters or worse
+	_,(qse,ssp)=local_frame(qse,ssp)
+	
 	# voxelize the search space point cloud if necessary
 	if sspedge!=0:
-		v=time.time()
-		ssp=double_vox(ssp,sspedge).astype(numpy.float32)	
-		v2=time.time()-v
+		gssp=backend.to_device(ssp)
+		vox=backend.voxelize(gssp,sspedge)
+		ssp=backend.to_host(vox).astype(numpy.float32)
+		backend.release(gssp,vox)
 	else:
 		ssp=ssp.astype(numpy.float32)
 					
@@ -314,17 +370,16 @@ def G_MSO(qse,ssp,sspedge,scales,imax=20000):
 	all_qse_index=numpy.arange(qse.shape[0])
 	
 	# partition the search space
-	partset = Partitions(ssp,imax,buffer,ominrad,minrad,ivt)
-	# put the qse and ssp on the gpu for faster partitioning
-	g_qse=gpua.to_gpu(qse)
-	g_ssp=gpua.to_gpu(ssp)
+	partset = Partitions(ssp,imax,buffer,ominrad,minrad,ivt,backend)
+	# put the qse and ssp on the backend for faster partitioning
+	g_qse=backend.to_device(qse)
+	g_ssp=backend.to_device(ssp)
 	
 	# iterate over the set of partitions
 	for qse_mask, ssp_mask in partset.partition_generator(g_qse,g_ssp):
-		pt=time.time()
 		
-		# reset the storage file index
-		pidx=0					
+		# forget the neighborhoods spilled for the last partition
+		spill.clear()
 			
 		# make sure this volume should be processed
 		if qse_mask.sum()>ivt:
@@ -333,33 +388,32 @@ def G_MSO(qse,ssp,sspedge,scales,imax=20000):
 			lqse = numpy.compress(qse_mask,qse,axis=0)
 			lssp = numpy.compress(ssp_mask,ssp,axis=0)
 			# pass the partitions to the neighborhood construction pipeline
-			nb,pidx=NB_build(lqse,lssp,buffer,pdir,pidx)
+			nb,spilled=NB_build(lqse,lssp,buffer,spill,backend)
 			# retrieve the indices associated with the qse points 
 			qseidx=numpy.extract(qse_mask,all_qse_index)
 									
-			# loop over all the tensors in the temp directory if necessary
-			if pidx:
-				for pd in range(pidx):	
-					nb=numpy.load(pdir+str(pd)+'.npy')
+			# loop over all the spilled neighborhoods if necessary
+			if spilled:
+				for rowoff,coords in zip(nb,spill.chunks()):
 					# carve off the first however many query set indices
-					uqseidx=qseidx[:nb.shape[0]]
-					qseidx=qseidx[nb.shape[0]:]
-					outvec=NB_process(nb,scales,uqseidx)
-					outc=numpy.vstack((outc,outvec))
-					nb=0	
+					uqseidx=qseidx[:rowoff.size-1]
+					qseidx=qseidx[rowoff.size-1:]
+					process((coords,rowoff),uqseidx,outc,backend)
 			else:				
-				# pass the only neighborhood to the process pipeline
-				outvec=NB_process(nb,scales,qseidx)
-				outc=numpy.vstack((outc,outvec))
-				nb=0	
-		
-		partime=(time.time()-pt)
+				# pass the only neighborhoods to the process pipeline
+				process(nb,qseidx,outc,backend)
+			nb=0
 				
-			
+	# clean up the partitioning copies and the temp storage
+	backend.release(g_qse,g_ssp)
+	spill.close()
+	# keep the rows of the points we processed
+	outc=outc.filled_rows()
+
 	finaltime=time.time()-alltime
 	finalpoints=outc.shape[0]
-	pointsec=finalpoints/finaltime
-	print( 'total time in gmso at ' + str(sspedge) + 'm voxel edge length: ' + str(int(finaltime)) + 's')
+	pointsec=finalpoints/max(finaltime,1e-9)
+	print( 'total time in ' + name + ' at ' + str(sspedge) + 'm voxel edge length: ' + str(int(finaltime)) + 's')
 	print( str(finalpoints) + ' points processed at an overall rate of ' + str(int(pointsec)) + ' points per second')
 	
 	
@@ -372,180 +426,205 @@ def G_MSO(qse,ssp,sspedge,scales,imax=20000):
 
 #-------------------------------------------------------------------------------
 
-def NB_build(qse,ssp,rad,pdir,pidx):
+def NB_build(qse,ssp,rad,spill,backend):
 	# g mills 30/9/14-- original version 13/6/14
 	# associates a query set point cloud with neighbors in search space,
-	# returning a neighborhood tensor with associated query set points at the
-	# head of each page in the tensor. if the tensor grows large enough to 
-	# crowd system RAM, we'll write it to the HDD in chunks and process them
-	# individually.
+	# returning ragged neighborhoods: the coordinates of every neighbor
+	# relative to its query point, flat and one query point after another,
+	# with the row offsets of each query point's neighbors (as in
+	# nimrud.features.neighborhoods). only real neighbors are stored, so the
+	# size doesn't follow the biggest neighborhood. if they still grow large
+	# enough to crowd system RAM, we'll spill the coordinates to a memory
+	# mapped store in chunks and process them individually. each chunk is
+	# written on a background thread while the next one is built.
 
 	# INPUT
 	# qse = query set, on the host
 	# ssp = search space, on the host
 	# rad = starting neighborhood search radius. float32.
-	# pdir = directory where we save the tensors for later processing-- 
-			# including file prefix
-	# pidx = temporary storage file index
+	# spill = SpillStore that oversized neighborhoods are written to
+	# backend = Backend doing the searches
 	
 	# PARAMETERS
 	ikmax=60000000		# maximum size of number of points in search space * 
 						# number of points in query set. beyond 60 mil, we risk
 						# overfilling gpu ram on a 2gb board
-	i=ssp.shape[0]					# num points in search space
-	k=int(numpy.floor(ikmax/i))		# num points in query set-- per dwell cycle
-	j=3								# point cloud dimensionality 
-	pthresh=750000000	# when a tensor reaches this size, dump to the hdd. 3gb.
+	i=max(ssp.shape[0],1)			# num points in search space
+	k=max(int(numpy.floor(ikmax/i)),1)	# num points in query set-- per dwell cycle
+	pthresh=750000000	# when the coordinates reach this size, dump to the hdd. 3gb.
 
 		
 	# OUTPUT
-	# a neighborhood tensor for the entire query set and search space given.
-	ia = []	# this is just an intermediary list.
-	# pidx = index following the last save file that was generated-- return 0 
-	# if we didn't write to the hdd.
-	
-	# start a timer
-	star=time.clock()
-	
-	# calculate the dwell
-	dwell=int(numpy.ceil(qse.shape[0]/k))	# at least one loop
-	if dwell==1:			# is it only one loop?
-		k=qse.shape[0]		# if so, k is size of entire query set
-		klast=k				# and identical to the last pass k value. 
-	else:
-		# last pass k value
-		klast=qse.shape[0]%k		
-
-	# instantiate a NBtensor object with the search space
-	gen=NBtensor(ssp)
-	
-	# set up our first query set
-	lqse=qse[:k,:]
-
-	# loop over dwell and use *gen* to build neighborhoods
-	for d in range(dwell):
-
-		# build a neighborhood with this query set and add to the intermediary
-		ia+=[gen.fill(lqse,rad)]
-		
-		# set up the next query set
-		if d<dwell-1:		# get new query set if in the middle of the dwell
-			lqse=qse[(d+1)*k:(d+2)*k,:]
-			# if the intermediary array is getting too big then dump to hdd
-			maxrows=max(x.shape[1] for x in ia)	
-			pags=sum(x.shape[0] for x in ia)	
-			if maxrows*pags*3>pthresh:	# time to dump it out
-				print('saving contents of intermediarray to ' + pdir + str(pidx))
-				onb=numpy.zeros((pags,maxrows,3),dtype=numpy.float32)
-				for x in enumerate(ia):
-					rows=x[1].shape[1]
-					onb[k*x[0]:k*(x[0]+1),:rows,:]=x[1]
-				# save the data
-				numpy.save(pdir+str(pidx),onb)
-				pidx+=1		# don't forget to increment the out index counter
-				ia=[]		# and empty out the intermediary
-			
-		elif d==dwell-1:	# destroy all allocations if last or only pass
-			gen.purge()
+	# nb = (coordinates, row offsets) for the entire query set, or if we
+	# spilled, a list of the row offsets of each spilled chunk, whose 
+	# coordinates come back from spill.chunks() in the same order.
+	# spilled = number of chunks in the spill store-- 0 if we didn't spill.
+	ia = []		# intermediary list of (coordinates, neighbor counts)
+	spilloffs = []	# row offsets of the spilled chunks
+	
+	# prepare the search space for the grabs
+	index=backend.search_index(ssp)
+	
+	# loop over dwell and grab the neighborhoods of *k* query points at a time
+	for d in range(0,qse.shape[0],k):
+		coords,rowoff=backend.grab(index,qse[d:d+k],rad)
+		ia+=[(coords,numpy.diff(rowoff))]
+		
+		# if the intermediary is getting too big (and there's more to come)
+		# then dump to hdd
+		if sum(x[0].size for x in ia)>pthresh and d+k<qse.shape[0]:
+			print('spilling contents of intermediarray to ' + spill.directory)
+			spill.append(numpy.vstack([x[0] for x in ia]))
+			spilloffs+=[_row_offsets([x[1] for x in ia])]
+			ia=[]		# and empty out the intermediary
+	
+	backend.release(index)
 								
-	# condense a single neighborhood tensor from the intermediary
-	maxrows=max(x.shape[1] for x in ia)	
-	pags=sum(x.shape[0] for x in ia)	# the number of pages
-	onb=numpy.zeros((pags,maxrows,3),dtype=numpy.float32)
-	for x in enumerate(ia):
-		rows=x[1].shape[1]
-		onb[k*x[0]:k*(x[0]+1),:rows,:]=x[1]
+	# condense the ragged neighborhoods from the intermediary
+	coords=numpy.vstack([x[0] for x in ia]) if ia else numpy.zeros((0,3),dtype=numpy.float32)
+	rowoff=_row_offsets([x[1] for x in ia])
+	
+	# if we've spilled nbhds, put the last ones in the store too and return
+	# their row offsets instead.
+	spilled=len(spill)
+	if spilled!=0:	
+		spill.append(coords)
+		spilloffs+=[rowoff]
+		return spilloffs, spilled+1
+	return (coords,rowoff), 0
+	
+	
+
+#-------------------------------------------------------------------------------
 
+def _row_offsets(counts):
+	# row offsets of ragged neighborhoods, from a list of arrays of neighbor
+	# counts
 	
-	# if we've written nbhds to the HDD, put the last one on there too and
-	# return zero instead.
-	if pidx!=0:	
-		numpy.save(pdir+str(pidx),onb)
-		pidx+=1		# don't forget to increment the out index counter
-		onb=0
-	return onb, pidx
+	counts=numpy.concatenate(counts) if len(counts) else numpy.zeros(0,dtype=numpy.int64)
+	rowoff=numpy.zeros(counts.size+1,dtype=numpy.int64)
+	numpy.cumsum(counts,out=rowoff[1:])
+	return rowoff
+
+
+
+#-------------------------------------------------------------------------------
+
+def NB_chunks(nb,backend):
+	# yields (query point slice, loaded neighborhoods) for chunks of ragged
+	# neighborhoods small enough for the backend to process at once. each
+	# chunk is loaded into the backend's working layout (a padded tensor on
+	# the GPU for cuda) and released once the caller moves on. chunks with no
+	# neighbors at all are skipped, since there's nothing to write for them.
 	
+	# INPUT
+	# nb = (coordinates, row offsets) from NB_build
+	# backend = Backend to load them on
 	
+	# PARAMETERS
+	ikmax=50000000		# max value of i*k in the processing pipeline
+	ydimmax=65535		# this is the largest possible grid y-dim in CUDA. 
+	# refactor *segscan* and we won't have to place this artificial limitation
+	# on the chunk size here. see *PTshrink* comments for details. of course,
+	# if we load TOO big a tensor we could risk a kernel hang.
+	coords,rowoff=nb
+	k=rowoff.size-1		# query set points
+	i=max(int(numpy.diff(rowoff).max()),1) if k else 1	# biggest neighborhood
+	
+	# decide how to partition the neighborhoods into manageable chunks
+	kmax=min(ydimmax,max(int(numpy.floor(ikmax/i)),1))
+	
+	# loop over chunks
+	for d in range(0,k,kmax):
+		e=min(d+kmax,k)
+		if rowoff[e]>rowoff[d]:
+			gen=backend.load(coords[rowoff[d]:rowoff[e]],rowoff[d:e+1]-rowoff[d])
+			yield slice(d,e),gen
+			# purge all that stuff from the backend
+			backend.release(gen)
+
+
 
 #-------------------------------------------------------------------------------
 
-def NB_process(inb,scales,qseidx):
+def NB_process(nb,scales,qseidx,out=None,extended=False,backend=None):
 	# g mills 30/9/14
 	# processing pipeline for eigvals, density and centroid displacement.
 	
 	# INPUT
-	# inb = input numpy 3-array
+	# nb = ragged neighborhoods (coordinates, row offsets) from NB_build
 	# scales = list of analysis scales. should be descending order and float32 
 	# qseidx = list of indices associated with the points we will be processing
+	# out = OutputBuffer to write the rows into, addressed by *qseidx*
+	# extended = also calculate the eigen features for each scale
+	# backend = Backend or backend name (see nimrud.cuda.backends.get_backend)
 	
 	# PARAMETERS
-	ikmax=50000000		# max value of i*k in the processing pipeline
-	k = inb.shape[0]	# pages in bulk neighborhood/ query set points
-	i = inb.shape[1]	# rows per page in same/ search space points
-	eps=numpy.spacing(1)	# tiny number to protect against division by zero
+	backend=get_backend(backend)
+	k = nb[1].size-1	# query set points
 	ns = scales.size
-	rad=180/numpy.pi	
 	conv=100*100*100	# 1 million cubic centimeters in a cubic meter.	
-	ydimmax=65535		# this is the largest possible grid y-dim in CUDA. 
-	# refactor *segscan* and we won't have to place this artificial limitation
-	# on the chunk size here. see *PTshrink* comments for details. of course,
-	# if we load TOO big a tensor we could risk a kernel hang.
+	outwidth=4+len(EIGEN_FEATURES) if extended else 4	# outputs per scale
 		
 	# OUTPUT
-	# outc = point cloud (query set points) with multiscale vectors appended. 
-	# scales in descending order. points in no guaranteed order.
+	# outc = point cloud (query set points) with multiscale vectors appended,
+	# written into *out* or returned in qseidx order if there isn't one.
+	# scales in descending order. 
 	# [index, (density, centroid, eigval x2) x num scales]
-	outc=numpy.zeros((0,1+ns*4),dtype=numpy.float32)
-	
-	
-	# decide how to partition the tensor into manageable chunks
-	kmax=min(ydimmax,int(numpy.floor(ikmax/i)))
-	klast=k%kmax					# last chunk
-	dwell=int(numpy.ceil(k/kmax))
+	# or if extended:
+	# [index, (density, centroid, eigval x2, eigen features x9) x num scales]
+	if out is None:
+		outc=OutputBuffer(k,1+ns*outwidth)
+		outidx=numpy.arange(k)
+	else:
+		outc=out
+		outidx=qseidx
 	
 	# loop over chunks
-	for d in range(dwell):
+	for rows,gen in NB_chunks(nb,backend):
 		# initialize output chunk
-		if inb.shape[1]>1:
-			if d==dwell-1:	# if last pass
-				# take the last or only piece
-				gen=NBtensor(inb[-klast:,1:,:])	
-				# strip those query set indices and compose to a col vector
-				soutc=numpy.zeros((klast,1+ns*4),dtype=numpy.float32)
-				soutc[:,0]=qseidx[-klast:]	
-
-			else:			
-				# take a piece from the front or middle
-				gen=NBtensor(inb[kmax*d:kmax*(d+1),1:,:]) 
-				# strip those query set indices and compose to a col vector
-				soutc=numpy.zeros((kmax,1+ns*4),dtype=numpy.float32)
-				soutc[:,0]=qseidx[kmax*d:kmax*(d+1)]
-		
-			# loop over scales
-			for s in enumerate(scales):
-				# calculate offset to starting column in feature block
-				s_off=1+s[0]*4
-				# drop neighborhood to this scale (no points should be dropped
-				# on first pass)
-				irows=gen.drop(s[1])				
-				# calculate the volume of the neighborhood-- points per cm^3
-				vol=conv*(4/3)*numpy.pi*s[1]**3
-				# calculate the density of the neighborhoods
-				soutc[:,s_off]=irows/vol
-				# get the mean point displacements
-				soutc[:,s_off+1]=gen.MP_displacement()	
-				# get the write position for eigenvalues
-				es=s_off+2
-				# get the eigenvalues (GPU)
-				soutc[:,es:es+2]=gen.MSPCA_eigs()				
-			
-			# purge all that stuff from the GPU
-			gen.purge()
-			# concatenate output chunk to *outc*
-			outc=numpy.vstack((outc,soutc))
+		cqseidx=qseidx[rows]
+		soutc=numpy.zeros((cqseidx.shape[0],1+ns*outwidth),dtype=numpy.float32)
+		soutc[:,0]=cqseidx
+	
+		# loop over scales
+		for s in enumerate(scales):
+			# calculate offset to starting column in feature block
+			s_off=1+s[0]*outwidth
+			# drop neighborhood to this scale (no points should be dropped
+			# on first pass)
+			irows=backend.shrink(gen,s[1])
+			# calculate the volume of the neighborhood-- points per cm^3
+			vol=conv*(4/3)*numpy.pi*s[1]**3
+			# calculate the density of the neighborhoods
+			soutc[:,s_off]=irows/vol
+			# get the mean point displacements
+			norms,cents=backend.centroids(gen)
+			soutc[:,s_off+1]=backend.to_host(norms)
+			cov=backend.covariances(gen,cents)
+			# get the write position for eigenvalues
+			es=s_off+2
+			if extended:
+				# decompose the covariance matrices on the host, so we
+				# have the eigenvectors for the extended features too
+				vals,vecs=normalized_eigenvalues(
+					numpy.nan_to_num(backend.to_host(cov)),vectors=True)
+				soutc[:,es:es+2]=vals[:,:2]
+				soutc[:,es+2:s_off+outwidth]=eigen_features(vals,vecs)
+			else:
+				# get the eigenvalues on the backend
+				eigs=backend.eigenvalues(cov)
+				soutc[:,es:es+2]=numpy.nan_to_num(backend.to_host(eigs))[:,:2]
+				backend.release(eigs)
+			backend.release(norms,cents,cov)
+		
+		# write output chunk to its rows of *outc*
+		outc.write(outidx[rows],soutc)
 				
 	
-	return outc
+	if out is None:
+		return outc.filled_rows()
+	return out
 
 	
 
@@ -693,11 +772,25 @@ class NBtensor(object):
 		# neighborhood, with sign preserved.
 		
 		# OUTPUT
-		# vector of z offset values
+		# vector of z offset values, 0 for empty neighborhoods
 		
 		
 		assert isinstance(self.gnb,gpua.GPUArray),"this method requires a tensor"	
-		pass	# for now
+		
+		# pull the z offsets and interesting region sizes back to host
+		z=self.gnb.get()[:,:,2]
+		irows=self.irows.get()
+		
+		# mask off everything past the interesting region of each page
+		live=numpy.arange(z.shape[1])<irows.reshape(-1,1)
+		zmax=numpy.where(live,z,-numpy.inf).max(1)
+		zmin=numpy.where(live,z,numpy.inf).min(1)
+		
+		# keep whichever extreme is bigger, with its sign
+		sazo=numpy.where(zmax>=-zmin,zmax,zmin)
+		sazo[irows==0]=0
+		
+		return sazo
 
 	#=========================		
 	
@@ -740,7 +833,7 @@ class NBtensor(object):
 		gc=ch.PT_cov(self.gnb,self.cents,self.irows)
 		try:
 			self.cents.gpudata.free()
-		except pycuda._driver.LogicError:
+		except cuda.LogicError:
 			print('failed to dump original centroid locations in NBtensor.MSPCA_eigs')
 			print(cuda.mem_get_info())
 			
@@ -812,7 +905,7 @@ class Partitions(object):
 	
 	#=========================
 	
-	def __init__(self,inc,imax,bufferrad,omrad,rmrad,minpop):
+	def __init__(self,inc,imax,bufferrad,omrad,rmrad,minpop,backend=None):
 		# initialize the object and perform the partition.
 		
 		# INPUT 
@@ -823,6 +916,8 @@ class Partitions(object):
 		# rmrad = minimum acceptable final output radius-- note edge partitions
 				# may come out smaller than this.
 		# minpop = minimum population of a partition to be stored 
+		# backend = Backend to move oversized point clouds to (see 
+				# nimrud.cuda.backends). None sends them to the GPU with pycuda.
 				
 		
 		# PARAMETERS
@@ -839,7 +934,10 @@ class Partitions(object):
 		
 			if inc.shape[0]>cpumax:
 				#print("host-side pointcloud size limit exceeded-- using GPU to partition")
-				inc=gpua.to_gpu(inc.astype(numpy.float32))
+				if backend is None:
+					inc=gpua.to_gpu(inc.astype(numpy.float32))
+				else:
+					inc=backend.to_device(inc.astype(numpy.float32))
 		
 		# set the attributes
 		self.pop=inc.shape[0]		# total population
@@ -857,7 +955,7 @@ class Partitions(object):
 							# find smaller partitions.
 		
 		# finding the faces of the bounding cube is a little more complicated.
-		if isinstance(inc,gpua.GPUArray): 		# first get center
+		if not isinstance(inc,numpy.ndarray): 		# first get center
 			ig=inc.get()		# TODO...
 			center=ig.mean(0)	 
 			imi=numpy.abs(center-ig.min(0)).max()
@@ -919,9 +1017,9 @@ class Partitions(object):
 				s=self._rule_threshold(qse,rule)
 				
 			# type check for gpuarray
-			if isinstance(q,gpua.GPUArray):
+			if not isinstance(q,numpy.ndarray):
 				q=q.get()
-			if isinstance(s,gpua.GPUArray):
+			if not isinstance(s,numpy.ndarray):
 				s=s.get()
 				
 			yield q,s
@@ -980,13 +1078,13 @@ class Partitions(object):
 									# search space radius
 		
 		# final safety switch
-		start=time.clock()
+		start=time.time()
 	
 		# try and find that optimal radius.
 		while runflag:
 			
 			# check that we haven't run out of time
-			if time.clock()-start > runtime:
+			if time.time()-start > runtime:
 				print("no acceptable partition found in Partitions._rigid")
 				break	# if we let it run one more, it will take even longer
 						# than the last. the ruleset list comprehension below
@@ -1009,7 +1107,7 @@ class Partitions(object):
 			# partition
 			xar[-1]=smax[0]
 			yar[-1]=smax[1]
-			yar[-1]=smax[2]
+			zar[-1]=smax[2]
 			# compose min, max face pairs
 			xr = numpy.column_stack((xir,xar))
 			yr = numpy.column_stack((yir,yar))
@@ -1026,7 +1124,7 @@ class Partitions(object):
 				# check if oversize
 				if pop>self.imax:
 					# reduce the radius and break to try again
-					rad*=radreduce**(pop/self.imax)
+					rad*=self.radreduce**(pop/self.imax)
 					break
 			# if we made it through the loop, we have an acceptable set of rules
 			else:
@@ -1111,7 +1209,7 @@ class Partitions(object):
 			userule[:,1]+=self.buffer
 			
 		# either threshold it in-house or send to the cuda kernel
-		if isinstance(inc,gpua.GPUArray):
+		if not isinstance(inc,numpy.ndarray):
 			bmask=ch.rule_threshold(inc,userule)
 		else:
 			# perform thresholds on each dimension in turn
@@ -1312,7 +1410,9 @@ def natural_vox(inc,edge):
 
 #-------------------------------------------------------------------------------
 
-def OG_MSO(qse,ssp,sspedge,scales,imax=20000):
+@cached_operator('OG_MSO',ignore=('workers','spill_dir','backend'))
+def OG_MSO(qse,ssp,sspedge,scales,imax=20000,scale_mode='radius',workers=1,
+	spill_dir=None,backend=None):
 	# g mills 24/8/15
 	# first order (pure geometry) multiscale operator processing chain. 
 	# voxelizes and proceqses MSOs for input point cloud at given scales, then 
@@ -1322,6 +1422,12 @@ def OG_MSO(qse,ssp,sspedge,scales,imax=20000):
 	
 	# 29/8/15 rework: feature-major ordering, like gmso and vmso
 	
+	# kNN scales (numbers of neighbors) and process pools are served by the
+	# CPU operator
+	if scale_mode=='knn' or workers>1:
+		return cpu_mso.oriented_mso(qse,ssp,sspedge,scales,scale_mode=scale_mode,
+			workers=workers)
+	
 	# FIRST: put scales in descending order and make float32
 	scales=numpy.float32(numpy.sort(scales)[::-1])
 	
@@ -1331,93 +1437,28 @@ def OG_MSO(qse,ssp,sspedge,scales,imax=20000):
 	# sspedge = edge length for search space voxelization. 0 skips subsampling.
 	# scales = numpy array of spherical neighborhood radii to use
 	# imax = maximum number of points in a ssp partition
-	
-	# PARAMETERS
-	inrows=qse.shape[0]
-	#imax=20000			# maximum number of points in a ssp partition
-	minrad=scales[-1]	# absolute minimum radius of a qse partition
-	ominrad=minrad*3	# minimum radius of a query set partition in octree
-	buffer=scales[0]	# size difference between query set and search space rad
-	ivt = 10			# ignore voxel threshold- number of points needed in a 
-						# partition in order to justify work on it
-	pdir='nbtemp/nb'	# directory name and prefix for temp storage of tensors
-	pidx=0				# starting save file index
+	# scale_mode = 'radius', or 'knn' to give scales as numbers of neighbors
+	# workers = number of CPU processes. above 1, the CPU operator is run in a
+			# process pool with the point clouds in shared memory
+	# spill_dir = directory to spill neighborhoods that outgrow RAM to (3 GB
+			# segment files). None uses $NIMRUD_SPILL_DIR, or the system's temp
+			# directory.
+	# backend = compute backend running the chain: a name or Backend (see
+			# nimrud.cuda.backends.get_backend). numpy by default.
+	# cache = (keyword) nimrud.utils.cache.FeatureCache to look for the results 
+			# of an identical earlier run in and store new results to, or True
+			# for the default one. no caching if None.
 	
 	# OUTPUT
 	# outc = point cloud indices (query set points) with multiscale vectors
-	# appended. scales in descending order.
+	# appended. scales in descending order, points in query set order.
 	# [IDX, (density, centroid, eigval x2, vec x4) x num scales]
-	outc=numpy.zeros((0,1+scales.size*8),dtype=numpy.float32)
-	
-				
-	# some timers		
-	alltime=time.time()
-	
-	# voxelize the search space point cloud if necessary
-	if sspedge!=0:
-		v=time.time()
-		ssp=double_vox(ssp,sspedge).astype(numpy.float32)	
-		v2=time.time()-v
-	else:
-		ssp=ssp.astype(numpy.float32)
-					
-	# query set won't be voxelized since we're returning indices in original
-	# point cloud.
-	qse=qse.astype(numpy.float32)
-	# index the query set
-	all_qse_index=numpy.arange(qse.shape[0])
-	
-	# partition the search space
-	partset = Partitions(ssp,imax,buffer,ominrad,minrad,ivt)
-	# put the qse and ssp on the gpu for faster partitioning
-	g_qse=gpua.to_gpu(qse)
-	g_ssp=gpua.to_gpu(ssp)
-	
-	# iterate over the set of partitions
-	for qse_mask, ssp_mask in partset.partition_generator(g_qse,g_ssp):
-		pt=time.time()
-		
-		# reset the storage file index
-		pidx=0					
-			
-		# make sure this volume should be processed
-		if qse_mask.sum()>ivt:
-		
-			# get the search space and query set partitions
-			lqse = numpy.compress(qse_mask,qse,axis=0)
-			lssp = numpy.compress(ssp_mask,ssp,axis=0)
-			# pass the partitions to the neighborhood construction pipeline
-			nb,pidx=NB_build(lqse,lssp,buffer,pdir,pidx)
-			# retrieve the indices associated with the qse points 
-			qseidx=numpy.extract(qse_mask,all_qse_index)
-									
-			# loop over all the tensors in the temp directory if necessary
-			if pidx:
-				for pd in range(pidx):	
-					nb=numpy.load(pdir+str(pd)+'.npy')
-					# carve off the first however many query set indices
-					uqseidx=qseidx[:nb.shape[0]]
-					qseidx=qseidx[nb.shape[0]:]
-					outvec=OGNB_process(nb,scales,uqseidx)
-					outc=numpy.vstack((outc,outvec))
-					nb=0	
-			else:				
-				# pass the only neighborhood to the process pipeline
-				outvec=OGNB_process(nb,scales,qseidx)
-				outc=numpy.vstack((outc,outvec))
-				nb=0	
-		
-		partime=(time.time()-pt)
-				
-			
-	finaltime=time.time()-alltime
-	finalpoints=outc.shape[0]
-	pointsec=finalpoints/finaltime
-	print( 'total time in gmso at ' + str(sspedge) + 'm voxel edge length: ' + str(int(finaltime)) + 's')
-	print( str(finalpoints) + ' points processed at an overall rate of ' + str(int(pointsec)) + ' points per second')
 	
+	# reduce each set of neighborhoods the chain builds
+	def process(nb,qseidx,outc,backend):
+		OGNB_process(nb,scales,qseidx,outc,backend)
 	
-	return outc
+	return MSO_chain(qse,ssp,sspedge,scales,imax,8,process,spill_dir,backend,'ogmso')
 
 
 
@@ -1425,134 +1466,124 @@ def OG_MSO(qse,ssp,sspedge,scales,imax=20000):
 	
 #-------------------------------------------------------------------------------
 
-def OGNB_process(inb,scales,qseidx):
+def OGNB_process(nb,scales,qseidx,out=None,backend=None):
 	# g mills 24/8/15
 	# processing pipeline for eigvals, density, centroid and eigvecs.
 	
 	# INPUT
-	# inb = input numpy 3-array
+	# nb = ragged neighborhoods (coordinates, row offsets) from NB_build
 	# scales = list of analysis scales. should be descending order and float32 
 	# qseidx = list of indices associated with the points we will be processing
+	# out = OutputBuffer to write the rows into, addressed by *qseidx*
+	# backend = Backend or backend name (see nimrud.cuda.backends.get_backend)
 	
 	# PARAMETERS
-	ikmax=50000000		# max value of i*k in the processing pipeline
-	k = inb.shape[0]	# pages in bulk neighborhood/ query set points
-	i = inb.shape[1]	# rows per page in same/ search space points
+	backend=get_backend(backend)
+	k = nb[1].size-1	# query set points
 	eps=numpy.spacing(1)	# tiny number to protect against division by zero
 	ns = scales.size
-	rad=180/numpy.pi	
 	conv=100*100*100	# 1 million cubic centimeters in a cubic meter.	
-	ydimmax=65535		# this is the largest possible grid y-dim in CUDA. 
-	# refactor *segscan* and we won't have to place this artificial limitation
-	# on the chunk size here. see *PTshrink* comments for details. of course,
-	# if we load TOO big a tensor we could risk a kernel hang.
 	outwidth=8			# number of output args per scale (4 for basic gmso, 
 						# 8 for vecs)	
 	
 	# OUTPUT
 	# outc = point cloud indices (query set points) with multiscale vectors
-	# appended. scales in descending order.
+	# appended, written into *out* or returned in qseidx order if there isn't
+	# one. scales in descending order.
 	# [IDX, (density, centroid, eigval x2, vec x4) x num scales]
-	outc=numpy.zeros((0,1+ns*outwidth),dtype=numpy.float32)
-	
-	
-	# decide how to partition the tensor into manageable chunks
-	kmax=min(ydimmax,int(numpy.floor(ikmax/i)))
-	klast=k%kmax					# last chunk
-	dwell=int(numpy.ceil(k/kmax))
+	if out is None:
+		outc=OutputBuffer(k,1+ns*outwidth)
+		outidx=numpy.arange(k)
+	else:
+		outc=out
+		outidx=qseidx
 	
 	# loop over chunks
-	for d in range(dwell):
+	for rows,gen in NB_chunks(nb,backend):
 		# initialize output chunk
-		if inb.shape[1]>1:
-			if d==dwell-1:	# if last pass
-				# take the last or only piece
-				gen=NBtensor(inb[-klast:,1:,:])	
-				# strip those query set indices and compose to a col vector
-				soutc=numpy.zeros((klast,1+ns*8),dtype=numpy.float32)
-				soutc[:,0]=qseidx[-klast:]	
-
-			else:			
-				# take a piece from the front or middle
-				gen=NBtensor(inb[kmax*d:kmax*(d+1),1:,:]) 
-				# strip those query set indices and compose to a col vector
-				soutc=numpy.zeros((kmax,1+ns*8),dtype=numpy.float32)
-				soutc[:,0]=qseidx[kmax*d:kmax*(d+1)]
-		
-			# loop over scales
-			for s in enumerate(scales):
-				# calculate output block offset
-				s_off = 1+s[0]*outwidth
-				# drop neighborhood to this scale (no points should be dropped
-				# on first pass)
-				irows=gen.drop(s[1])				
-				# calculate the volume of the neighborhood-- points per cm^3
-				vol=conv*(4/3)*numpy.pi*s[1]**3
-				# calculate the density of the neighborhoods
-				soutc[:,s_off]=irows/vol			
-				# get the mean point displacements
-				soutc[:,s_off+1]=gen.MP_displacement()			
-				# get the write position for eigenvalues
-				es=s_off+2
-				
-				# we're using numpy to perform the eigendecomposition since we
-				# want the eigvecs now. the vectors will be normalized and
-				# correspond to the same ordering as the values. since they're
-				# normalized the first two entries of the vector will uniquely
-				# define it. likewise, we don't really care about the least
-				# vector so we will take the first two of the first two. 
-				cov=numpy.nan_to_num(gen.MSPCA_cov())
-				vals,vecs=eig(cov)
-				
-				# normalize the eigenvalues to 1-- normalize all three before
-				# taking off the two largest. 
-				vals/=(vals.sum(1).reshape(-1,1)+eps)
-				
-				# we want to (efficiently) sort the rows of *vals* and chop off
-				# the third of each. so we'll do an argsort over the rows, add
-				# an offset to each row of the argsort output, chop out the
-				# last column, flatten it, and then do a flat .take on *vals*,
-				# and then reshape *vals* into 2 cols.
-				sorter=numpy.argsort(vals,axis=1)
-				valoff=numpy.arange(sorter.shape[0])*3
-				valsorter=sorter+valoff.reshape(-1,1)
-				valsorter=valsorter[:,:2].ravel()
-				soutc[:,es:es+2]=vals.take(valsorter).reshape(-1,2)
-				
-				# now let's get a write position for the eigenvectors:
-				vs=s_off+4
-				# now we have a 3-array containing our eigenvalues. the 2nd and
-				# 3rd axes will be transposed and we'll cut out the Z axis
-				vecs=numpy.transpose(vecs,(0,2,1))[:,:,:2]
-				# now we can take our sorting array and chop it down to the
-				# first 2 vectors' addreqses before we start transforming it
-				vecsorter=sorter[:,:2]
-				# it will now reference the first entry of the first vector
-				# of each qse point
-				vecsorter=vecsorter*2+(numpy.arange(sorter.shape[0])*6).reshape(-1,1)
-				# we want to take both entries of each vector so we'll flatten
-				# it and interleave it with a version that has had 1 added 
-				vecsorter1=vecsorter.ravel()
-				vecsorter2=vecsorter1+1
-				vecsorter=numpy.column_stack((vecsorter1,vecsorter2)).ravel()
-				# now take out the partial vectors and shape into a 2-array
-				soutc[:,vs:vs+4]=vecs.take(vecsorter).reshape(-1,4)
-							
+		cqseidx=qseidx[rows]
+		soutc=numpy.zeros((cqseidx.shape[0],1+ns*8),dtype=numpy.float32)
+		soutc[:,0]=cqseidx
+	
+		# loop over scales
+		for s in enumerate(scales):
+			# calculate output block offset
+			s_off = 1+s[0]*outwidth
+			# drop neighborhood to this scale (no points should be dropped
+			# on first pass)
+			irows=backend.shrink(gen,s[1])
+			# calculate the volume of the neighborhood-- points per cm^3
+			vol=conv*(4/3)*numpy.pi*s[1]**3
+			# calculate the density of the neighborhoods
+			soutc[:,s_off]=irows/vol			
+			# get the mean point displacements
+			norms,cents=backend.centroids(gen)
+			soutc[:,s_off+1]=backend.to_host(norms)
+			# get the write position for eigenvalues
+			es=s_off+2
+			
+			# we're doing the eigendecomposition on the host (closed form,
+			# batched) since we want the eigvecs now. the vectors will be
+			# normalized and correspond to the same ordering as the values.
+			# since they're normalized the first two entries of the vector
+			# will uniquely define it. likewise, we don't really care about
+			# the least vector so we will take the first two of the first two. 
+			gcov=backend.covariances(gen,cents)
+			cov=numpy.nan_to_num(backend.to_host(gcov))
+			backend.release(norms,cents,gcov)
+			vals,vecs=eig(cov)
+			
+			# normalize the eigenvalues to 1-- normalize all three before
+			# taking off the two largest. 
+			vals/=(vals.sum(1).reshape(-1,1)+eps)
+			
+			# we want to (efficiently) sort the rows of *vals* and chop off
+			# the third of each. so we'll do an argsort over the rows, add
+			# an offset to each row of the argsort output, chop out the
+			# last column, flatten it, and then do a flat .take on *vals*,
+			# and then reshape *vals* into 2 cols.
+			sorter=numpy.argsort(vals,axis=1)
+			valoff=numpy.arange(sorter.shape[0])*3
+			valsorter=sorter+valoff.reshape(-1,1)
+			valsorter=valsorter[:,:2].ravel()
+			soutc[:,es:es+2]=vals.take(valsorter).reshape(-1,2)
 			
-			# purge all that stuff from the GPU
-			gen.purge()
-			# concatenate output chunk to *outc*
-			outc=numpy.vstack((outc,soutc))
+			# now let's get a write position for the eigenvectors:
+			vs=s_off+4
+			# now we have a 3-array containing our eigenvalues. the 2nd and
+			# 3rd axes will be transposed and we'll cut out the Z axis
+			vecs=numpy.transpose(vecs,(0,2,1))[:,:,:2]
+			# now we can take our sorting array and chop it down to the
+			# first 2 vectors' addreqses before we start transforming it
+			vecsorter=sorter[:,:2]
+			# it will now reference the first entry of the first vector
+			# of each qse point
+			vecsorter=vecsorter*2+(numpy.arange(sorter.shape[0])*6).reshape(-1,1)
+			# we want to take both entries of each vector so we'll flatten
+			# it and interleave it with a version that has had 1 added 
+			vecsorter1=vecsorter.ravel()
+			vecsorter2=vecsorter1+1
+			vecsorter=numpy.column_stack((vecsorter1,vecsorter2)).ravel()
+			# now take out the partial vectors and shape into a 2-array
+			soutc[:,vs:vs+4]=vecs.take(vecsorter).reshape(-1,4)
+						
+		
+		# write output chunk to its rows of *outc*
+		outc.write(outidx[rows],soutc)
 				
 	
-	return outc
+	if out is None:
+		return outc.filled_rows()
+	return out
 	
 								
 				
 				
 #-------------------------------------------------------------------------------
 
-def C_MSO(qse,ssp,sspedge,scales,imax=20000):
+@cached_operator('C_MSO',ignore=('workers','spill_dir','backend'))
+def C_MSO(qse,ssp,sspedge,scales,imax=20000,scale_mode='radius',workers=1,
+	spill_dir=None,backend=None):
 	# g mills 31/8/15
 	# first order geometric multiscale operator processing chain. 
 	# voxelizes and proceqses MSOs for input point cloud at given scales, then 
@@ -1561,6 +1592,12 @@ def C_MSO(qse,ssp,sspedge,scales,imax=20000):
 	# matrix of each neighborhood, rather than the eigenfeatures.
 	
 	
+	# kNN scales (numbers of neighbors) and process pools are served by the
+	# CPU operator
+	if scale_mode=='knn' or workers>1:
+		return cpu_mso.covariance_mso(qse,ssp,sspedge,scales,scale_mode=scale_mode,
+			workers=workers)
+	
 	# FIRST: put scales in descending order and make float32
 	scales=numpy.float32(numpy.sort(scales)[::-1])
 	
@@ -1570,93 +1607,28 @@ def C_MSO(qse,ssp,sspedge,scales,imax=20000):
 	# sspedge = edge length for search space voxelization. 0 skips subsampling.
 	# scales = numpy array of spherical neighborhood radii to use
 	# imax = maximum number of points in a ssp partition
-	
-	# PARAMETERS
-	inrows=qse.shape[0]
-	#imax=20000			# maximum number of points in a ssp partition
-	minrad=scales[-1]	# absolute minimum radius of a qse partition
-	ominrad=minrad*3	# minimum radius of a query set partition in octree
-	buffer=scales[0]	# size difference between query set and search space rad
-	ivt = 10			# ignore voxel threshold- number of points needed in a 
-						# partition in order to justify work on it
-	pdir='nbtemp/nb'	# directory name and prefix for temp storage of tensors
-	pidx=0				# starting save file index
+	# scale_mode = 'radius', or 'knn' to give scales as numbers of neighbors
+	# workers = number of CPU processes. above 1, the CPU operator is run in a
+			# process pool with the point clouds in shared memory
+	# spill_dir = directory to spill neighborhoods that outgrow RAM to (3 GB
+			# segment files). None uses $NIMRUD_SPILL_DIR, or the system's temp
+			# directory.
+	# backend = compute backend running the chain: a name or Backend (see
+			# nimrud.cuda.backends.get_backend). numpy by default.
+	# cache = (keyword) nimrud.utils.cache.FeatureCache to look for the results 
+			# of an identical earlier run in and store new results to, or True
+			# for the default one. no caching if None.
 	
 	# OUTPUT
 	# outc = point cloud indices (query set points) with multiscale vectors
-	# appended. scales in descending order.
+	# appended. scales in descending order, points in query set order.
 	# [IDX, (density, centroid, cov x 6) x num scales]
-	outc=numpy.zeros((0,1+scales.size*8),dtype=numpy.float32)
-	
-				
-	# some timers		
-	alltime=time.time()
-	
-	# voxelize the search space point cloud if necessary
-	if sspedge!=0:
-		v=time.time()
-		ssp=double_vox(ssp,sspedge).astype(numpy.float32)	
-		v2=time.time()-v
-	else:
-		ssp=ssp.astype(numpy.float32)
-					
-	# query set won't be voxelized since we're returning indices in original
-	# point cloud.
-	qse=qse.astype(numpy.float32)
-	# index the query set
-	all_qse_index=numpy.arange(qse.shape[0])
-	
-	# partition the search space
-	partset = Partitions(ssp,imax,buffer,ominrad,minrad,ivt)
-	# put the qse and ssp on the gpu for faster partitioning
-	g_qse=gpua.to_gpu(qse)
-	g_ssp=gpua.to_gpu(ssp)
-	
-	# iterate over the set of partitions
-	for qse_mask, ssp_mask in partset.partition_generator(g_qse,g_ssp):
-		pt=time.time()
-		
-		# reset the storage file index
-		pidx=0					
-			
-		# make sure this volume should be processed
-		if qse_mask.sum()>ivt:
-		
-			# get the search space and query set partitions
-			lqse = numpy.compress(qse_mask,qse,axis=0)
-			lssp = numpy.compress(ssp_mask,ssp,axis=0)
-			# pass the partitions to the neighborhood construction pipeline
-			nb,pidx=NB_build(lqse,lssp,buffer,pdir,pidx)
-			# retrieve the indices associated with the qse points 
-			qseidx=numpy.extract(qse_mask,all_qse_index)
-									
-			# loop over all the tensors in the temp directory if necessary
-			if pidx:
-				for pd in range(pidx):	
-					nb=numpy.load(pdir+str(pd)+'.npy')
-					# carve off the first however many query set indices
-					uqseidx=qseidx[:nb.shape[0]]
-					qseidx=qseidx[nb.shape[0]:]
-					outvec=CNB_process(nb,scales,uqseidx)
-					outc=numpy.vstack((outc,outvec))
-					nb=0	
-			else:				
-				# pass the only neighborhood to the process pipeline
-				outvec=OGNB_process(nb,scales,qseidx)
-				outc=numpy.vstack((outc,outvec))
-				nb=0	
-		
-		partime=(time.time()-pt)
-				
-			
-	finaltime=time.time()-alltime
-	finalpoints=outc.shape[0]
-	pointsec=finalpoints/finaltime
-	print( 'total time in cmso at ' + str(sspedge) + 'm voxel edge length: ' + str(int(finaltime)) + 's')
-	print( str(finalpoints) + ' points processed at an overall rate of ' + str(int(pointsec)) + ' points per second')
 	
+	# reduce each set of neighborhoods the chain builds
+	def process(nb,qseidx,outc,backend):
+		CNB_process(nb,scales,qseidx,outc,backend)
 	
-	return outc
+	return MSO_chain(qse,ssp,sspedge,scales,imax,8,process,spill_dir,backend,'cmso')
 
 
 
@@ -1664,95 +1636,79 @@ def C_MSO(qse,ssp,sspedge,scales,imax=20000):
 	
 #-------------------------------------------------------------------------------
 
-def CNB_process(inb,scales,qseidx):
+def CNB_process(nb,scales,qseidx,out=None,backend=None):
 	# g mills 24/8/15
 	# processing pipeline for density, centroid and covariance matrix.
 	
 	# INPUT
-	# inb = input numpy 3-array
+	# nb = ragged neighborhoods (coordinates, row offsets) from NB_build
 	# scales = list of analysis scales. should be descending order and float32 
 	# qseidx = list of indices associated with the points we will be processing
+	# out = OutputBuffer to write the rows into, addressed by *qseidx*
+	# backend = Backend or backend name (see nimrud.cuda.backends.get_backend)
 	
 	# PARAMETERS
-	ikmax=50000000		# max value of i*k in the processing pipeline
-	k = inb.shape[0]	# pages in bulk neighborhood/ query set points
-	i = inb.shape[1]	# rows per page in same/ search space points
-	eps=numpy.spacing(1)	# tiny number to protect against division by zero
+	backend=get_backend(backend)
+	k = nb[1].size-1	# query set points
 	ns = scales.size
-	rad=180/numpy.pi	
 	conv=100*100*100	# 1 million cubic centimeters in a cubic meter.	
-	ydimmax=65535		# this is the largest possible grid y-dim in CUDA. 
-	# refactor *segscan* and we won't have to place this artificial limitation
-	# on the chunk size here. see *PTshrink* comments for details. of course,
-	# if we load TOO big a tensor we could risk a kernel hang.
 	outwidth=8			# number of output args per scale (4 for basic gmso, 
 						# 8 for vecs)	
+	# the covariance tensor is (k,3,3), so we can flatten the last 2 dimensions
+	# to make it (k,9) and use triu_indices to index the upper triangle.
+	tridx=numpy.triu_indices(3)
+	tridx=tridx[0]*3+tridx[1]
 	
 	# OUTPUT
 	# outc = point cloud indices (query set points) with multiscale vectors
-	# appended. scales in descending order.
+	# appended, written into *out* or returned in qseidx order if there isn't
+	# one. scales in descending order.
 	# [IDX, (density, centroid, cov x 6) x num scales]
-	outc=numpy.zeros((0,1+ns*outwidth),dtype=numpy.float32)
-	
-	
-	# decide how to partition the tensor into manageable chunks
-	kmax=min(ydimmax,int(numpy.floor(ikmax/i)))
-	klast=k%kmax					# last chunk
-	dwell=int(numpy.ceil(k/kmax))
+	if out is None:
+		outc=OutputBuffer(k,1+ns*outwidth)
+		outidx=numpy.arange(k)
+	else:
+		outc=out
+		outidx=qseidx
 	
 	# loop over chunks
-	for d in range(dwell):
+	for rows,gen in NB_chunks(nb,backend):
 		# initialize output chunk
-		if inb.shape[1]>1:
-			if d==dwell-1:	# if last pass
-				# take the last or only piece
-				gen=NBtensor(inb[-klast:,1:,:])	
-				# strip those query set indices and compose to a col vector
-				soutc=numpy.zeros((klast,1+ns*8),dtype=numpy.float32)
-				soutc[:,0]=qseidx[-klast:]	
-
-			else:			
-				# take a piece from the front or middle
-				gen=NBtensor(inb[kmax*d:kmax*(d+1),1:,:]) 
-				# strip those query set indices and compose to a col vector
-				soutc=numpy.zeros((kmax,1+ns*8),dtype=numpy.float32)
-				soutc[:,0]=qseidx[kmax*d:kmax*(d+1)]
-		
-			# loop over scales
-			for s in enumerate(scales):
-				# calculate output block offset
-				s_off = 1+s[0]*outwidth
-				# drop neighborhood to this scale (no points should be dropped
-				# on first pass)
-				irows=gen.drop(s[1])				
-				# calculate the volume of the neighborhood-- points per cm^3
-				vol=conv*(4/3)*numpy.pi*s[1]**3
-				# calculate the density of the neighborhoods
-				soutc[:,s_off]=irows/vol			
-				# get the mean point displacements
-				soutc[:,s_off+1]=gen.MP_displacement()			
-				
-				# take the covariance matrices
-				cov=numpy.nan_to_num(gen.MSPCA_cov())				
-				# the shape of the covariance matrix-holding tensor is (k,3,3)
-				# so we can flatten the last 2 dimensions to make it (k,9).
-				# then we can use triu_indices to index the upper triangle.
-				tridx=numpy.triu_indices(3)
-				tridx=tridx[0]*3+tridx[1]
-				cov=cov.reshape(-1,9).take(tridx,axis=1)				
-				# now let's get a write position:
-				cs=s_off+1
-				# and slide in
-				soutc[:,cs:cs+6]=cov
-							
+		cqseidx=qseidx[rows]
+		soutc=numpy.zeros((cqseidx.shape[0],1+ns*8),dtype=numpy.float32)
+		soutc[:,0]=cqseidx
+	
+		# loop over scales
+		for s in enumerate(scales):
+			# calculate output block offset
+			s_off = 1+s[0]*outwidth
+			# drop neighborhood to this scale (no points should be dropped
+			# on first pass)
+			irows=backend.shrink(gen,s[1])
+			# calculate the volume of the neighborhood-- points per cm^3
+			vol=conv*(4/3)*numpy.pi*s[1]**3
+			# calculate the density of the neighborhoods
+			soutc[:,s_off]=irows/vol			
+			# get the mean point displacements
+			norms,cents=backend.centroids(gen)
+			soutc[:,s_off+1]=backend.to_host(norms)
 			
-			# purge all that stuff from the GPU
-			gen.purge()
-			# concatenate output chunk to *outc*
-			outc=numpy.vstack((outc,soutc))
+			# take the covariance matrices
+			gcov=backend.covariances(gen,cents)
+			cov=numpy.nan_to_num(backend.to_host(gcov)).reshape(-1,9).take(tridx,axis=1)
+			backend.release(norms,cents,gcov)
+			# now let's get a write position, just past the centroid:
+			cs=s_off+2
+			# and slide in
+			soutc[:,cs:cs+6]=cov
+		
+		# write output chunk to its rows of *outc*
+		outc.write(outidx[rows],soutc)
 				
 	
-	return outc
+	if out is None:
+		return outc.filled_rows()
+	return out
 	
 								
 				
@@ -0,0 +1,82 @@
+# pylint: disable=E0401, E1101
+
+"""
+implements OutputBuffer, a preallocated array that results are written into by row index.
+"""
+
+import os
+import tempfile
+import weakref
+
+import numpy as np
+
+
+class OutputBuffer(object):
+    """
+    a (num_rows, width) array sized up front (for instance, one row per query set point) which
+    results are written into by row index as they are produced, with a record of which rows have
+    been filled. this replaces growing results with numpy.vstack inside loops, which copies
+    everything produced so far on every pass, and it keeps the rows in index order whatever
+    order the work is done in.
+
+    if directory is given, the array is a memmap on a temporary file there, so outputs bigger
+    than memory only use the disk they are written to. the file is removed by close(), or when
+    the buffer is garbage collected.
+    """
+
+    def __init__(self, num_rows, width, dtype=np.float32, directory=None):
+
+        self.filled = np.zeros(num_rows, dtype=bool)
+        self.path = None
+        if directory is None or num_rows * width == 0:
+            self.data = np.zeros((num_rows, width), dtype=dtype)
+        else:
+            handle, self.path = tempfile.mkstemp(
+                prefix="nimrud_output_", suffix=".dat", dir=directory)
+            os.close(handle)
+            self.data = np.memmap(self.path, dtype=dtype, mode="w+", shape=(num_rows, width))
+            self._cleanup = weakref.finalize(self, os.remove, self.path)
+
+    #==================================
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    #==================================
+
+    def write(self, index, rows):
+        """
+        write rows (one per entry of index, or one row for all of them) at the given row indices
+        and mark them filled
+        """
+
+        self.data[index] = rows
+        self.filled[index] = True
+
+    #==================================
+
+    def filled_index(self):
+        """
+        sorted indices of the rows that have been written
+        """
+        return np.flatnonzero(self.filled)
+
+    #==================================
+
+    def filled_rows(self):
+        """
+        an in-memory array of the rows that have been written, in index order
+        """
+        return np.asarray(self.data[self.filled])
+
+    #==================================
+
+    def close(self):
+        """
+        release the array, deleting its file if it has one
+        """
+
+        self.data = None
+        if self.path is not None:
+            self._cleanup()
+            self.path = None
@@ -0,0 +1,214 @@
+# pylint: disable=E0401, E1101
+
+"""
+implements FeatureCache, a content-addressed disk cache for multiscale operator results.
+
+results are keyed by a hash of everything that determines them: the operator's name, a
+fingerprint of every array it is given (the point clouds, query sets, index sets and feature
+vectors), its other arguments (voxel edge, scales and so on) and CACHE_VERSION. they are stored as
+.npy files and handed back as copy-on-write memmaps, so a cache hit costs a file open instead of a
+recomputation. the least recently used entries are deleted when the cache grows past its size
+cap.
+"""
+
+import functools
+import hashlib
+import inspect
+import os
+import tempfile
+
+import numpy as np
+
+
+# bump this when an operator's output changes, so old results are no longer found
+CACHE_VERSION = 1
+
+# environment variable giving the default cache directory
+CACHE_VARIABLE = "NIMRUD_CACHE"
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "nimrud")
+DEFAULT_MAX_BYTES = 10 * 2 ** 30
+
+#---------------------------------------------------------------------------------------------------
+
+class FeatureCache(object):
+    """
+    a directory of cached results, holding at most max_bytes of them. directory defaults to the
+    NIMRUD_CACHE environment variable, or ~/.cache/nimrud.
+    """
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+
+        if directory is None:
+            directory = os.environ.get(CACHE_VARIABLE, DEFAULT_DIRECTORY)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    #==================================
+
+    def key(self, name, arguments):
+        """
+        hex digest identifying a call to the named operator with the given arguments, a sequence
+        of arrays and plain values (numbers, strings, None, and tuples or lists of them)
+        """
+
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update("{}:{}".format(name, CACHE_VERSION).encode())
+        for argument in arguments:
+            digest.update(b"|")
+            digest.update(_fingerprint(argument))
+        return digest.hexdigest()
+
+    #==================================
+
+    def path(self, key):
+        """
+        file holding the result for key
+        """
+        return os.path.join(self.directory, key + ".npy")
+
+    #==================================
+
+    def get(self, key):
+        """
+        the stored result for key as a copy-on-write memmap, or None if there isn't one. a hit
+        marks the entry as recently used.
+        """
+
+        path = self.path(key)
+        try:
+            result = np.load(path, mmap_mode="c")
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return result
+
+    #==================================
+
+    def put(self, key, result):
+        """
+        store result under key, then evict the least recently used entries until the cache fits
+        in max_bytes. a result bigger than the cap isn't stored.
+        """
+
+        result = np.asarray(result)
+        if result.nbytes > self.max_bytes:
+            return
+        # write to a temporary file and move it into place, so readers never see half a result
+        handle, temporary = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(handle, "wb") as stream:
+                np.save(stream, result)
+            os.replace(temporary, self.path(key))
+        except BaseException:
+            os.remove(temporary)
+            raise
+        self.evict()
+
+    #==================================
+
+    def evict(self):
+        """
+        delete the least recently used entries until the cache fits in max_bytes
+        """
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npy"):
+                continue
+            try:
+                status = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, name))
+
+        total = sum(entry[1] for entry in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+
+    #==================================
+
+    def size(self):
+        """
+        total bytes of the stored results
+        """
+
+        return sum(os.path.getsize(os.path.join(self.directory, name))
+                   for name in os.listdir(self.directory) if name.endswith(".npy"))
+
+    #==================================
+
+    def clear(self):
+        """
+        delete every stored result
+        """
+
+        for name in os.listdir(self.directory):
+            if name.endswith(".npy"):
+                os.remove(os.path.join(self.directory, name))
+
+#---------------------------------------------------------------------------------------------------
+
+def cached_operator(name, ignore=()):
+    """
+    decorator giving an operator a cache keyword argument. with cache=None (the default) the
+    operator runs as usual. given a FeatureCache (or True, for the default one), a call looks
+    for an identical earlier call in the cache and returns its result, or runs the operator and
+    stores the result. the parameters named in ignore (like a number of workers) don't change
+    the result and are left out of the key.
+    """
+
+    def decorate(function):
+
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+
+            cache = kwargs.pop("cache", None)
+            if cache is None or cache is False:
+                return function(*args, **kwargs)
+            if cache is True:
+                cache = FeatureCache()
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = cache.key(name, [
+                (parameter, value) for parameter, value in bound.arguments.items()
+                if parameter not in ignore])
+            result = cache.get(key)
+            if result is None:
+                result = function(*args, **kwargs)
+                cache.put(key, result)
+            return result
+
+        return wrapper
+
+    return decorate
+
+#---------------------------------------------------------------------------------------------------
+
+def _fingerprint(value):
+    """
+    bytes identifying a value: the dtype, shape and contents of an array, or the repr of anything
+    else, recursing into tuples and lists
+    """
+
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update("{}{}".format(value.dtype.str, value.shape).encode())
+        digest.update(value.data if value.size else b"")
+        return b"array:" + digest.digest()
+    if isinstance(value, (tuple, list)):
+        return b"(" + b",".join(_fingerprint(item) for item in value) + b")"
+    if isinstance(value, np.generic):
+        value = value.item()
+    return repr(value).encode()
@@ -171,6 +171,31 @@ class VoxelFilter(object):
         # TODO: not relevant right now
         raise NameError("find_facing_neighbors not implemented yet")
 
+#---------------------------------------------------------------------------------------------------
+
+def local_frame(*clouds, dtype=np.float32):
+    """
+    move point clouds into a shared frame centered on their bounding box, stored at dtype.
+    returns the origin of the frame (in float64, the original coordinates of the new zero) and a
+    list of the moved clouds.
+
+    offsets between points are unchanged, but they survive single precision far better near
+    the origin: float32 coordinates are a quarter meter apart at 4e6 (a typical UTM northing),
+    and tens of micrometers apart within a few hundred meters of 0. the subtraction is done in
+    float64, before the cast.
+    """
+
+    nonempty = [np.asarray(cloud) for cloud in clouds if len(cloud)]
+    if nonempty:
+        lowest = np.min([cloud.min(0) for cloud in nonempty], axis=0).astype(np.float64)
+        highest = np.max([cloud.max(0) for cloud in nonempty], axis=0).astype(np.float64)
+        origin = (lowest + highest) / 2
+    else:
+        origin = np.zeros(np.asarray(clouds[0]).shape[-1] if clouds else 3)
+
+    return origin, [(np.asarray(cloud, dtype=np.float64) - origin).astype(dtype)
+                    for cloud in clouds]
+
 
 #---------------------------------------------------------------------------------------------------
 #---------------------------------------------------------------------------------------------------
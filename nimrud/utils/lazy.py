@@ -0,0 +1,159 @@
+# pylint: disable=E0401, E1101
+
+"""
+lazy imports, for modules whose heavy dependencies (pycuda, matplotlib, scipy, sklearn) are only
+needed by some of their functions.
+
+a name bound with lazy_import or lazy_from at the top of a module stands in for the module or
+attribute, and imports it the first time it is used. importing the module itself then costs
+nothing for those dependencies, and doesn't fail on machines without them (for instance, pycuda
+with no CUDA driver) unless something that needs them is actually called.
+
+import_benchmark measures how long modules take to import in a fresh interpreter, and which heavy
+dependencies they pull in.
+"""
+
+import ast
+import importlib
+import os
+import subprocess
+import sys
+
+
+# packages that are slow to import, or that need hardware
+HEAVY_MODULES = ["matplotlib", "pycuda", "scipy", "sklearn"]
+
+#---------------------------------------------------------------------------------------------------
+
+class LazyModule(object):
+    """
+    stands in for the named module, importing it on first attribute access
+    """
+
+    def __init__(self, name):
+
+        self._name = name
+        self._module = None
+
+    #==================================
+
+    def _load(self):
+        """
+        import the module, if that hasn't happened yet, and return it
+        """
+
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    #==================================
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    #==================================
+
+    def __repr__(self):
+        return "<lazy module {}{}>".format(self._name, "" if self._module is None else " (loaded)")
+
+#---------------------------------------------------------------------------------------------------
+
+class LazyAttribute(object):
+    """
+    stands in for an attribute of the named module (a class or function, typically), importing
+    the module the first time it is called or has an attribute looked up
+    """
+
+    def __init__(self, module_name, attribute):
+
+        self._module = LazyModule(module_name)
+        self._attribute = attribute
+
+    #==================================
+
+    def _load(self):
+        """
+        the attribute itself
+        """
+        return getattr(self._module, self._attribute)
+
+    #==================================
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    #==================================
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    #==================================
+
+    def __repr__(self):
+        return "<lazy {}.{}>".format(self._module._name, self._attribute)
+
+#---------------------------------------------------------------------------------------------------
+
+def lazy_import(name):
+    """
+    lazy stand in for "import name"
+    """
+    return LazyModule(name)
+
+#---------------------------------------------------------------------------------------------------
+
+def lazy_from(module_name, attribute):
+    """
+    lazy stand in for "from module_name import attribute"
+    """
+    return LazyAttribute(module_name, attribute)
+
+#---------------------------------------------------------------------------------------------------
+
+def import_benchmark(module_names, path=None, repeat=3):
+    """
+    import each module in a fresh interpreter repeat times, with path (a directory, such as the
+    prototypes directory for their implicit relative imports) at the front of sys.path.
+
+    returns a dict mapping each module name to (fastest import time in seconds, sorted list of
+    the HEAVY_MODULES it loaded). a module that fails to import raises a RuntimeError with the
+    interpreter's error output.
+    """
+
+    script = "\n".join([
+        "import sys, time",
+        "start = time.time()",
+        "import {name}",
+        "elapsed = time.time() - start",
+        "heavy = [m for m in {heavy!r} if m in sys.modules]",
+        "print(repr((elapsed, heavy)))"])
+    environment = dict(os.environ)
+    if path is not None:
+        environment["PYTHONPATH"] = os.pathsep.join(
+            [path] + [p for p in [environment.get("PYTHONPATH")] if p])
+
+    results = {}
+    for name in module_names:
+        timings = []
+        for _ in range(repeat):
+            process = subprocess.Popen(
+                [sys.executable, "-c", script.format(name=name, heavy=HEAVY_MODULES)],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environment,
+                universal_newlines=True)
+            output, errors = process.communicate()
+            if process.returncode != 0:
+                raise RuntimeError("importing {} failed:\n{}".format(name, errors))
+            timings.append(ast.literal_eval(output.strip().splitlines()[-1]))
+        results[name] = (min(timing[0] for timing in timings), sorted(timings[0][1]))
+
+    return results
+
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    PROTOTYPES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              "prototypes")
+    for module, (seconds, heavy) in sorted(
+            import_benchmark(["mso", "ml", "apc"], path=PROTOTYPES).items()):
+        print("{:>6}: {:.3f} s, heavy modules loaded: {}".format(
+            module, seconds, ", ".join(heavy) or "none"))
@@ -4,15 +4,32 @@
 implements FlexCloud which facilitates point cloud classification by tracking associations between
 points, features and labels.
 
-stylish future upgrade for FlexCloud: subclass MutableMapping to index with keys like a dictionary.
-make each asset a key. use bracket notation with the facet name (__getitem__) to return an asset
-array.
+FlexCloud subclasses MutableMapping to index with keys like a dictionary. each asset is a key, and
+bracket notation with the facet name (__getitem__) returns an asset array. assigning an array
+replaces the asset's rows at its current index (or covers the whole cloud, for a new asset), and
+assigning an (asset, index) pair replaces the asset outright. assets can also be registered as
+recipes, which are only computed when they are first asked for. clouds compare and hash by
+identity, like plain objects, rather than by their assets.
 """
 
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from itertools import product
+import os
+
 import numpy as np
 
 
-class FlexCloud(object):
+# default number of bytes that memoized derived assets may occupy before the least recently used
+# ones are dropped
+DERIVED_BYTE_BUDGET = 2 * 1024 ** 3
+
+# ways FlexCloud can store its points. see FlexCloud.__init__
+COORDINATE_ENCODINGS = ["raw", "float32", "int32"]
+
+#---------------------------------------------------------------------------------------------------
+
+class FlexCloud(MutableMapping):
     """
     given a 3d point cloud as a 2d numpy array, shift its points close to the origin and track its
     features. any supplemental information must be added separately, after the object has been 
@@ -45,24 +62,226 @@ class FlexCloud(object):
             meta: "this is why i think this is a good idea..."
         }
     }
+
+    derived assets are registered with add_recipe as a function of the cloud (its points and other
+    assets) plus keyword parameters. a derived asset is computed the first time it is accessed,
+    and then memoized in the asset dictionary alongside the regular assets. memoized derived
+    assets are dropped least recently used first once they take up more than derived_budget
+    bytes, and recomputed (or reloaded, if they were persisted) when they are asked for again.
     """
 
     #==================================
 
-    def __init__(self, input_cloud):
+    def __init__(
+            self,
+            input_cloud,
+            derived_budget=DERIVED_BYTE_BUDGET,
+            encoding="raw",
+            scale=0.001):
+        """
+        encoding sets how the points are stored relative to the corner:
+            "raw" keeps them at the dtype they came in with.
+            "float32" keeps them as single precision offsets.
+            "int32" quantizes them to integer multiples of scale (as in LAS files), so that
+                decoded coordinates are within scale / 2 of the originals.
+        points are decoded back to float64 on demand by take.
+        """
 
         if input_cloud.ndim != 2: 
             raise ValueError("input point cloud must be a 2D array")
         if input_cloud.shape[1] != 3:
             raise ValueError("must be initialized with a 3D point cloud")
+        if encoding not in COORDINATE_ENCODINGS:
+            raise ValueError("{} is not a supported coordinate encoding".format(encoding))
         # now bring the point cloud in to the origin
         self.corner = input_cloud[0]
-        self.points = input_cloud - self.corner
+        self.encoding = encoding
+        self.scale = scale if encoding == "int32" else None
+        self.points = self._encode_points(input_cloud - self.corner)
+        self._initialize_assets(derived_budget)
+
+    #==================================
+
+    def _initialize_assets(self, derived_budget):
+        """
+        index the stored points and start empty asset and recipe dictionaries
+        """
+
         # count how many points we have in the original point cloud
-        self.num_points = input_cloud.shape[0]
+        self.num_points = self.points.shape[0]
         self.id_index = np.arange(self.num_points)
         # initialize the asset dictionary
         self.assets = {}
+        # recipes for derived assets, and the memory used by those which have been computed, in
+        # order of last access
+        self.recipes = {}
+        self.derived_budget = derived_budget
+        self._derived_usage = OrderedDict()
+        # spare capacity for assets which are grown incrementally: {name: (index, asset)}. the
+        # arrays in the asset dictionary are views on the head of these.
+        self._growth_buffers = {}
+
+    #==================================
+
+    @classmethod
+    def _from_encoded(cls, template, corner, points):
+        """
+        build a FlexCloud around points which are already stored in the encoding of template,
+        relative to corner. the new cloud has no assets.
+        """
+
+        cloud = cls.__new__(cls)
+        cloud.corner = corner
+        cloud.encoding = template.encoding
+        cloud.scale = template.scale
+        cloud.points = points
+        cloud._initialize_assets(template.derived_budget)
+        return cloud
+
+    #==================================
+
+    @classmethod
+    def concat(cls, clouds):
+        """
+        concatenate a sequence of FlexClouds into a new one, which takes its corner and encoding
+        from the first. points of each cloud keep their order and follow those of the clouds
+        before it. every asset which has been computed in any cloud is carried over, with its
+        indices offset to address the concatenated points; recipes are not carried over.
+        """
+
+        clouds = list(clouds)
+        if not clouds:
+            raise ValueError("need at least one cloud to concatenate")
+        first = clouds[0]
+        corner = first.corner
+        offsets = np.cumsum([0] + [cloud.num_points for cloud in clouds])
+
+        # allocate the output once and write each cloud into its slice. points are only decoded
+        # through float64 when they have to be moved to a different corner or encoding.
+        if first.encoding == "raw":
+            point_dtype = np.result_type(*[cloud.points.dtype for cloud in clouds])
+        else:
+            point_dtype = first.points.dtype
+        points = np.empty((offsets[-1], 3), dtype=point_dtype)
+        for cloud, start, stop in zip(clouds, offsets[:-1], offsets[1:]):
+            shift = cloud.corner - corner
+            same_storage = cloud.encoding == first.encoding and cloud.scale == first.scale
+            if same_storage and not np.any(shift):
+                points[start:stop] = cloud.points
+            else:
+                points[start:stop] = first._encode_points(cloud.take(original_coordinates=False)
+                                                          + shift)
+        output = cls._from_encoded(first, corner, points)
+
+        # the asset indices of each cloud are sorted and unique, and shifting them by increasing
+        # offsets keeps them that way, so the assets can simply be stacked.
+        asset_names = []
+        for cloud in clouds:
+            asset_names.extend(name for name in cloud.assets if name not in asset_names)
+        for name in asset_names:
+            present = [(cloud.assets[name], offset) for cloud, offset in zip(clouds, offsets)
+                       if name in cloud.assets]
+            trailing_shapes = set(record["asset"].shape[1:] for record, _ in present)
+            if len(trailing_shapes) > 1:
+                raise ValueError("asset {} has mismatched shapes across clouds".format(name))
+            output.assets[name] = {
+                "asset": np.concatenate([record["asset"] for record, _ in present], axis=0),
+                "index": np.concatenate([record["index"] + offset for record, offset in present]),
+                "meta": present[0][0]["meta"]
+            }
+
+        return output
+
+    #==================================
+
+    def subset(self, index_array):
+        """
+        return a new FlexCloud holding the points addressed by a unique index array, in that
+        order, with the same corner and encoding. every computed asset is carried over with its
+        indices remapped to the new points; recipes are not carried over.
+        """
+
+        index_array = np.asarray(index_array)
+        if index_array.ndim != 1:
+            raise ValueError("index array must be 1D")
+        if index_array.size and (index_array.min() < 0 or index_array.max() >= self.num_points):
+            raise ValueError("index array addresses outside the extant cloud")
+
+        # the stored points can be taken as they are, without decoding them
+        output = self._from_encoded(self, self.corner, self.points.take(index_array, axis=0))
+
+        # sort the requested indices once, then binary search each asset's indices into them
+        sorter = np.argsort(index_array, kind="mergesort")
+        sorted_indices = index_array.take(sorter)
+        if np.any(sorted_indices[1:] == sorted_indices[:-1]):
+            raise ValueError("index array must be unique")
+
+        for name, record in self.assets.items():
+            positions, found = _sorted_membership(sorted_indices, record["index"])
+            new_index = sorter.take(positions.compress(found))
+            # new indices follow the order of index_array, so put them back in sorted order
+            new_order = np.argsort(new_index)
+            output.assets[name] = {
+                "asset": record["asset"].compress(found, axis=0).take(new_order, axis=0),
+                "index": new_index.take(new_order),
+                "meta": record["meta"]
+            }
+
+        return output
+
+    #==================================
+
+    # Mapping's __eq__ would compare every (derived) asset array, and leave clouds unhashable
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
+    def __getitem__(self, asset_name):
+        return self._asset_record(asset_name)["asset"]
+
+    def __setitem__(self, asset_name, value):
+        if asset_name in self.recipes:
+            raise ValueError("derived asset {} cannot be modified".format(asset_name))
+        if isinstance(value, tuple):
+            asset_array, index_array = value
+        else:
+            # a bare array, as __getitem__ returns it, keeps the asset's index
+            asset_array = value
+            if asset_name in self.assets:
+                index_array = self.assets[asset_name]["index"]
+            else:
+                index_array = np.arange(self.num_points)
+        meta = self.assets[asset_name]["meta"] if asset_name in self.assets else None
+        asset_array, index_array = self._validate_asset(np.asarray(asset_array),
+                                                        np.asarray(index_array))
+        self.assets[asset_name] = {
+            "asset": asset_array,
+            "index": index_array,
+            "meta": meta
+        }
+        self._growth_buffers.pop(asset_name, None)
+
+    def __delitem__(self, asset_name):
+        if asset_name not in self:
+            raise KeyError(asset_name)
+        self.assets.pop(asset_name, None)
+        self.recipes.pop(asset_name, None)
+        self._derived_usage.pop(asset_name, None)
+        self._growth_buffers.pop(asset_name, None)
+
+    def __iter__(self):
+        for asset_name in self.assets:
+            yield asset_name
+        for asset_name in self.recipes:
+            if asset_name not in self.assets:
+                yield asset_name
+
+    def __len__(self):
+        return len(set(self.assets).union(self.recipes))
+
+    def __contains__(self, asset_name):
+        # don't fall back on __getitem__ here, or we would compute derived assets just to check
+        # whether they exist
+        return asset_name in self.assets or asset_name in self.recipes
 
     #==================================
 
@@ -73,7 +292,7 @@ class FlexCloud(object):
         """
 
         # first make sure this is a good idea
-        if asset_name in self.assets:
+        if asset_name in self:
             raise ValueError("asset {} already exists in asset dictionary".format(asset_name))
         asset_array, index_array = self._validate_asset(asset_array, index_array)
 
@@ -88,6 +307,193 @@ class FlexCloud(object):
 
     #==================================
 
+    def append_asset(self, asset_array, index_array, asset_name, meta=None, buffered=False):
+        """
+        merge new rows into an asset, creating it if it doesn't exist yet. raise an exception if
+        any of the new indices are already in the asset. see upsert_asset for the arguments.
+        """
+
+        self._merge_asset(asset_array, index_array, asset_name, meta, buffered, replace=False)
+
+    #==================================
+
+    def upsert_asset(self, asset_array, index_array, asset_name, meta=None, buffered=False):
+        """
+        merge new rows into an asset, creating it if it doesn't exist yet. rows whose indices are
+        already in the asset replace the old ones; the rest are inserted in sorted order with a
+        linear merge. meta is only used if the asset is created.
+
+        if buffered, the asset is stored at the head of a buffer with spare capacity that at
+        least doubles whenever it fills up, so batches which land after the asset's last index
+        are written in place and repeated appends cost amortized O(n) overall.
+        """
+
+        self._merge_asset(asset_array, index_array, asset_name, meta, buffered, replace=True)
+
+    #==================================
+
+    def _merge_asset(self, asset_array, index_array, asset_name, meta, buffered, replace):
+        """
+        merge (index, value) rows into a sorted asset. see upsert_asset.
+        """
+
+        if asset_name in self.recipes:
+            raise ValueError("derived asset {} cannot be modified".format(asset_name))
+        asset_array, index_array = self._validate_asset(asset_array, index_array)
+
+        if asset_name in self.assets:
+            record = self.assets[asset_name]
+        else:
+            record = {
+                "asset": asset_array[:0],
+                "index": index_array[:0],
+                "meta": meta
+            }
+            self.assets[asset_name] = record
+        # an empty batch leaves the asset as it is
+        if index_array.size == 0:
+            return
+        old_index = record["index"]
+        old_asset = record["asset"]
+        if old_asset.shape[1:] != asset_array.shape[1:]:
+            raise ValueError("new rows don't match the shape of asset {}".format(asset_name))
+        asset_dtype = np.result_type(old_asset, asset_array)
+
+        # overwrite the rows we already have
+        positions, found = _sorted_membership(old_index, index_array)
+        if np.any(found):
+            if not replace:
+                raise ValueError("some indices are already in asset {}".format(asset_name))
+            if asset_dtype != old_asset.dtype:
+                old_asset = old_asset.astype(asset_dtype)
+            old_asset[positions.compress(found)] = asset_array.compress(found, axis=0)
+            index_array = index_array.compress(~found)
+            asset_array = asset_array.compress(~found, axis=0)
+
+        # the rest get merged in. each new row lands after every old row that sorts before it,
+        # and after the new rows before it.
+        num_old = old_index.size
+        num_total = num_old + index_array.size
+        new_positions = np.searchsorted(old_index, index_array) + np.arange(index_array.size)
+        old_positions = np.ones(num_total, dtype=bool)
+        old_positions[new_positions] = False
+        old_positions = old_positions.nonzero()[0]
+
+        index_buffer, asset_buffer = self._growth_buffers.get(asset_name, (None, None))
+        in_place = buffered and index_buffer is not None and\
+            index_buffer.size >= num_total and asset_buffer.dtype == asset_dtype
+        if not in_place:
+            capacity = num_total
+            if buffered:
+                old_capacity = 0 if index_buffer is None else index_buffer.size
+                capacity = max(num_total, 2 * old_capacity)
+            index_buffer = np.empty(capacity, dtype=np.result_type(old_index, index_array))
+            asset_buffer = np.empty((capacity,) + old_asset.shape[1:], dtype=asset_dtype)
+
+        # old rows only ever move towards the tail. if they aren't moving (the new batch sorts
+        # after them) and we're already in the right buffer, there's nothing to do for them.
+        if not in_place:
+            index_buffer[old_positions] = old_index
+            asset_buffer[old_positions] = old_asset
+        elif not np.array_equal(old_positions, np.arange(num_old)):
+            # fancy assignment doesn't guard against its source overlapping its destination
+            index_buffer[old_positions] = old_index.copy()
+            asset_buffer[old_positions] = old_asset.copy()
+        index_buffer[new_positions] = index_array
+        asset_buffer[new_positions] = asset_array
+
+        if buffered:
+            self._growth_buffers[asset_name] = (index_buffer, asset_buffer)
+        else:
+            self._growth_buffers.pop(asset_name, None)
+        record["index"] = index_buffer[:num_total]
+        record["asset"] = asset_buffer[:num_total]
+
+    #==================================
+
+    def add_recipe(self, asset_name, function, params=None, meta=None, persist_dir=None):
+        """
+        register a derived asset. function is called as function(cloud, **params) the first time
+        the asset is accessed, and must return a tuple (asset_array, index_array) like the
+        arguments to add_asset. if persist_dir is given, the computed asset is saved there as .npy
+        files and later loaded from disk instead of being recomputed. persisted files are keyed
+        by asset name only, so use a fresh directory if the recipe or its parameters change.
+        """
+
+        if asset_name in self:
+            raise ValueError("asset {} already exists in asset dictionary".format(asset_name))
+        if not callable(function):
+            raise ValueError("recipe for {} is not callable".format(asset_name))
+
+        self.recipes[asset_name] = {
+            "function": function,
+            "params": {} if params is None else dict(params),
+            "meta": meta,
+            "persist_dir": persist_dir
+        }
+
+    #==================================
+
+    def _asset_record(self, asset_name):
+        """
+        return the {index, asset, meta} dictionary for an asset, computing it first if it is a
+        derived asset that is not currently memoized.
+        """
+
+        if asset_name in self._derived_usage:
+            self._derived_usage.move_to_end(asset_name)
+        if asset_name in self.assets:
+            return self.assets[asset_name]
+        if asset_name not in self.recipes:
+            raise KeyError(asset_name)
+
+        recipe = self.recipes[asset_name]
+        persist_paths = None
+        if recipe["persist_dir"] is not None:
+            persist_paths = [
+                os.path.join(recipe["persist_dir"], "{}_{}.npy".format(asset_name, part))
+                for part in ["asset", "index"]]
+
+        if persist_paths is not None and all(os.path.exists(path) for path in persist_paths):
+            # this was validated before it was saved
+            asset_array, index_array = [np.load(path) for path in persist_paths]
+        else:
+            asset_array, index_array = recipe["function"](self, **recipe["params"])
+            asset_array, index_array = self._validate_asset(
+                np.asarray(asset_array),
+                np.asarray(index_array))
+            if persist_paths is not None:
+                os.makedirs(recipe["persist_dir"], exist_ok=True)
+                np.save(persist_paths[0], asset_array)
+                np.save(persist_paths[1], index_array)
+
+        self.assets[asset_name] = {
+            "asset": asset_array,
+            "index": index_array,
+            "meta": recipe["meta"]
+        }
+        self._derived_usage[asset_name] = asset_array.nbytes + index_array.nbytes
+        self._evict_derived(asset_name)
+
+        return self.assets[asset_name]
+
+    #==================================
+
+    def _evict_derived(self, keep_name):
+        """
+        drop least recently used derived assets until they fit in the byte budget. the asset named
+        keep_name is never dropped, even if it is over budget on its own.
+        """
+
+        while sum(self._derived_usage.values()) > self.derived_budget:
+            oldest_name = next(iter(self._derived_usage))
+            if oldest_name == keep_name:
+                break
+            del self._derived_usage[oldest_name]
+            del self.assets[oldest_name]
+
+    #==================================
+
     def _validate_asset(self, asset_array, index_array):
         """
         unique and sort the index array, and align the asset array to match it.
@@ -104,7 +510,7 @@ class FlexCloud(object):
         # make sure all indices are unique and sorted
         unique_indices, index_to_unique = np.unique(index_array, return_index=True)
         # make sure the index array will index into the cloud
-        if index_array.min() < 0 or index_array.max() >= self.num_points:
+        if index_array.size and (index_array.min() < 0 or index_array.max() >= self.num_points):
             raise ValueError("index array addresses outside the extant cloud")
 
         # now return (assets, indices)
@@ -122,7 +528,7 @@ class FlexCloud(object):
         # intersection operator.
         index_accumulator = self.id_index
         for name in asset_names:
-            this_index = self.assets[name]["index"]
+            this_index = self._asset_record(name)["index"]
             index_accumulator = np.intersect1d(index_accumulator, this_index, assume_unique=True)
 
         # how many points are there?
@@ -131,8 +537,8 @@ class FlexCloud(object):
         # we can now use in1d to find each asset that is present in the intersection
         asset_accumulator = []
         for name in asset_names:
-            this_index = self.assets[name]["index"]
-            this_asset = self.assets[name]["asset"]
+            this_index = self._asset_record(name)["index"]
+            this_asset = self._asset_record(name)["asset"]
             # find which assets are present in the output index set
             mask = np.in1d(this_index, index_accumulator, assume_unique=True)
             # put them on the accumulator
@@ -149,15 +555,158 @@ class FlexCloud(object):
         equivalent to ndarray.take(). return a subset of the FlexCloud's points addressed by an
         index array, in the original coordinates if desired. if no index given, return all.
         """
-        if original_coordinates:
-            return_points = self.points + self.corner
+        # pick out the points before decoding them, so we only decode what was asked for
+        if index_array is not None:
+            return_points = self.points.take(index_array, axis=0)
         else:
             return_points = self.points
-        if index_array is not None:
-            return return_points.take(index_array, axis=0)
+        return_points = self._decode_points(return_points)
+        if original_coordinates:
+            return return_points + self.corner
         else:
             return return_points
 
     #==================================
 
+    def _encode_points(self, relative_points):
+        """
+        convert points relative to the corner into the storage encoding of this cloud
+        """
+
+        if self.encoding == "float32":
+            return relative_points.astype(np.float32)
+        elif self.encoding == "int32":
+            if self.scale <= 0:
+                raise ValueError("quantization scale must be positive")
+            quantized = np.round(relative_points / self.scale)
+            int_limits = np.iinfo(np.int32)
+            if quantized.min() < int_limits.min or quantized.max() > int_limits.max:
+                raise ValueError("quantization scale is too small to encode this cloud in int32")
+            return quantized.astype(np.int32)
+        else:
+            return relative_points
+
+    #==================================
+
+    def _decode_points(self, stored_points):
+        """
+        convert stored points back into coordinates relative to the corner
+        """
+
+        if self.encoding == "float32":
+            return stored_points.astype(np.float64)
+        elif self.encoding == "int32":
+            return stored_points * self.scale
+        else:
+            return stored_points
+
+    #==================================
+
+    def iter_tiles(self, edge, halo, assets=None):
+        """
+        stream the cloud in cubic tiles of a given edge length. yields a tuple
+        (query_indices, search_indices, tile_assets) for each occupied tile, where query_indices
+        are the points falling inside the tile, search_indices are the points inside the tile
+        grown by halo in every coordinate direction (as in geometry.nested_regions), and
+        tile_assets maps each requested asset name to a dictionary holding the index and asset
+        rows of that asset which fall in the search set.
+
+        the tiles come from a single sort of the points by tile address. the halo of each tile is
+        gathered from its neighboring tiles in the sorted order, so no pass over the whole cloud
+        is made per tile.
+        """
+
+        if edge <= 0:
+            raise ValueError("tile edge length must be positive")
+        if halo < 0:
+            raise ValueError("halo cannot be negative")
+        if assets is None:
+            assets = []
+        for name in assets:
+            if name not in self:
+                raise ValueError("asset {} is not in the asset dictionary".format(name))
+
+        points = self.take(original_coordinates=False)
+        origin = points.min(0)
+
+        # integer tile coordinates of each point, folded into one scalar address per tile
+        tile_coordinates = np.floor((points - origin) / edge).astype(np.int64)
+        grid_shape = tile_coordinates.max(0) + 1
+        addresses = np.ravel_multi_index(tile_coordinates.T, grid_shape)
+
+        # the one sorted pass: every tile is now a contiguous run of the sort order
+        sort_order = np.argsort(addresses, kind="mergesort")
+        tile_addresses, tile_starts = np.unique(addresses.take(sort_order), return_index=True)
+        tile_stops = np.append(tile_starts[1:], self.num_points)
+
+        # how many rings of neighboring tiles the halo can reach into
+        reach = int(np.ceil(halo / edge))
+        neighbor_offsets = np.asarray(list(product(range(-reach, reach + 1), repeat=3)))
+
+        for tile_address, start, stop in zip(tile_addresses, tile_starts, tile_stops):
+            query_indices = np.sort(sort_order[start:stop])
+
+            tile_coordinate = np.asarray(np.unravel_index(tile_address, grid_shape))
+            low_side = origin + tile_coordinate * edge - halo
+            high_side = origin + (tile_coordinate + 1) * edge + halo
+
+            # find the occupied neighbors of this tile in the sorted address list
+            neighbors = tile_coordinate + neighbor_offsets
+            in_grid = np.all((neighbors >= 0) & (neighbors < grid_shape), axis=1)
+            neighbor_addresses = np.ravel_multi_index(neighbors[in_grid].T, grid_shape)
+            positions = _sorted_lookup(tile_addresses, neighbor_addresses)
+
+            candidates = np.concatenate(
+                [sort_order[tile_starts[pos]:tile_stops[pos]] for pos in positions])
+            candidate_points = points.take(candidates, axis=0)
+            mask = np.all((candidate_points >= low_side) & (candidate_points <= high_side), axis=1)
+            search_indices = np.sort(candidates.compress(mask))
+
+            yield query_indices, search_indices, self._slice_assets(assets, search_indices)
+
+    #==================================
+
+    def _slice_assets(self, asset_names, index_array):
+        """
+        return a dictionary of {name: {"index": ..., "asset": ...}} holding the rows of each named
+        asset whose indices appear in the sorted, unique index_array.
+        """
+
+        sliced = {}
+        for name in asset_names:
+            record = self._asset_record(name)
+            this_index = record["index"]
+            this_asset = record["asset"]
+            positions = _sorted_lookup(this_index, index_array)
+            sliced[name] = {
+                "index": this_index.take(positions),
+                "asset": this_asset.take(positions, axis=0)
+            }
+
+        return sliced
+
     #==================================
+
+#---------------------------------------------------------------------------------------------------
+
+def _sorted_membership(sorted_keys, query_keys):
+    """
+    binary search query_keys in sorted_keys (sorted and unique). return the candidate position of
+    each query key and a boolean mask of which ones were actually found there.
+    """
+
+    if sorted_keys.size == 0:
+        return np.zeros(query_keys.size, dtype=np.int64), np.zeros(query_keys.size, dtype=bool)
+    positions = np.searchsorted(sorted_keys, query_keys).clip(max=sorted_keys.size - 1)
+    return positions, sorted_keys.take(positions) == query_keys
+
+#---------------------------------------------------------------------------------------------------
+
+def _sorted_lookup(sorted_keys, query_keys):
+    """
+    return the positions in sorted_keys (sorted and unique) of every entry of query_keys that is
+    present there. entries of query_keys that are not found are dropped.
+    """
+
+    positions, found = _sorted_membership(sorted_keys, query_keys)
+    return positions.compress(found)
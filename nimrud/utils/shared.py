@@ -0,0 +1,159 @@
+# pylint: disable=E0401, E1101
+
+"""
+implements SharedArray, a numpy array in multiprocessing.shared_memory, and run_partitioned, which
+spreads work over index ranges of shared arrays across a pool of processes.
+
+the arrays are copied into shared memory once and every worker attaches to them when it starts,
+so each task only carries its index range and a few small arguments. nothing the size of a point
+cloud is pickled per task, and workers write their results straight into shared output arrays.
+"""
+
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# shared arrays attached by a pool worker, and anything its tasks want to keep between them (a
+# search tree, for instance). set up by _attach when the worker starts.
+_WORKER_STATE = {}
+
+#---------------------------------------------------------------------------------------------------
+
+class SharedArray(object):
+    """
+    a numpy array backed by a named block of shared memory. the process that creates it owns the
+    block and should unlink it when done; other processes attach to it by its spec.
+    """
+
+    def __init__(self, shape, dtype, name=None):
+
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.owner = name is None
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.memory.buf)
+
+    #==================================
+
+    @classmethod
+    def from_array(cls, array):
+        """
+        copy an array into a new block of shared memory
+        """
+
+        array = np.ascontiguousarray(array)
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    #==================================
+
+    @classmethod
+    def attach(cls, spec):
+        """
+        attach to the shared array described by spec, from another process
+        """
+        return cls(spec[1], spec[2], name=spec[0])
+
+    #==================================
+
+    @property
+    def spec(self):
+        """
+        (name, shape, dtype) tuple, small enough to hand to other processes
+        """
+        return self.memory.name, self.shape, self.dtype.str
+
+    #==================================
+
+    def close(self):
+        """
+        detach from the shared memory, and free it if this is the process that created it
+        """
+
+        self.array = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+#---------------------------------------------------------------------------------------------------
+
+def run_partitioned(function, inputs, outputs, num_rows, partition_size, workers=1, args=(),
+                    cache=None):
+    """
+    call function(inputs, outputs, start, stop, cache, *args) for consecutive ranges
+    [start, stop) of num_rows rows, partition_size rows at a time. inputs and outputs are tuples
+    of arrays; function reads the first and writes its rows of the second in place. cache is a
+    dict the function may keep things in between partitions.
+
+    with more than one worker, inputs and outputs are put in shared memory once and the
+    partitions are handed to a pool of workers processes, so function must be importable by name
+    (a module level function). outputs are copied back in place when all partitions are done.
+
+    a cache given here starts off every process's cache. whatever is expensive to build and the
+    same for every partition (a search tree over the whole search space, say) should be built
+    into it once, rather than by each worker: forked workers inherit it without copying, and
+    other start methods pickle it to each worker once.
+    """
+
+    cache = {} if cache is None else cache
+
+    ranges = [(start, min(start + partition_size, num_rows))
+              for start in range(0, num_rows, partition_size)]
+    if workers <= 1 or len(ranges) <= 1:
+        for start, stop in ranges:
+            function(inputs, outputs, start, stop, cache, *args)
+        return
+
+    shared_inputs = [SharedArray.from_array(array) for array in inputs]
+    shared_outputs = [SharedArray.from_array(array) for array in outputs]
+    try:
+        pool = multiprocessing.Pool(
+            min(workers, len(ranges)),
+            initializer=_attach,
+            initargs=([array.spec for array in shared_inputs],
+                      [array.spec for array in shared_outputs],
+                      cache))
+        try:
+            pool.starmap(_run_task, [(function, start, stop, args) for start, stop in ranges])
+        finally:
+            pool.close()
+            pool.join()
+        for output, shared in zip(outputs, shared_outputs):
+            output[...] = shared.array
+    finally:
+        for shared in shared_inputs + shared_outputs:
+            shared.close()
+
+#---------------------------------------------------------------------------------------------------
+
+def _attach(input_specs, output_specs, cache):
+    """
+    pool worker initializer: attach to the shared arrays once, for all of this worker's tasks,
+    and start its cache off from the one run_partitioned was given
+    """
+
+    _WORKER_STATE["inputs"] = [SharedArray.attach(spec) for spec in input_specs]
+    _WORKER_STATE["outputs"] = [SharedArray.attach(spec) for spec in output_specs]
+    _WORKER_STATE["cache"] = dict(cache)
+
+#---------------------------------------------------------------------------------------------------
+
+def _run_task(function, start, stop, args):
+    """
+    run one partition in a pool worker, on the arrays it attached to
+    """
+
+    function(
+        tuple(shared.array for shared in _WORKER_STATE["inputs"]),
+        tuple(shared.array for shared in _WORKER_STATE["outputs"]),
+        start,
+        stop,
+        _WORKER_STATE["cache"],
+        *args)
@@ -0,0 +1,160 @@
+# pylint: disable=E0401, E1101
+
+"""
+implements SpillStore, which holds arrays too big to keep in memory in preallocated memory-mapped
+files and serves them back as memmap views.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+
+
+# number of elements in each preallocated segment file. 3 GB of float32.
+DEFAULT_CAPACITY = 750000000
+
+# environment variable naming the directory spill stores go under when none is given. without it
+# they go to the system's temporary directory.
+SPILL_VARIABLE = "NIMRUD_SPILL_DIR"
+
+#---------------------------------------------------------------------------------------------------
+
+class SpillStore(object):
+    """
+    an append-only sequence of arrays (of any shape, one dtype) spilled to disk. arrays are
+    copied into preallocated memmap segment files by a background thread, so the caller can go on
+    building the next one while the last is written. chunks() waits for the writes and yields
+    each array back, in order, as a view on its memmap.
+
+    the segment files live in a fresh temporary directory under directory (or the directory named
+    by the NIMRUD_SPILL_DIR environment variable, or the system's temporary directory) which is
+    removed by close(), or when the store is garbage collected if close() is never called.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, dtype=np.float32, directory=None):
+
+        if capacity <= 0:
+            raise ValueError("segment capacity must be positive")
+        self.capacity = int(capacity)
+        self.dtype = np.dtype(dtype)
+        if directory is None:
+            directory = os.environ.get(SPILL_VARIABLE) or None
+        self.directory = tempfile.mkdtemp(prefix="nimrud_spill_", dir=directory)
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self.directory, True)
+
+        # memmap segment files, and the (segment, offset, shape) of every stored array
+        self._segments = []
+        self._records = []
+        # where the next array will be written
+        self._segment_number = 0
+        self._offset = 0
+
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._pending = []
+
+    #==================================
+
+    def __len__(self):
+        return len(self._records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    #==================================
+
+    def append(self, array):
+        """
+        queue an array to be written to the store. the array must not be modified until the
+        write finishes (flush, chunks, clear and close all wait for it).
+        """
+
+        array = np.ascontiguousarray(array, dtype=self.dtype)
+        segment_number, offset = self._reserve(array.size)
+        destination = self._segments[segment_number][offset:offset + array.size]
+        self._pending.append(self._writer.submit(np.copyto, destination, array.ravel()))
+        self._records.append((segment_number, offset, array.shape))
+
+    #==================================
+
+    def _reserve(self, size):
+        """
+        find room for size elements, moving on to the next segment file (and creating it if
+        necessary) when the current one is full. return the (segment, offset) to write at.
+        """
+
+        while True:
+            if self._segment_number == len(self._segments):
+                path = os.path.join(self.directory, "segment{}.dat".format(len(self._segments)))
+                self._segments.append(np.memmap(
+                    path,
+                    dtype=self.dtype,
+                    mode="w+",
+                    shape=(max(self.capacity, size, 1),)))
+            if self._offset + size <= self._segments[self._segment_number].size:
+                break
+            self._segment_number += 1
+            self._offset = 0
+
+        position = (self._segment_number, self._offset)
+        self._offset += size
+        return position
+
+    #==================================
+
+    def flush(self):
+        """
+        wait for every queued write to finish, raising any exception one of them hit
+        """
+
+        pending, self._pending = self._pending, []
+        for write in pending:
+            write.result()
+
+    #==================================
+
+    def chunks(self):
+        """
+        yield every stored array, in the order they were appended, as a memmap view
+        """
+
+        self.flush()
+        for segment_number, offset, shape in self._records:
+            size = int(np.prod(shape))
+            yield self._segments[segment_number][offset:offset + size].reshape(shape)
+
+    #==================================
+
+    def clear(self):
+        """
+        forget the stored arrays, keeping the segment files to write over
+        """
+
+        self.flush()
+        self._records = []
+        self._segment_number = 0
+        self._offset = 0
+
+    #==================================
+
+    def close(self):
+        """
+        release the segment files and delete the temporary directory
+        """
+
+        if self._writer is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self._writer.shutdown()
+            self._writer = None
+            self._records = []
+            self._segments = []
+            self._cleanup()
@@ -0,0 +1,57 @@
+# pylint: disable=E0401, E1101
+
+"""
+tests for the OutputBuffer class
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+from nimrud.utils import buffers
+
+SEED = 10
+np.random.seed(SEED)
+
+#---------------------------------------------------------------------------------------------------
+
+def test_output_buffer():
+    """
+    rows written out of order should come back in index order, with only the filled ones kept
+    """
+
+    rows = np.random.rand(100, 5).astype(np.float32)
+    for directory in [None, tempfile.mkdtemp()]:
+        buffer = buffers.OutputBuffer(100, 5, directory=directory)
+        assert len(buffer) == 100 and not buffer.filled.any(), "didn't start empty"
+        if directory is not None:
+            assert isinstance(buffer.data, np.memmap), "didn't back the buffer with a memmap"
+
+        # write two partitions in scrambled order, leaving some rows out
+        order = np.random.permutation(100)
+        for part in [order[:40], order[50:]]:
+            buffer.write(part, rows[part])
+        written = np.sort(np.concatenate([order[:40], order[50:]]))
+        assert np.array_equal(buffer.filled_index(), written), "wrong filled rows"
+        filled = buffer.filled_rows()
+        assert type(filled) is np.ndarray, "didn't return an in-memory array"
+        assert np.array_equal(filled, rows[written]), "rows came back wrong"
+
+        path = buffer.path
+        buffer.close()
+        if directory is not None:
+            assert not os.path.exists(path), "didn't delete the backing file"
+            os.rmdir(directory)
+
+    # a single row can be broadcast over several indices
+    buffer = buffers.OutputBuffer(10, 2, dtype=np.float64)
+    buffer.write([1, 3], [7, 8])
+    assert np.array_equal(buffer.filled_rows(), [[7, 8], [7, 8]]), "didn't broadcast the row"
+
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    print("testing output buffers")
+    test_output_buffer()
+    print("output buffers work")
@@ -0,0 +1,119 @@
+# pylint: disable=E0401, E1101
+
+"""
+tests for the content-addressed feature cache
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from nimrud.utils import cache
+
+SEED = 10
+np.random.seed(SEED)
+
+#---------------------------------------------------------------------------------------------------
+
+def test_cache_keys():
+    """
+    keys should depend on the contents of arrays and the values of everything else, only
+    """
+
+    store = cache.FeatureCache(tempfile.mkdtemp())
+    cloud = np.random.rand(100, 3)
+    key = store.key("G_MSO", [cloud, 0.05, np.array([0.5, 0.2]), "radius"])
+
+    assert key == store.key("G_MSO", [cloud.copy(), 0.05, np.array([0.5, 0.2]), "radius"]),\
+        "same call got a different key"
+    assert key == store.key("G_MSO", [np.asfortranarray(cloud), 0.05, np.array([0.5, 0.2]),
+                                      "radius"]), "memory layout changed the key"
+    changed = cloud.copy()
+    changed[50, 1] += 1e-9
+    for arguments in [[changed, 0.05, np.array([0.5, 0.2]), "radius"],
+                      [cloud, 0.1, np.array([0.5, 0.2]), "radius"],
+                      [cloud, 0.05, np.array([0.5, 0.1]), "radius"],
+                      [cloud.astype(np.float32), 0.05, np.array([0.5, 0.2]), "radius"],
+                      [cloud, 0.05, np.array([0.5, 0.2]), "knn"]]:
+        assert store.key("G_MSO", arguments) != key, "different call got the same key"
+    assert store.key("C_MSO", [cloud, 0.05, np.array([0.5, 0.2]), "radius"]) != key,\
+        "different operator got the same key"
+
+    shutil.rmtree(store.directory)
+
+#---------------------------------------------------------------------------------------------------
+
+def test_cache_store():
+    """
+    results should come back as stored, and the least recently used ones should go first when
+    the cache is full
+    """
+
+    result = np.random.rand(100, 10).astype(np.float32)
+    store = cache.FeatureCache(tempfile.mkdtemp(), max_bytes=int(result.nbytes * 2.5))
+    assert store.get("nothing") is None, "found a result that was never stored"
+
+    for key in ["first", "second"]:
+        store.put(key, result)
+    hit = store.get("first")
+    assert np.array_equal(hit, result) and hit.dtype == np.float32, "result came back wrong"
+    hit[0] = 0
+    assert np.array_equal(store.get("first"), result), "writing to a hit changed the cache"
+
+    # use "first" after "second", so "second" is the least recently used
+    os.utime(store.path("second"), (time.time() - 100, time.time() - 100))
+    store.put("third", result)
+    assert store.get("second") is None, "didn't evict the least recently used result"
+    assert store.get("first") is not None and store.get("third") is not None,\
+        "evicted a recently used result"
+    assert store.size() <= store.max_bytes, "cache is over its cap"
+
+    store.put("huge", np.zeros(result.size * 3, dtype=np.float32))
+    assert store.get("huge") is None, "stored a result bigger than the cache"
+    store.clear()
+    assert store.size() == 0, "didn't clear"
+    shutil.rmtree(store.directory)
+
+#---------------------------------------------------------------------------------------------------
+
+def test_cached_operator():
+    """
+    a cached operator should only run once for repeated identical calls
+    """
+
+    calls = []
+
+    @cache.cached_operator("square", ignore=("workers",))
+    def square(points, scale, offset=0, workers=1):
+        """
+        count calls and return something from the arguments
+        """
+        calls.append(workers)
+        return points * scale + offset
+
+    store = cache.FeatureCache(tempfile.mkdtemp())
+    points = np.random.rand(50, 3)
+    known = square(points, 2.0)
+    assert np.array_equal(square(points, 2.0, cache=store), known), "wrong first result"
+    assert np.array_equal(square(points, 2.0, 0, workers=4, cache=store), known),\
+        "wrong cached result"
+    assert len(calls) == 2, "ran the operator again for the same call"
+    square(points, 2.0, offset=1, cache=store)
+    assert len(calls) == 3, "used a cached result for a different call"
+    shutil.rmtree(store.directory)
+
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    print("testing cache keys")
+    test_cache_keys()
+    print("cache keys work")
+    print("testing cache storage")
+    test_cache_store()
+    print("cache storage works")
+    print("testing cached operators")
+    test_cached_operator()
+    print("cached operators work")
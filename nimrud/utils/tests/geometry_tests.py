@@ -279,6 +279,31 @@ def test_voxel_unique():
             "failed to get correct set of unique voxels at dimension {}".format(dim)
 
 
+#---------------------------------------------------------------------------------------------------
+
+def test_local_frame():
+    """
+    move two clouds far from the origin into a shared float32 frame and check that the offsets
+    between their points survive
+    """
+
+    corner = np.array([512345.678, 4123456.789, 150.0])
+    query_set = corner + np.random.rand(50, 3)
+    search_space = corner + np.random.rand(200, 3) * 2
+    origin, (local_query, local_search) = geometry.local_frame(query_set, search_space)
+
+    assert local_query.dtype == np.float32 and local_search.dtype == np.float32,\
+        "clouds not stored in single precision"
+    assert np.allclose(origin, corner + 1, atol=0.01), "frame not centered on the clouds"
+    assert np.allclose(local_search + origin, search_space, atol=1e-6, rtol=0),\
+        "lost the search space's coordinates"
+    exact = search_space[:10] - query_set[0]
+    assert np.abs((local_search[:10] - local_query[0]) - exact).max() < 1e-6,\
+        "offsets lost precision in the local frame"
+    assert np.abs((search_space[:10].astype(np.float32) - query_set[0].astype(np.float32))
+                  - exact).max() > 1e-3, "absolute float32 coordinates shouldn't be this precise"
+
+
 #---------------------------------------------------------------------------------------------------
 
 def test_octree_init():
@@ -540,6 +565,8 @@ if __name__ == '__main__':
     print("voxels transform back to correct coordinates")
     test_voxel_unique()
     print("unique voxel transform functions")
+    test_local_frame()
+    print("local frame keeps offsets")
     print("that does it for the voxel filter")
     print("testing nested partitions")
     test_nested_regions()
@@ -0,0 +1,58 @@
+# pylint: disable=E0401, E1101
+
+"""
+tests for lazy imports and the import benchmark
+"""
+
+import os
+import sys
+
+from nimrud.utils import lazy
+
+PROTOTYPES = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "prototypes")
+
+#---------------------------------------------------------------------------------------------------
+
+def test_lazy_import():
+    """
+    lazy names shouldn't import anything until they're used, and then act like the real thing
+    """
+
+    name = "json.tool"
+    sys.modules.pop(name, None)
+    module = lazy.lazy_import(name)
+    function = lazy.lazy_from("colorsys", "rgb_to_hsv")
+    assert name not in sys.modules, "imported before first use"
+    assert callable(module.main), "didn't load the module"
+    assert name in sys.modules, "didn't import on first use"
+    assert function(1, 0, 0) == (0, 1, 1), "didn't call through to the attribute"
+
+    missing = lazy.lazy_import("no_such_module_here")
+    try:
+        missing.anything
+        assert False, "found a module that doesn't exist"
+    except ImportError:
+        pass
+
+#---------------------------------------------------------------------------------------------------
+
+def test_prototype_imports():
+    """
+    importing the prototypes shouldn't load pycuda, matplotlib, scipy or sklearn
+    """
+
+    results = lazy.import_benchmark(["mso", "ml", "apc"], path=PROTOTYPES, repeat=1)
+    for module, (seconds, heavy) in results.items():
+        assert seconds >= 0, "bad timing"
+        assert heavy == [], "{} loaded {} at import".format(module, ", ".join(heavy))
+
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    print("testing lazy imports")
+    test_lazy_import()
+    print("lazy imports work")
+    print("testing prototype imports")
+    test_prototype_imports()
+    print("prototypes import without heavy dependencies")
@@ -4,9 +4,11 @@
 tests for the FlexCloud class
 """
 
+import tempfile
+
 import numpy as np
 
-from nimrud.utils import point_clouds
+from nimrud.utils import geometry, point_clouds
 
 SEED = 10
 np.random.seed(SEED)
@@ -105,6 +107,68 @@ def test_add_asset():
 
 #---------------------------------------------------------------------------------------------------
 
+def test_append_upsert():
+    """
+    merging batches into an asset should leave it exactly as if it had been added in one piece
+    """
+
+    points = np.random.rand(1000, 3)
+    values = np.random.rand(1000, 2)
+    order = np.random.permutation(1000)
+
+    for buffered in [False, True]:
+        cloud = point_clouds.FlexCloud(points)
+        # ten shuffled batches, then ten in increasing order of index
+        for batch in np.array_split(order[:500], 10) + np.array_split(np.sort(order[500:]), 10):
+            cloud.append_asset(values[batch], batch, "asset_1", meta="meta", buffered=buffered)
+        assert np.array_equal(cloud.assets["asset_1"]["index"], np.arange(1000)),\
+            "appended index wrong with buffered={}".format(buffered)
+        assert np.array_equal(cloud.assets["asset_1"]["asset"], values),\
+            "appended asset wrong with buffered={}".format(buffered)
+        assert cloud.assets["asset_1"]["meta"] == "meta", "didn't set meta on creation"
+
+        # append refuses indices it already holds
+        try:
+            cloud.append_asset(values[:10], np.arange(10), "asset_1", buffered=buffered)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("appended duplicate indices with buffered={}".format(buffered))
+
+    # upsert replaces what it has and inserts the rest
+    cloud = point_clouds.FlexCloud(points)
+    cloud.add_asset(values[::2], np.arange(0, 1000, 2), "asset_1")
+    new_values = np.random.rand(200, 2)
+    new_idx = np.arange(100, 300)
+    cloud.upsert_asset(new_values, new_idx, "asset_1")
+    known_idx = np.union1d(np.arange(0, 1000, 2), new_idx)
+    known = dict(zip(np.arange(0, 1000, 2), values[::2]))
+    known.update(zip(new_idx, new_values))
+    assert np.array_equal(cloud.assets["asset_1"]["index"], known_idx), "upserted index wrong"
+    assert np.array_equal(cloud.assets["asset_1"]["asset"], [known[i] for i in known_idx]),\
+        "upserted asset wrong"
+
+    # empty batches leave an asset alone, or create it empty
+    cloud.upsert_asset(np.zeros(0), np.zeros(0, int), "asset_1")
+    cloud.append_asset(np.zeros(0), np.zeros(0, int), "asset_1")
+    assert np.array_equal(cloud.assets["asset_1"]["index"], known_idx),\
+        "empty batch changed the asset"
+    cloud.append_asset(np.zeros(0), np.zeros(0, int), "asset_2", buffered=True)
+    assert cloud.assets["asset_2"]["index"].size == 0, "empty batch didn't create an empty asset"
+    cloud.append_asset(values[:10, 0], np.arange(10), "asset_2", buffered=True)
+    assert np.array_equal(cloud.assets["asset_2"]["asset"], values[:10, 0]),\
+        "couldn't append to an asset created empty"
+
+    # shapes have to match
+    try:
+        cloud.upsert_asset(np.random.rand(10), np.arange(10), "asset_1")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("upserted rows of the wrong shape")
+
+#---------------------------------------------------------------------------------------------------
+
 def test_intersection():
     """
     test intersecting the assets
@@ -152,10 +216,267 @@ def test_take():
 
 #---------------------------------------------------------------------------------------------------
 
+def test_encoding():
+    """
+    compact encodings should store the points in fewer bytes and decode them within their
+    precision bounds
+    """
+
+    # something like a projected survey, far from the origin
+    points = np.random.rand(1000, 3) * 1000 + np.array([500000, 5000000, 100])
+    idx = np.random.permutation(1000)[:100]
+
+    cloud = point_clouds.FlexCloud(points, encoding="int32", scale=0.001)
+    assert cloud.points.dtype == np.int32, "didn't quantize to int32"
+    assert np.abs(cloud.take() - points).max() <= 0.0005 + 1e-9, "int32 error out of bounds"
+    assert np.abs(cloud.take(idx) - points.take(idx, axis=0)).max() <= 0.0005 + 1e-9,\
+        "int32 take failed with given idx"
+
+    cloud = point_clouds.FlexCloud(points, encoding="float32")
+    assert cloud.points.dtype == np.float32, "didn't store float32"
+    # relative coordinates span about 1000 m
+    assert np.abs(cloud.take() - points).max() <= np.spacing(np.float32(1000)),\
+        "float32 error out of bounds"
+    assert cloud.take().dtype == np.float64, "didn't decode to float64"
+
+    # these should not work
+    for bad_kwargs in [{"encoding": "int8"}, {"encoding": "int32", "scale": 1e-9}]:
+        try:
+            point_clouds.FlexCloud(points, **bad_kwargs)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("accepted encoding arguments {}".format(bad_kwargs))
+
+#---------------------------------------------------------------------------------------------------
+
+def test_concat():
+    """
+    concatenation should stack points in order, in the original coordinates, with every asset's
+    indices offset to the right cloud
+    """
+
+    points_1 = np.random.rand(1000, 3)
+    points_2 = np.random.rand(500, 3) + 10
+    cloud_1 = point_clouds.FlexCloud(points_1)
+    cloud_2 = point_clouds.FlexCloud(points_2, encoding="float32")
+
+    asset_1 = np.random.rand(100, 2)
+    asset_1_idx = np.arange(100) * 3
+    asset_2 = np.random.rand(50, 2)
+    asset_2_idx = np.arange(50) * 7
+    cloud_1.add_asset(asset_1, asset_1_idx, "shared")
+    cloud_2.add_asset(asset_2, asset_2_idx, "shared")
+    cloud_2.add_asset(asset_2[:, 0], asset_2_idx, "second_only")
+
+    cloud = point_clouds.FlexCloud.concat([cloud_1, cloud_2])
+    assert cloud.num_points == 1500, "concatenated the wrong number of points"
+    assert np.array_equal(cloud.corner, cloud_1.corner), "didn't keep the first corner"
+    assert np.allclose(cloud.take(), np.vstack((points_1, points_2)), atol=1e-5),\
+        "didn't reconcile the corners"
+    assert np.array_equal(cloud.assets["shared"]["index"], np.hstack((asset_1_idx,
+                                                                      asset_2_idx + 1000))),\
+        "didn't offset the asset indices"
+    assert np.array_equal(cloud.assets["shared"]["asset"], np.vstack((asset_1, asset_2))),\
+        "didn't stack the asset"
+    assert np.array_equal(cloud.assets["second_only"]["index"], asset_2_idx + 1000),\
+        "didn't offset an asset held by one cloud"
+
+    # assets with different widths can't be stacked
+    cloud_3 = point_clouds.FlexCloud(points_2)
+    cloud_3.add_asset(asset_2[:, 0], asset_2_idx, "shared")
+    try:
+        point_clouds.FlexCloud.concat([cloud_1, cloud_3])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("stacked assets with mismatched shapes")
+
+#---------------------------------------------------------------------------------------------------
+
+def test_subset():
+    """
+    a subset should hold the addressed points in order, and every asset remapped to them
+    """
+
+    points = np.random.rand(1000, 3)
+    cloud = point_clouds.FlexCloud(points, encoding="int32", scale=0.0001)
+    asset = np.random.rand(500, 2)
+    asset_idx = np.random.permutation(1000)[:500]
+    cloud.add_asset(asset, asset_idx, "asset_1")
+
+    idx = np.random.permutation(1000)[:300]
+    sub = cloud.subset(idx)
+    assert sub.points.dtype == np.int32, "didn't keep the encoding"
+    assert np.array_equal(sub.take(), cloud.take(idx)), "took the wrong points"
+
+    # brute force the remapped asset
+    lookup = dict(zip(asset_idx, asset))
+    known = sorted((new, lookup[old]) for new, old in enumerate(idx) if old in lookup)
+    assert np.array_equal(sub.assets["asset_1"]["index"], [new for new, _ in known]),\
+        "remapped the asset indices incorrectly"
+    assert np.array_equal(sub.assets["asset_1"]["asset"], [row for _, row in known]),\
+        "misaligned the remapped asset"
+
+    for bad_idx in [np.array([0, 0, 1]), np.array([-1, 2]), np.array([1000])]:
+        try:
+            cloud.subset(bad_idx)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("took a subset with index {}".format(bad_idx))
+
+#---------------------------------------------------------------------------------------------------
+
+def test_iter_tiles():
+    """
+    tiles should cover every point exactly once, and their halo-buffered search sets should match
+    what nested_regions finds for the same bounds
+    """
 
+    points = np.random.rand(3000, 3) * 10
+    cloud = point_clouds.FlexCloud(points)
+    asset_idx = np.random.permutation(3000)[:1000]
+    cloud.add_asset(np.random.rand(1000, 2), asset_idx, "asset_1")
+
+    edge = 2.5
+    halo = 0.5
+    local_points = cloud.take(original_coordinates=False)
+    origin = local_points.min(0)
+
+    seen = np.zeros(3000, dtype=np.int64)
+    for query_idx, search_idx, tile_assets in cloud.iter_tiles(edge, halo, assets=["asset_1"]):
+        seen[query_idx] += 1
+
+        # the tile is the cell containing its first point
+        low = origin + np.floor((local_points[query_idx[0]] - origin) / edge) * edge
+        high = low + edge
+        known_query, known_search = geometry.nested_regions(
+            local_points, local_points, halo, low, high)
+        assert np.array_equal(np.intersect1d(known_query, query_idx), query_idx),\
+            "tile holds points outside its bounds"
+        assert np.array_equal(known_search, search_idx), "tile has the wrong halo search set"
+
+        # the asset rows should be exactly those in the search set
+        known_asset_idx = np.intersect1d(cloud.assets["asset_1"]["index"], search_idx)
+        assert np.array_equal(known_asset_idx, tile_assets["asset_1"]["index"]),\
+            "sliced the wrong asset indices"
+        mask = np.in1d(cloud.assets["asset_1"]["index"], known_asset_idx)
+        assert np.array_equal(
+            cloud.assets["asset_1"]["asset"][mask],
+            tile_assets["asset_1"]["asset"]), "asset rows misaligned with their indices"
+
+    assert np.all(seen == 1), "tiles did not cover every point exactly once"
+
+    # bad arguments
+    for bad_edge, bad_halo in [(0, halo), (edge, -halo)]:
+        try:
+            list(cloud.iter_tiles(bad_edge, bad_halo))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("accepted edge {} and halo {}".format(bad_edge, bad_halo))
 
 #---------------------------------------------------------------------------------------------------
 
+def test_mapping():
+    """
+    the FlexCloud should behave like a dictionary of asset arrays
+    """
+
+    points = np.random.rand(1000, 3)
+    cloud = point_clouds.FlexCloud(points)
+
+    asset_1 = np.random.rand(100, 2)
+    asset_1_idx = np.arange(100)[::-1]
+    cloud["asset_1"] = (asset_1, asset_1_idx)
+    assert "asset_1" in cloud, "didn't add asset through bracket notation"
+    assert np.array_equal(cloud["asset_1"], asset_1[::-1]), "didn't return the sorted asset array"
+    assert list(cloud) == ["asset_1"] and len(cloud) == 1, "iterated over the wrong keys"
+
+    # assignment replaces, and takes back what indexing gives out
+    cloud["asset_1"] = cloud["asset_1"] * 2
+    assert np.array_equal(cloud["asset_1"], 2 * asset_1[::-1]), "didn't replace the asset"
+    assert np.array_equal(cloud.assets["asset_1"]["index"], np.arange(100)),\
+        "didn't keep the asset's index"
+    cloud["asset_1"] = (asset_1[:10], np.arange(10))
+    assert cloud["asset_1"].shape == (10, 2), "didn't replace the asset and its index"
+    cloud.update({"asset_2": points[:, 0]})
+    assert cloud.setdefault("asset_2", None) is cloud["asset_2"], "setdefault replaced an asset"
+    assert np.array_equal(cloud.assets["asset_2"]["index"], np.arange(1000)),\
+        "new bare asset didn't cover the cloud"
+    del cloud["asset_2"]
+
+    # clouds compare by identity
+    other = point_clouds.FlexCloud(points)
+    assert cloud == cloud and cloud != other, "compared clouds by their assets"
+    assert len({cloud, other, cloud}) == 2, "clouds aren't hashable"
+
+    del cloud["asset_1"]
+    assert "asset_1" not in cloud, "didn't delete asset"
+    try:
+        cloud["asset_1"]
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("returned a deleted asset")
+
+#---------------------------------------------------------------------------------------------------
+
+def test_derived_assets():
+    """
+    recipes should run on first access only, be dropped when over budget and reload from disk if
+    they were persisted
+    """
+
+    points = np.random.rand(1000, 3)
+    calls = []
+
+    def heights(cloud, offset):
+        """
+        z coordinate of every point, plus an offset
+        """
+        calls.append(offset)
+        return cloud.take()[:, 2] + offset, cloud.id_index
+
+    # each derived asset holds 16000 bytes, so only one fits
+    cloud = point_clouds.FlexCloud(points, derived_budget=20000)
+    cloud.add_recipe("height_1", heights, params={"offset": 1})
+    cloud.add_recipe("height_2", heights, params={"offset": 2})
+    assert "height_1" in cloud and not calls, "computed a recipe before it was accessed"
+    assert len(cloud) == 2, "didn't count recipes as assets"
+
+    assert np.allclose(cloud["height_1"], points[:, 2] + 1), "computed the wrong asset"
+    cloud["height_1"]
+    assert calls == [1], "didn't memoize the derived asset"
+
+    # computing the second evicts the first
+    index, block = cloud.intersection(["height_2"])
+    assert np.allclose(block.ravel(), points[:, 2] + 2), "intersection missed a derived asset"
+    assert "height_1" not in cloud.assets, "didn't evict over budget"
+    cloud["height_1"]
+    assert calls == [1, 2, 1], "didn't recompute an evicted asset"
+
+    # registering a name twice is an error
+    try:
+        cloud.add_recipe("height_1", heights)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("registered a recipe under an existing name")
+
+    # persisted assets are computed once and then loaded from disk
+    with tempfile.TemporaryDirectory() as persist_dir:
+        for _ in range(2):
+            cloud = point_clouds.FlexCloud(points)
+            cloud.add_recipe("height_3", heights, params={"offset": 3}, persist_dir=persist_dir)
+            assert np.allclose(cloud["height_3"], points[:, 2] + 3), "persisted the wrong asset"
+        assert calls == [1, 2, 1, 3], "didn't reload the persisted asset"
+
+#---------------------------------------------------------------------------------------------------
+
+
+
 
 if __name__ == '__main__':
 
@@ -165,11 +486,32 @@ if __name__ == '__main__':
     print("testing adding of assets")
     test_add_asset()    
     print("assets added correctly")
+    print("testing append and upsert")
+    test_append_upsert()
+    print("assets merged correctly")
     print("testing asset intersection")
     test_intersection()
     print("intersection operation tests out")
     print("testing take")
     test_take()
     print("take took")
+    print("testing coordinate encodings")
+    test_encoding()
+    print("encodings decode")
+    print("testing concatenation")
+    test_concat()
+    print("clouds concatenated")
+    print("testing subsets")
+    test_subset()
+    print("subsets taken")
+    print("testing tile iteration")
+    test_iter_tiles()
+    print("tiles iterated")
+    print("testing mapping interface")
+    test_mapping()
+    print("mapping works")
+    print("testing derived assets")
+    test_derived_assets()
+    print("derived assets derived")
 
 
@@ -0,0 +1,82 @@
+# pylint: disable=E0401, E1101
+
+"""
+tests for shared memory arrays and partitioned process pool runs
+"""
+
+import numpy as np
+
+from nimrud.utils import shared
+
+SEED = 10
+np.random.seed(SEED)
+
+#---------------------------------------------------------------------------------------------------
+
+def scaled_rows(inputs, outputs, start, stop, cache, factor):
+    """
+    write factor times the input rows, and count the partitions this process has seen
+    """
+
+    values, = inputs
+    output, = outputs
+    cache["partitions"] = cache.get("partitions", 0) + 1
+    output[start:stop] = values[start:stop] * factor
+
+#---------------------------------------------------------------------------------------------------
+
+def cached_rows(inputs, outputs, start, stop, cache):
+    """
+    write the input rows times a factor found in the cache
+    """
+
+    values, = inputs
+    output, = outputs
+    output[start:stop] = values[start:stop] * cache["factor"]
+
+#---------------------------------------------------------------------------------------------------
+
+def test_shared_array():
+    """
+    an attached shared array should see the data written through the original
+    """
+
+    values = np.random.rand(20, 3)
+    original = shared.SharedArray.from_array(values)
+    attached = shared.SharedArray.attach(original.spec)
+    assert np.array_equal(attached.array, values), "attached array doesn't match"
+    original.array[0] = -1
+    assert np.all(attached.array[0] == -1), "writes aren't shared"
+    attached.close()
+    original.close()
+
+#---------------------------------------------------------------------------------------------------
+
+def test_run_partitioned():
+    """
+    partitions run in a process pool should fill the same output as a serial run
+    """
+
+    values = np.random.rand(1003, 4)
+    for workers in [1, 3]:
+        output = np.zeros_like(values)
+        shared.run_partitioned(scaled_rows, (values,), (output,), values.shape[0], 100, workers,
+                               (2.0,))
+        assert np.array_equal(output, values * 2), "wrong output with {} workers".format(workers)
+
+        # a cache built up front reaches every worker
+        output = np.zeros_like(values)
+        shared.run_partitioned(cached_rows, (values,), (output,), values.shape[0], 100, workers,
+                               cache={"factor": 3.0})
+        assert np.array_equal(output, values * 3),\
+            "didn't start from the given cache with {} workers".format(workers)
+
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    print("testing shared arrays")
+    test_shared_array()
+    print("shared arrays work")
+    print("testing partitioned runs")
+    test_run_partitioned()
+    print("partitioned runs work")
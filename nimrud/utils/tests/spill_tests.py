@@ -0,0 +1,84 @@
+# pylint: disable=E0401, E1101
+
+"""
+tests for the SpillStore class
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+from nimrud.utils import spill
+
+SEED = 10
+np.random.seed(SEED)
+
+#---------------------------------------------------------------------------------------------------
+
+def test_spill_store():
+    """
+    test that spilled arrays come back intact, in order, as memmap views
+    """
+
+    with tempfile.TemporaryDirectory() as parent:
+        store = spill.SpillStore(capacity=100, directory=parent)
+        assert os.path.dirname(store.directory) == parent, "didn't use the parent directory"
+
+        # shapes vary like the padded neighborhood tensors do, and one is bigger than a segment
+        arrays = [np.random.rand(4, 5, 3), np.random.rand(2, 7, 3), np.random.rand(10, 6, 3),
+                  np.random.rand(0, 2, 3)]
+        for array in arrays:
+            store.append(array)
+        assert len(store) == len(arrays), "miscounted the stored arrays"
+
+        chunks = list(store.chunks())
+        for chunk, array in zip(chunks, arrays):
+            assert isinstance(chunk, np.memmap) or chunk.size == 0, "didn't serve a memmap view"
+            assert chunk.dtype == np.float32, "didn't store at the store precision"
+            assert np.array_equal(chunk, array.astype(np.float32)), "corrupted an array"
+        assert len(os.listdir(store.directory)) == 3, "didn't grow to fit the arrays"
+
+        # clearing reuses the segment files
+        store.clear()
+        assert len(store) == 0 and not list(store.chunks()), "didn't clear the store"
+        store.append(arrays[1])
+        assert np.array_equal(next(store.chunks()), arrays[1].astype(np.float32)),\
+            "corrupted an array after clearing"
+        assert len(os.listdir(store.directory)) == 3, "didn't reuse the segment files"
+
+        directory = store.directory
+        store.close()
+        assert not os.path.exists(directory), "didn't clean up the temporary directory"
+        store.close()
+
+        # the context manager cleans up too
+        with spill.SpillStore(capacity=10, directory=parent) as store:
+            store.append(np.ones(25))
+            directory = store.directory
+        assert not os.path.exists(directory), "context manager didn't clean up"
+
+        # without a directory, the environment names the parent
+        saved = os.environ.get(spill.SPILL_VARIABLE)
+        os.environ[spill.SPILL_VARIABLE] = parent
+        try:
+            with spill.SpillStore(capacity=10) as store:
+                assert os.path.dirname(store.directory) == parent, "didn't read the environment"
+        finally:
+            if saved is None:
+                del os.environ[spill.SPILL_VARIABLE]
+            else:
+                os.environ[spill.SPILL_VARIABLE] = saved
+
+    try:
+        spill.SpillStore(capacity=0)
+        assert False, "accepted an empty segment capacity"
+    except ValueError:
+        pass
+
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    print("testing the spill store")
+    test_spill_store()
+    print("spill store works")